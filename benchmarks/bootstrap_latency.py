@@ -0,0 +1,169 @@
+"""
+Compares how soon bootstrap sends each instance of a scale out its deploy
+commands on the lookup path and on the fast path, against the in-process fake
+AWS in fake_aws.py.  Each burst launches that many instances at once, their
+launch events spread over --containers Lambda containers that each handle
+theirs one after another, starting with empty caches:
+
+  lookup  - looks up the pipeline bucket with CodePipeline, checks each
+            instance with DescribeInstances and reads the latest artifact
+            pointer
+  fast    - the bucket given in GARLC_PIPELINE_BUCKET, instances not checked
+            and the commands the main function recorded in the pointer sent
+  prewarm - the fast path, in containers a Prewarm event warmed beforehand
+
+For each burst and path it reports, in simulated milliseconds of API
+latency, the median and 99th percentile time an invocation took, the time
+from the launch to the last instance's SendCommand, and the AWS API calls
+made per instance.  The lookups bootstrap runs side by side each start at
+the same simulated time, and the invocation goes on once the slowest ends.
+Import and client creation costs are not simulated (see cold_start.py).
+Usage:
+
+    python benchmarks/bootstrap_latency.py [--bursts 10 100 1000] [--containers 100]
+        [--latency 0.03] [--json]
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda')
+sys.path.insert(0, LAMBDA_DIR)
+
+import bootstrap  # pylint: disable=wrong-import-position
+import main as garlc_main  # pylint: disable=wrong-import-position
+import throttling  # pylint: disable=wrong-import-position
+from fake_aws import FakeAWS  # pylint: disable=wrong-import-position
+
+ARTIFACT_KEY = 'GARLC/MyApp/artifact.zip'
+PATHS = ['lookup', 'fast', 'prewarm']
+CONTAINER_CACHES = [bootstrap.BUCKET_CACHE, bootstrap.ARTIFACT_CACHE, bootstrap.VERSION_CACHE]
+
+class Container(object):
+    """
+    The caches and rate limiters of one Lambda container, and the simulated
+    time it is next free at
+    """
+    def __init__(self, free):
+        self.free = free
+        self.entries = dict((cache.name, {}) for cache in CONTAINER_CACHES)
+        self.buckets = {}
+
+    def invoke(self, backend, event):
+        """
+        Runs bootstrap in this container once it is free, and returns the
+        simulated seconds the invocation took
+        """
+        for cache in CONTAINER_CACHES:
+            cache.entries = self.entries[cache.name]
+        throttling.BUCKETS = self.buckets
+        backend.clock.now = self.free
+        backend.clock.time()
+        bootstrap.handle(event, backend.context())
+        took = backend.clock.time() - self.free
+        self.free += took
+        return took
+
+def simulated_run_lookups(clock):
+    """
+    Returns a stand-in for parallel.run_lookups running each lookup from the
+    same simulated time, as they overlap in real time, and going on when the
+    slowest ends
+    """
+    def run_lookups(lookups, timeout=None):
+        """Runs the lookups one after the other on the simulated clock"""
+        started = clock.time()
+        results = []
+        ended = started
+        for _, func, _ in lookups:
+            clock.now = started
+            clock.time()
+            results.append(func())
+            ended = max(ended, clock.time())
+        clock.now = ended
+        clock.time()
+        return results
+    return run_lookups
+
+def percentile(values, percent):
+    """
+    Returns the value percent of values are at or below
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+def measure(burst, path, args):
+    """
+    Launches burst instances at once and returns how soon bootstrap sent
+    them their commands on path
+    """
+    backend = FakeAWS(burst, latency=args.latency)
+    backend['s3'].add_object(ARTIFACT_KEY, b'artifact')
+    fast = path != 'lookup'
+    saved = (bootstrap.PIPELINE_BUCKET, bootstrap.VALIDATE_INSTANCES, bootstrap.run_lookups,
+             throttling.BUCKETS)
+    bootstrap.PIPELINE_BUCKET = backend.bucket if fast else ''
+    bootstrap.VALIDATE_INSTANCES = not fast
+    bootstrap.run_lookups = simulated_run_lookups(backend.clock)
+    try:
+        with backend.installed():
+            garlc_main.record_artifact('s3://%s/%s' % (backend.bucket, ARTIFACT_KEY),
+                                       'latency-test')
+            launched = backend.clock.time() + 60
+            containers = [Container(launched) for _ in range(min(burst, args.containers))]
+            if path == 'prewarm':
+                for container in containers:
+                    container.free = launched - 10
+                    container.invoke(backend, {'Prewarm': True})
+                    container.free = launched
+            before = sum(backend.api_calls().values())
+            took = [containers[i % len(containers)].invoke(
+                backend, {'detail': {'instance-id': instance['InstanceId']}})
+                    for i, instance in enumerate(backend['ec2'].instances)]
+            calls = sum(backend.api_calls().values()) - before
+    finally:
+        (bootstrap.PIPELINE_BUCKET, bootstrap.VALIDATE_INSTANCES, bootstrap.run_lookups,
+         throttling.BUCKETS) = saved
+        for cache in CONTAINER_CACHES:
+            cache.entries = {}
+    assert backend['ssm'].targets == burst, 'Not every instance was sent its commands'
+    return {
+        'burst': burst,
+        'path': path,
+        'median': percentile(took, 50) * 1000,
+        'p99': percentile(took, 99) * 1000,
+        'last': (max(container.free for container in containers) - launched) * 1000,
+        'calls': calls / float(burst)
+    }
+
+def main():
+    """
+    Measures every burst on every path and prints a row for each
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--bursts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--containers', type=int, default=100,
+                        help='Lambda containers the launch events are spread over')
+    parser.add_argument('--latency', type=float, default=0.03,
+                        help='simulated seconds each API call takes')
+    parser.add_argument('--json', action='store_true', help='print the raw measurements')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = [measure(burst, path, args) for burst in args.bursts for path in PATHS]
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    print('%-8s %-8s %10s %10s %10s %10s' % (
+        'burst', 'path', 'median ms', 'p99 ms', 'last ms', 'calls/inst'))
+    for result in results:
+        print('%-8d %-8s %10.1f %10.1f %10.1f %10.2f' % (
+            result['burst'], result['path'], result['median'], result['p99'],
+            result['last'], result['calls']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Measures the cold start of each GARLC Lambda handler against a stubbed AWS.
+Every run happens in a fresh interpreter and reports, in milliseconds:
+
+  import  - importing the handler module
+  boto3   - importing boto3 the first time a client is needed
+  first   - the first invocation, including client creation
+  warm    - a second invocation in the same container
+
+AWS calls are answered from canned responses registered on the boto3 session,
+so nothing leaves the machine.  Usage:
+
+    python benchmarks/cold_start.py [--runs 5] [--instances 1000]
+"""
+from __future__ import print_function
+import argparse
+import datetime
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+HANDLERS = ['main', 'bootstrap', 'runcommand_helper']
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda')
+
+def canned_responses(instance_count):
+    """
+    Returns the response to every AWS operation the handlers make, keyed by
+    operation name
+    """
+    instances = [{'InstanceId': 'i-%08d' % i, 'Tags': []} for i in range(instance_count)]
+    return {
+        'DescribeInstances': {'Reservations': [{'Instances': instances}]},
+        'InvokeAsync': {'Status': 202},
+        'PutJobSuccessResult': {},
+        'PutJobFailureResult': {},
+        'GetPipeline': {'pipeline': {'artifactStore': {'location': 'garlc-bucket'}}},
+        'ListObjectsV2': {'Contents': [
+            {'Key': 'GARLC/MyApp/artifact.zip', 'LastModified': datetime.datetime(2016, 1, 1)}
+        ]},
+        'PutObject': {},
+        'SendCommand': {'Command': {'CommandId': 'benchmark'}}
+    }
+
+def handler_event(name, instance_count):
+    """
+    Returns an event that drives the named handler down its full path
+    """
+    if name == 'main':
+        return {'CodePipeline.job': {'id': 'benchmark', 'data': {'inputArtifacts': [
+            {'location': {'s3Location': {'bucketName': 'garlc-bucket',
+                                         'objectKey': 'GARLC/MyApp/artifact.zip'}}}
+        ]}}}
+    elif name == 'bootstrap':
+        return {'detail': {'instance-id': 'i-00000000'}}
+    instance_ids = ['i-%08d' % i for i in range(instance_count)]
+    return {
+        'ChunkedInstanceIds': [instance_ids[i:i + 50] for i in range(0, len(instance_ids), 50)],
+        'Commands': ['echo benchmark']
+    }
+
+class StubHttpResponse(object):
+    """
+    Minimal stand-in for the HTTP response botocore expects alongside a
+    parsed response
+    """
+    status_code = 200
+    headers = {}
+
+def stub_aws(responses):
+    """
+    Makes every client created from the default boto3 session answer from
+    responses instead of calling AWS
+    """
+    import boto3
+
+    def respond(model, **_kwargs):
+        """Short-circuits the request with the canned response"""
+        if model.name == 'GetObject':
+            # Bootstrap falls back to listing the bucket
+            return StubHttpResponse(), {'Body': io.BytesIO(b'{}')}
+        return StubHttpResponse(), responses[model.name]
+
+    boto3.setup_default_session(region_name='us-east-1')
+    boto3.DEFAULT_SESSION._session.register('before-call.*.*', respond)
+
+def measure(name, instance_count):
+    """
+    Runs in a fresh interpreter and returns the timings of the named handler
+    """
+    sys.path.insert(0, LAMBDA_DIR)
+    started = time.time()
+    module = __import__(name)
+    import_ms = (time.time() - started) * 1000
+
+    started = time.time()
+    stub_aws(canned_responses(instance_count))
+    boto3_ms = (time.time() - started) * 1000
+
+    event = handler_event(name, instance_count)
+    started = time.time()
+    module.handle(event, None)
+    first_ms = (time.time() - started) * 1000
+
+    started = time.time()
+    module.handle(event, None)
+    warm_ms = (time.time() - started) * 1000
+    return {'import': import_ms, 'boto3': boto3_ms, 'first': first_ms, 'warm': warm_ms}
+
+def run(name, instance_count):
+    """
+    Measures the named handler in a new interpreter
+    """
+    env = dict(os.environ)
+    env.update({
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        # Rate limiting would only measure the configured TPS
+        'GARLC_SSM_TPS': '100000',
+        'GARLC_EC2_TPS': '100000',
+        'GARLC_LAMBDA_TPS': '100000',
+        'GARLC_DEFAULT_TPS': '100000'
+    })
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--worker', name,
+         '--instances', str(instance_count)],
+        env=env, cwd=LAMBDA_DIR
+    )
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def median(values):
+    """
+    Returns the median of values
+    """
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def main():
+    """
+    Benchmarks every handler and prints the median of each timing
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--instances', type=int, default=1000)
+    parser.add_argument('--worker', choices=HANDLERS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        import logging
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(measure(args.worker, args.instances)))
+        return
+
+    print('%-18s %8s %8s %8s %8s' % ('handler (ms)', 'import', 'boto3', 'first', 'warm'))
+    for name in HANDLERS:
+        results = [run(name, args.instances) for _ in range(args.runs)]
+        print('%-18s %8.1f %8.1f %8.1f %8.1f' % tuple(
+            [name] + [median([result[key] for result in results])
+                      for key in ('import', 'boto3', 'first', 'warm')]
+        ))
+
+if __name__ == '__main__':
+    main()
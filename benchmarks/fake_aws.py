@@ -0,0 +1,478 @@
+"""
+In-process fake of the AWS APIs GARLC calls, for running the Lambda handlers
+end to end at fleet scale without an AWS account.  Every fake counts the calls
+made to it and runs on a SimulatedClock, so API latency, throttling backoff
+and Run Command execution cost no real time.  The clock is shared by every
+thread, and calls made side by side overlap on it as they would in real
+time.  Other regions each get an EC2 and SSM of their own, with a fleet of
+the same size, registered for the clients of that region.
+
+    backend = FakeAWS(instance_count=1000, ssm_tps=5)
+    with backend.installed():
+        main.handle(event, backend.context())
+        backend.run_helpers(runcommand_helper.handle)
+"""
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import threading
+from botocore.exceptions import ClientError
+
+class SimulatedClock(object):
+    """
+    Thread safe clock that only moves when something sleeps on it.  Stands
+    in for the time module in the handlers.  A sleep lasts from the time the
+    sleeping thread last read, so threads sleeping side by side overlap as
+    they would in real time instead of adding up.
+    """
+    RESOLUTION = 1e-6
+
+    def __init__(self, start=1500000000.0):
+        self.now = float(start)
+        self.lock = threading.Lock()
+        self.seen = threading.local()
+
+    def time(self):
+        """
+        Returns the simulated time.time()
+        """
+        with self.lock:
+            self.seen.now = self.now
+            return self.now
+
+    def sleep(self, seconds):
+        """
+        Advances the clock instead of sleeping
+        """
+        with self.lock:
+            if seconds > 0:
+                # Delays too small to move a time.time() sized float would
+                # leave a caller waiting on the clock forever
+                seconds = max(float(seconds), self.RESOLUTION)
+            wakes = getattr(self.seen, 'now', self.now) + max(seconds, 0)
+            self.now = max(self.now, wakes)
+            self.seen.now = wakes
+
+class FakeContext(object):
+    """
+    Lambda context whose remaining time runs down on the simulated clock
+    """
+    def __init__(self, clock, timeout_seconds=300):
+        self.clock = clock
+        self.deadline = clock.time() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        """
+        Returns the simulated milliseconds left in the invocation
+        """
+        return int(max(self.deadline - self.clock.time(), 0) * 1000)
+
+def throttling_error(operation):
+    """
+    Returns the ClientError AWS raises when a call is throttled
+    """
+    return ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                       operation)
+
+class FakeService(object):
+    """
+    Base of the fakes.  Counts calls and throttled calls by operation, adds
+    latency to every call and throttles calls beyond tps per second of
+    simulated time (no limit when tps is None).
+    """
+    def __init__(self, clock, latency=0.0, tps=None):
+        self.clock = clock
+        self.latency = latency
+        self.tps = tps
+        self.calls = {}
+        self.throttled = {}
+        self.window = (None, 0)
+        self.lock = threading.Lock()
+
+    def record(self, operation):
+        """
+        Counts a call to operation, raising a throttling error when the
+        service's rate is exceeded
+        """
+        self.clock.time()
+        self.clock.sleep(self.latency)
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self.tps is None:
+                return
+            second = int(self.clock.time())
+            start, count = self.window
+            count = count + 1 if start == second else 1
+            self.window = (second, count)
+            if count > self.tps:
+                self.throttled[operation] = self.throttled.get(operation, 0) + 1
+                raise throttling_error(operation)
+
+class FakeEC2(FakeService):
+    """
+    DescribeInstances over a fleet of synthetic instances that all match
+    GARLC's filters
+    """
+    def __init__(self, clock, instances, **kwargs):
+        super(FakeEC2, self).__init__(clock, **kwargs)
+        self.instances = instances
+
+    def describe_instances(self, **kwargs):
+        """
+        Returns a page of instances, following MaxResults and NextToken
+        """
+        self.record('DescribeInstances')
+        instances = self.instances
+        if 'Filters' in kwargs:
+            for name, values in [(f['Name'], f['Values']) for f in kwargs['Filters']]:
+                if name == 'instance-id':
+                    instances = [i for i in instances if i['InstanceId'] in values]
+        start = int(kwargs.get('NextToken', 0))
+        end = start + kwargs.get('MaxResults', 1000)
+        page = {'Reservations': [{'Instances': instances[start:end]}]}
+        if end < len(instances):
+            page['NextToken'] = str(end)
+        return page
+
+class FakeSSM(FakeService):
+    """
+    Run Command backend.  Each command takes run_seconds of simulated time
+    to finish on its instances and fails on the instances in failing.
+    """
+    MAX_INSTANCE_IDS = 50
+    LIST_PAGE_SIZE = 50
+
+    def __init__(self, clock, run_seconds=60, failing=(), **kwargs):
+        super(FakeSSM, self).__init__(clock, **kwargs)
+        self.run_seconds = run_seconds
+        self.failing = set(failing)
+        self.commands = []
+        self.targets = 0
+
+    def send_command(self, **kwargs):
+        """
+        Queues a command for up to 50 instances
+        """
+        self.record('SendCommand')
+        instance_ids = kwargs['InstanceIds']
+        if len(instance_ids) > self.MAX_INSTANCE_IDS:
+            raise ClientError({'Error': {'Code': 'ValidationException',
+                                         'Message': 'Too many instance IDs'}}, 'SendCommand')
+        with self.lock:
+            command = {
+                'CommandId': 'c-%08d' % len(self.commands),
+                'Comment': kwargs.get('Comment', ''),
+                'DocumentName': kwargs['DocumentName'],
+                'InstanceIds': instance_ids,
+                'Sent': self.clock.time()
+            }
+            self.commands.append(command)
+            self.targets += len(instance_ids)
+        return {'Command': self.describe(command)}
+
+    def describe(self, command):
+        """
+        Returns a command as ListCommands shows it at the current time
+        """
+        finished = self.clock.time() >= command['Sent'] + self.run_seconds
+        errors = len([i for i in command['InstanceIds'] if i in self.failing]) if finished else 0
+        status = 'InProgress'
+        if finished:
+            status = 'Failed' if errors else 'Success'
+        return {
+            'CommandId': command['CommandId'],
+            'Comment': command['Comment'],
+            'DocumentName': command['DocumentName'],
+            'Status': status,
+            'TargetCount': len(command['InstanceIds']),
+            'CompletedCount': len(command['InstanceIds']) if finished else 0,
+            'ErrorCount': errors
+        }
+
+    def list_commands(self, **kwargs):
+        """
+        Lists the commands sent, 50 per page
+        """
+        self.record('ListCommands')
+        start = int(kwargs.get('NextToken', 0))
+        end = start + self.LIST_PAGE_SIZE
+        page = {'Commands': [self.describe(c) for c in self.commands[start:end]]}
+        if end < len(self.commands):
+            page['NextToken'] = str(end)
+        return page
+
+    def list_command_invocations(self, **kwargs):
+        """
+        Lists the invocations of a command on each of its instances
+        """
+        self.record('ListCommandInvocations')
+        command = [c for c in self.commands if c['CommandId'] == kwargs['CommandId']][0]
+        finished = self.describe(command)['Status'] != 'InProgress'
+        invocations = []
+        for instance_id in command['InstanceIds']:
+            status = 'InProgress'
+            if finished:
+                status = 'Failed' if instance_id in self.failing else 'Success'
+            invocations.append({'CommandId': command['CommandId'], 'InstanceId': instance_id,
+                                'Status': status})
+        return {'CommandInvocations': invocations}
+
+class FakeLambda(FakeService):
+    """
+    InvokeAsync that queues the event for FakeAWS.run_helpers to run
+    in-process, as AWS runs it after the call returns
+    """
+    def __init__(self, clock, **kwargs):
+        super(FakeLambda, self).__init__(clock, **kwargs)
+        self.queue = []
+        self.payload_bytes = []
+
+    def invoke_async(self, **kwargs):
+        """
+        Queues an invocation
+        """
+        self.record('InvokeAsync')
+        self.payload_bytes.append(len(kwargs['InvokeArgs']))
+        with self.lock:
+            self.queue.append((kwargs['FunctionName'], json.loads(kwargs['InvokeArgs'])))
+        return {'Status': 202}
+
+class FakeS3(FakeService):
+    """
+    A single bucket of objects, each stored with its LastModified time
+    """
+    def __init__(self, clock, **kwargs):
+        super(FakeS3, self).__init__(clock, **kwargs)
+        self.objects = {}
+
+    def add_object(self, key, body):
+        """
+        Stores an object without counting a call, to set up a run
+        """
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.objects[key] = (body, datetime.datetime.utcfromtimestamp(self.clock.time()))
+
+    def put_object(self, **kwargs):
+        """
+        Stores an object
+        """
+        self.record('PutObject')
+        self.add_object(kwargs['Key'], kwargs.get('Body', b''))
+        return {}
+
+    def get_object(self, **kwargs):
+        """
+        Returns an object, or raises NoSuchKey
+        """
+        self.record('GetObject')
+        if kwargs['Key'] not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}},
+                              'GetObject')
+        body, modified = self.objects[kwargs['Key']]
+        return {'Body': io.BytesIO(body), 'LastModified': modified}
+
+    def head_object(self, **kwargs):
+        """
+        Returns the ETag of an object, or raises NoSuchKey
+        """
+        self.record('HeadObject')
+        if kwargs['Key'] not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}},
+                              'HeadObject')
+        body, modified = self.objects[kwargs['Key']]
+        return {'ETag': '"%s"' % hashlib.md5(body).hexdigest(), 'LastModified': modified}
+
+    def delete_object(self, **kwargs):
+        """
+        Removes an object
+        """
+        self.record('DeleteObject')
+        self.objects.pop(kwargs['Key'], None)
+        return {}
+
+    def delete_objects(self, **kwargs):
+        """
+        Removes several objects
+        """
+        self.record('DeleteObjects')
+        for obj in kwargs['Delete']['Objects']:
+            self.objects.pop(obj['Key'], None)
+        return {}
+
+    def list_objects_v2(self, **kwargs):
+        """
+        Lists the objects under Prefix, 1000 per page
+        """
+        self.record('ListObjectsV2')
+        keys = sorted(k for k in self.objects if k.startswith(kwargs.get('Prefix', '')))
+        start = int(kwargs.get('ContinuationToken', 0))
+        end = start + kwargs.get('MaxKeys', 1000)
+        page = {'Contents': [{'Key': k, 'LastModified': self.objects[k][1]}
+                             for k in keys[start:end]]}
+        if end < len(keys):
+            page['NextContinuationToken'] = str(end)
+        return page
+
+class FakeCodePipeline(FakeService):
+    """
+    Records the job results GARLC puts
+    """
+    def __init__(self, clock, bucket, **kwargs):
+        super(FakeCodePipeline, self).__init__(clock, **kwargs)
+        self.bucket = bucket
+        self.results = []
+
+    def put_job_success_result(self, **kwargs):
+        """
+        Records a success, or a continuation when it carries a token
+        """
+        self.record('PutJobSuccessResult')
+        self.results.append(('success', kwargs))
+        return {}
+
+    def put_job_failure_result(self, **kwargs):
+        """
+        Records a failure
+        """
+        self.record('PutJobFailureResult')
+        self.results.append(('failure', kwargs))
+        return {}
+
+    def get_pipeline(self, **kwargs):
+        """
+        Returns a pipeline storing its artifacts in the fake bucket
+        """
+        self.record('GetPipeline')
+        return {'pipeline': {'artifactStore': {'location': self.bucket}}}
+
+def synthetic_instances(count, roles=('webserver', 'appserver', 'dbserver'), first=0):
+    """
+    Returns count instances tagged for GARLC, with their Ansible roles
+    spread evenly across roles, numbered from first
+    """
+    return [{
+        'InstanceId': 'i-%08x' % (first + i),
+        'State': {'Name': 'running'},
+        'Tags': [
+            {'Key': 'has_ssm_agent', 'Value': 'true'},
+            {'Key': 'Ansible_Roles', 'Value': roles[i % len(roles)]}
+        ]
+    } for i in range(count)]
+
+class FakeAWS(object):
+    """
+    The fake services GARLC uses, sharing one SimulatedClock
+    """
+    def __init__(self, instance_count, bucket='garlc-bucket', ssm_tps=None, latency=0.0,
+                 run_seconds=60, failing=(), lambda_timeout=300, regions=()):
+        self.clock = SimulatedClock()
+        self.bucket = bucket
+        self.lambda_timeout = lambda_timeout
+        self.services = {
+            'ec2': FakeEC2(self.clock, synthetic_instances(instance_count), latency=latency),
+            'ssm': FakeSSM(self.clock, run_seconds=run_seconds, failing=failing,
+                           latency=latency, tps=ssm_tps),
+            'lambda': FakeLambda(self.clock, latency=latency),
+            's3': FakeS3(self.clock, latency=latency),
+            'codepipeline': FakeCodePipeline(self.clock, bucket, latency=latency)
+        }
+        self.regions = dict((region, {
+            'ec2': FakeEC2(self.clock, synthetic_instances(
+                instance_count, first=(index + 1) * instance_count), latency=latency),
+            'ssm': FakeSSM(self.clock, run_seconds=run_seconds, failing=failing,
+                           latency=latency, tps=ssm_tps)
+        }) for index, region in enumerate(regions))
+        self.invocations = {}
+
+    def __getitem__(self, service):
+        return self.services[service]
+
+    def all_services(self):
+        """
+        Returns every fake, in this region and the others
+        """
+        fakes = list(self.services.values())
+        for services in self.regions.values():
+            fakes.extend(services.values())
+        return fakes
+
+    def context(self):
+        """
+        Returns the context of a new Lambda invocation
+        """
+        return FakeContext(self.clock, self.lambda_timeout)
+
+    @contextlib.contextmanager
+    def installed(self):
+        """
+        Registers the fakes with the clients module and puts the handlers on
+        the simulated clock for the duration of the block
+        """
+        import clients
+        import throttling
+        modules = [__import__(name) for name in
+                   ('main', 'runcommand_helper', 'tracking', 'cache', 'metrics')]
+        saved = [(module, module.time) for module in modules]
+        saved_throttling = (throttling.sleep, throttling.now)
+        clients.reset()
+        throttling.BUCKETS.clear()
+        for service, fake in self.services.items():
+            clients.set_client(service, fake)
+        for region, services in self.regions.items():
+            for service, fake in services.items():
+                clients.set_client(service, fake, region)
+        for module in modules:
+            module.time = self.clock
+        throttling.sleep, throttling.now = self.clock.sleep, self.clock.time
+        try:
+            yield self
+        finally:
+            for module, original in saved:
+                module.time = original
+            throttling.sleep, throttling.now = saved_throttling
+            throttling.BUCKETS.clear()
+            clients.reset()
+
+    def invoke(self, name, handler, event):
+        """
+        Runs a handler in-process as a new Lambda invocation
+        """
+        self.invocations[name] = self.invocations.get(name, 0) + 1
+        return handler(event, self.context())
+
+    def run_helpers(self, handler):
+        """
+        Runs every queued InvokeAsync, including the ones they queue, and
+        returns how many ran
+        """
+        ran = 0
+        queue = self['lambda'].queue
+        while queue:
+            name, event = queue.pop(0)
+            self.invoke(name, handler, event)
+            ran += 1
+        return ran
+
+    def api_calls(self):
+        """
+        Returns the calls made to every operation in every region, keyed by
+        operation name
+        """
+        calls = {}
+        for service in self.all_services():
+            for operation, count in service.calls.items():
+                calls[operation] = calls.get(operation, 0) + count
+        return calls
+
+    def throttled_calls(self):
+        """
+        Returns the throttled calls to every operation
+        """
+        throttled = {}
+        for service in self.all_services():
+            for operation, count in service.throttled.items():
+                throttled[operation] = throttled.get(operation, 0) + count
+        return throttled
@@ -0,0 +1,153 @@
+"""
+Runs a whole continuous mode deployment, main -> runcommand_helper -> main
+again with each continuation token, against the in-process fake AWS in
+fake_aws.py and reports for each fleet size (in each region, with --regions
+more regions deployed to alongside this one):
+
+  calls     - AWS API calls made, and the busiest operations
+  throttled - calls the fake throttled (and the handlers retried)
+  lambdas   - Lambda invocations, including the ones InvokeAsync started
+  payload   - largest InvokeAsync payload, in KB
+  simulated - seconds the deployment took on the simulated clock
+  real      - seconds the run took on this machine
+
+Usage:
+
+    python benchmarks/load_test.py [--instances 10 1000 10000] [--ssm-tps 5]
+        [--latency 0.05] [--run-seconds 60] [--strategy all|rolling] [--applied 0]
+        [--regions 0]
+"""
+from __future__ import print_function
+import argparse
+import hashlib
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda')
+sys.path.insert(0, LAMBDA_DIR)
+
+import main as garlc_main  # pylint: disable=wrong-import-position
+import runcommand_helper  # pylint: disable=wrong-import-position
+from fake_aws import FakeAWS  # pylint: disable=wrong-import-position
+
+ARTIFACT_KEY = 'GARLC/MyApp/artifact.zip'
+ARTIFACT_BODY = b'artifact'
+
+def pipeline_event(bucket, user_parameters):
+    """
+    Returns the CodePipeline event that starts a deployment
+    """
+    return {'CodePipeline.job': {'id': 'load-test', 'data': {
+        'actionConfiguration': {'configuration': {
+            'UserParameters': json.dumps(user_parameters)
+        }},
+        'inputArtifacts': [{'location': {'s3Location': {
+            'bucketName': bucket, 'objectKey': ARTIFACT_KEY
+        }}}]
+    }}}
+
+def mark_applied(backend, percent):
+    """
+    Tags percent of the instances as having already applied the artifact
+    """
+    version = hashlib.md5(ARTIFACT_BODY).hexdigest()
+    for ec2 in [backend['ec2']] + [services['ec2'] for services in backend.regions.values()]:
+        instances = ec2.instances
+        for instance in instances[:int(len(instances) * percent / 100.0)]:
+            instance['Tags'].append({'Key': 'GARLC_Version', 'Value': version})
+
+def run_deployment(backend, user_parameters, pipeline_delay):
+    """
+    Drives one deployment to its CodePipeline result, re-invoking main with
+    each continuation token pipeline_delay simulated seconds later, and
+    returns the result.  Like CodePipeline, each continuation is a job with
+    an ID of its own.
+    """
+    backend['s3'].add_object(ARTIFACT_KEY, ARTIFACT_BODY)
+    event = pipeline_event(backend.bucket, user_parameters)
+    results = backend['codepipeline'].results
+    for continuation in itertools.count(1):
+        backend.invoke('garlc_main', garlc_main.handle, event)
+        backend.run_helpers(runcommand_helper.handle)
+        outcome, result = results[-1]
+        if outcome == 'failure' or 'continuationToken' not in result:
+            return outcome
+        backend.clock.sleep(pipeline_delay)
+        event['CodePipeline.job']['data']['continuationToken'] = result['continuationToken']
+        event['CodePipeline.job']['id'] = 'load-test-%d' % continuation
+
+def measure(instance_count, args):
+    """
+    Runs a deployment to instance_count synthetic instances and returns its
+    measurements
+    """
+    regions = ['fake-region-%d' % (i + 1) for i in range(args.regions)]
+    backend = FakeAWS(instance_count, ssm_tps=args.ssm_tps, latency=args.latency,
+                      run_seconds=args.run_seconds, regions=regions)
+    mark_applied(backend, args.applied)
+    user_parameters = {'DeploymentStrategy': args.strategy}
+    if regions:
+        user_parameters['Targets'] = [''] + regions
+    started_real = time.time()
+    with backend.installed():
+        started = backend.clock.time()
+        outcome = run_deployment(backend, user_parameters, args.pipeline_delay)
+        simulated = backend.clock.time() - started
+    calls = backend.api_calls()
+    return {
+        'instances': instance_count,
+        'outcome': outcome,
+        'calls': sum(calls.values()),
+        'by_operation': calls,
+        'throttled': sum(backend.throttled_calls().values()),
+        'lambdas': sum(backend.invocations.values()),
+        'payload': max(backend['lambda'].payload_bytes or [0]) / 1024.0,
+        'simulated': simulated,
+        'real': time.time() - started_real
+    }
+
+def main():
+    """
+    Load tests every fleet size and prints a row for each
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--instances', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--ssm-tps', type=float, default=5,
+                        help='SendCommand calls per second the fake SSM allows')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='simulated seconds each API call takes')
+    parser.add_argument('--run-seconds', type=float, default=60,
+                        help='simulated seconds each command takes on its instances')
+    parser.add_argument('--pipeline-delay', type=float, default=30,
+                        help='simulated seconds before CodePipeline re-invokes a job')
+    parser.add_argument('--strategy', choices=['all', 'rolling'], default='all')
+    parser.add_argument('--applied', type=float, default=0,
+                        help='percent of the instances already at the artifact\'s version')
+    parser.add_argument('--regions', type=int, default=0,
+                        help='other regions deployed to at the same time, each with its '
+                        'own fleet and API rate')
+    parser.add_argument('--json', action='store_true', help='print the raw measurements')
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    results = [measure(count, args) for count in args.instances]
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    print('%-10s %-8s %7s %9s %7s %10s %11s %8s  %s' % (
+        'instances', 'outcome', 'calls', 'throttled', 'lambdas', 'payload KB', 'simulated s',
+        'real s', 'busiest operations'))
+    for result in results:
+        busiest = sorted(result['by_operation'].items(), key=lambda item: -item[1])[:3]
+        print('%-10d %-8s %7d %9d %7d %10.1f %11.1f %8.2f  %s' % (
+            result['instances'], result['outcome'], result['calls'], result['throttled'],
+            result['lambdas'], result['payload'], result['simulated'], result['real'],
+            ', '.join('%s=%d' % item for item in busiest)))
+
+if __name__ == '__main__':
+    main()
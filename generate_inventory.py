@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Generates an Ansible Inventory file from the Ansible_Roles EC2 tag of the
+instance it runs on, with a host group per role.  The tag is read from the
+instance metadata, without any EC2 API call, which needs instance tags
+enabled there (the launch template in terraform/lc enables them).  On
+instances without them it falls back to a single DescribeTags call through
+the AWS CLI, cached for --max-age seconds.  The inventory is written to a
+temporary file and renamed into place, so Ansible never reads a partial one.
+
+    python generate_inventory.py [--output /tmp/inventory] [--tag Ansible_Roles]
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+METADATA_URL = 'http://169.254.169.254/latest/'
+METADATA_TIMEOUT = 2
+
+def metadata(path):
+    """
+    Returns a value from the instance metadata, or None when it has none
+    """
+    try:
+        return urlopen(METADATA_URL + path, timeout=METADATA_TIMEOUT).read().decode('utf-8')
+    except (IOError, OSError):
+        return None
+
+def metadata_roles(tag):
+    """
+    Returns the tag's value from the instance tags in the instance metadata,
+    '' when the instance has no such tag, or None when instance tags are not
+    available in the metadata
+    """
+    keys = metadata('meta-data/tags/instance')
+    if keys is None:
+        return None
+    if tag not in keys.split():
+        return ''
+    return metadata('meta-data/tags/instance/' + tag) or ''
+
+def instance_region():
+    """
+    Returns the region of the instance, preferring the one in the environment
+    """
+    region = os.environ.get('AWS_DEFAULT_REGION')
+    if region:
+        return region
+    return json.loads(metadata('dynamic/instance-identity/document'))['region']
+
+def describe_roles(tag, instance_id):
+    """
+    Returns the tag's value read with DescribeTags
+    """
+    value = subprocess.check_output([
+        'aws', 'ec2', 'describe-tags', '--region', instance_region(),
+        '--filters', 'Name=resource-id,Values=' + instance_id, 'Name=key,Values=' + tag,
+        '--query', 'Tags[0].Value', '--output', 'text'
+    ]).decode('utf-8').strip()
+    return '' if value == 'None' else value
+
+def cached_roles(tag, instance_id, cache_file, max_age):
+    """
+    Returns the tag's value read with DescribeTags, reusing the value cached
+    in cache_file for up to max_age seconds
+    """
+    try:
+        with open(cache_file) as cached:
+            entry = json.load(cached)
+        if entry['InstanceId'] == instance_id and entry['Tag'] == tag and \
+                time.time() - entry['Time'] < max_age:
+            return entry['Roles']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    roles = describe_roles(tag, instance_id)
+    write_atomically(cache_file, json.dumps({
+        'InstanceId': instance_id, 'Tag': tag, 'Roles': roles, 'Time': time.time()
+    }))
+    return roles
+
+def find_roles(tag, cache_file, max_age):
+    """
+    Returns the instance's roles, in order and once each
+    """
+    value = metadata_roles(tag)
+    if value is None:
+        value = cached_roles(tag, metadata('meta-data/instance-id'), cache_file, max_age)
+    roles = []
+    for role in value.replace(' ', ',').split(','):
+        role = role.strip()
+        if role and role not in roles:
+            roles.append(role)
+    return roles
+
+def render_inventory(roles):
+    """
+    Returns an inventory putting localhost in the host group of each role
+    """
+    return ''.join('[%s]\nlocalhost ansible_connection=local\n' % role for role in roles)
+
+def write_atomically(path, content):
+    """
+    Replaces the file at path with content in one rename
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    handle, temporary = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(handle, 'w') as output:
+            output.write(content)
+        os.chmod(temporary, 0o644)
+        os.rename(temporary, path)
+    except (IOError, OSError):
+        os.remove(temporary)
+        raise
+
+def main():
+    """
+    Writes the inventory of this instance
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--output', default='/tmp/inventory')
+    parser.add_argument('--tag', default='Ansible_Roles')
+    parser.add_argument('--cache-file', default='/var/cache/garlc/roles.json',
+                        help='where roles read with DescribeTags are cached')
+    parser.add_argument('--max-age', type=float, default=300,
+                        help='seconds roles read with DescribeTags are cached for')
+    args = parser.parse_args()
+    roles = find_roles(args.tag, args.cache_file, args.max_age)
+    write_atomically(args.output, render_inventory(roles))
+    print('Wrote %s with roles: %s' % (args.output, ', '.join(roles) or 'none'))
+
+if __name__ == '__main__':
+    sys.exit(main())
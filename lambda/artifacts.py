@@ -0,0 +1,98 @@
+"""
+Keeps track of the newest GARLC artifact.  The continuous mode records the
+artifact of every deployment it hands off in a small pointer object in the
+pipeline bucket, so bootstrap can resolve the latest artifact with a single
+GET instead of listing the bucket.  The pointer also carries the artifact's
+version and the commands that deploy it, worked out once per deployment, so
+bootstrap goes from reading it straight to SendCommand.  The version of an
+artifact, which the instances record once they have applied it, is its ETag.
+"""
+import json
+import logging
+import os
+import re
+from botocore.exceptions import ClientError
+from clients import get_client
+from throttling import call
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Key of the pointer object, kept outside the prefix artifacts are stored under
+LATEST_ARTIFACT_KEY = os.environ.get('GARLC_LATEST_ARTIFACT_KEY', 'garlc-latest-artifact.json')
+
+def split_s3_url(url):
+    """
+    Returns the bucket and key of an s3://bucket/key URL
+    """
+    if not url.startswith('s3://') or '/' not in url[5:]:
+        raise ValueError("Not an S3 URL: %s" % url)
+    bucket, key = url[5:].split('/', 1)
+    return bucket, key
+
+def record_latest_artifact(artifact, job_id=None, version=None, commands=None):
+    """
+    Points the pipeline bucket's latest artifact pointer at artifact (an
+    s3:// URL in that bucket), along with its version and the commands that
+    deploy it when they are known
+    """
+    pointer = {'Artifact': artifact, 'JobId': job_id}
+    if version:
+        pointer['Version'] = version
+    if commands:
+        pointer['Commands'] = commands
+    try:
+        bucket, _ = split_s3_url(artifact)
+        aws_s3 = get_client('s3')
+        call(
+            's3', aws_s3.put_object,
+            Bucket=bucket,
+            Key=LATEST_ARTIFACT_KEY,
+            Body=json.dumps(pointer),
+            ContentType='application/json'
+        )
+        return True
+    except (ClientError, ValueError) as err:
+        LOGGER.error("Failed to record the latest artifact!\n%s", err)
+        return False
+
+def read_latest_artifact(bucket):
+    """
+    Returns the artifact the bucket's latest artifact pointer refers to, or
+    None when there is no usable pointer
+    """
+    pointer = read_latest_pointer(bucket)
+    return pointer['Artifact'] if pointer else None
+
+def read_latest_pointer(bucket):
+    """
+    Returns the bucket's latest artifact pointer, holding the Artifact and,
+    when the deployment recorded them, its Version and Commands, or None
+    when there is no usable pointer
+    """
+    try:
+        aws_s3 = get_client('s3')
+        stored = call('s3', aws_s3.get_object, Bucket=bucket, Key=LATEST_ARTIFACT_KEY)
+        pointer = json.loads(stored['Body'].read().decode('utf-8'))
+        split_s3_url(pointer['Artifact'])
+        return pointer
+    except ClientError as err:
+        LOGGER.info("No latest artifact pointer in %s: %s", bucket, err)
+    except (KeyError, TypeError, ValueError, AttributeError) as err:
+        LOGGER.error("Invalid latest artifact pointer in %s!\n%s", bucket, err)
+    return None
+
+def artifact_version(artifact):
+    """
+    Returns the version instances record once they have applied artifact:
+    its ETag, with the quotes the deploy commands strip removed.  Returns
+    None when the artifact cannot be read.
+    """
+    try:
+        bucket, key = split_s3_url(artifact)
+        aws_s3 = get_client('s3')
+        head = call('s3', aws_s3.head_object, Bucket=bucket, Key=key)
+        return re.sub(r'[^A-Za-z0-9-]', '', head['ETag']) or None
+    except (ClientError, KeyError, ValueError) as err:
+        LOGGER.error("Failed to read the version of %s!\n%s", artifact, err)
+        return None
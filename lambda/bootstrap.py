@@ -2,36 +2,81 @@
 This AWS Lambda function is intended to be invoked via a Cloudwatch Event for a
 new intance launch. We get the instance ID from the event message, find our pipeline
 bucket, the latest artifact in the bucket, tell the new instance to grab the
-artifact, and finally execute it locally via runcommand.
+artifact, and finally execute it locally via runcommand.  In batching mode the
+events are queued in SQS and delivered in batches, so the instances launched
+together are bootstrapped with a handful of API calls.  The main function
+records the commands that deploy the newest artifact along with it, so with
+the bucket given in GARLC_PIPELINE_BUCKET and GARLC_VALIDATE_INSTANCES set to
+false a warm container goes from the event straight to SendCommand.
 chavisb@amazon.com
 v1.0.0
 """
-import datetime
+import json
 import logging
-import boto3
+import os
 from botocore.exceptions import ClientError
+import metrics
+from artifacts import artifact_version
+from artifacts import read_latest_pointer
+from cache import TTLCache
+from clients import get_client
+from deploy_commands import DEFAULT_COMMAND_OPTIONS
+from deploy_commands import ssm_commands
+from documents import send_command_args
+from parallel import run_lookups
+from throttling import call
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+# SendCommand accepts at most this many InstanceIds per call
+SSM_MAX_INSTANCE_IDS = 50
+
+# EC2 accepts at most this many values per filter
+MAX_FILTER_VALUES = 200
+
+GARLC_INSTANCE_FILTERS = [
+    {'Name': 'tag:has_ssm_agent', 'Values': ['true', 'True']},
+    {'Name': 'instance-state-name', 'Values': ['pending', 'running']}
+]
+
 # assume we're always using a pipeline name GARLC
 PIPELINE_NAME = 'GARLC'
+# CodePipeline stores artifacts under the pipeline name (truncated to 20 characters)
+ARTIFACT_PREFIX = os.environ.get('GARLC_ARTIFACT_PREFIX', PIPELINE_NAME[:20] + '/')
+
+# The pipeline bucket, or '' to look it up from the pipeline
+PIPELINE_BUCKET = os.environ.get('GARLC_PIPELINE_BUCKET', '')
+
+# Set to false to send the deploy commands to every instance launched without
+# first checking it is a GARLC instance.  Instances without the SSM agent then
+# fail SendCommand, and restarted instances are deployed to again.
+VALIDATE_INSTANCES = os.environ.get('GARLC_VALIDATE_INSTANCES', 'true').lower() == 'true'
 
-def is_a_garlc_instance(instance_id):
+# Tag instances record the version of the artifact they have applied in.
+# Instances restarted at the newest version are not deployed to again
+# unless GARLC_FORCE is 1.
+VERSION_TAG = DEFAULT_COMMAND_OPTIONS.version_tag
+FORCE = os.environ.get('GARLC_FORCE', '0') == '1'
+
+# Warm containers share these lookups across the launch events of a scale out.
+# The artifact is kept briefly so new instances soon pick up a new deployment.
+BUCKET_CACHE = TTLCache('bucket', os.environ.get('GARLC_BUCKET_CACHE_TTL', '300'))
+ARTIFACT_CACHE = TTLCache('artifact', os.environ.get('GARLC_ARTIFACT_CACHE_TTL', '30'))
+VERSION_CACHE = TTLCache('version', os.environ.get('GARLC_VERSION_CACHE_TTL', '300'))
+
+def is_a_garlc_instance(instance_id, versions=None):
     """
-    Determine if an instance is GARLC enabled
+    Determine if an instance is GARLC enabled, storing the version it has
+    applied in versions when given (see find_garlc_instances)
     """
-    filters = [
-        {'Name': 'tag:has_ssm_agent', 'Values': ['true', 'True']}
-    ]
     try:
-        ec2 = boto3.client('ec2')
-        instance = ec2.describe_instances(InstanceIds=[str(instance_id)], Filters=filters)
+        garlc_instance_ids = find_garlc_instances([str(instance_id)], versions)
     except ClientError as err:
         LOGGER.error(str(err))
         return False
 
-    if instance:
+    if garlc_instance_ids:
         return True
     else:
         LOGGER.error(str(instance_id) + " is not a GARLC instance!")
@@ -39,76 +84,123 @@ def is_a_garlc_instance(instance_id):
 
 def find_bucket():
     """
-    find S3 bucket that codedeploy uses and return bucket name
+    find S3 bucket that codedeploy uses and return bucket name, cached for
+    BUCKET_CACHE.ttl seconds, or GARLC_PIPELINE_BUCKET when it is set
+    """
+    if PIPELINE_BUCKET:
+        return PIPELINE_BUCKET
+    return BUCKET_CACHE.get(PIPELINE_NAME, lookup_bucket)
+
+def lookup_bucket():
+    """
+    look up the artifact store of the pipeline with CodePipeline
     """
     try:
-        codepipeline = boto3.client('codepipeline')
-        pipeline = codepipeline.get_pipeline(name=PIPELINE_NAME)
+        codepipeline = get_client('codepipeline')
+        pipeline = call('codepipeline', codepipeline.get_pipeline, name=PIPELINE_NAME)
         return str(pipeline['pipeline']['artifactStore']['location'])
     except (ClientError, KeyError, TypeError) as err:
         LOGGER.error(err)
         return False
 
+def scan_newest_artifact(bucket):
+    """
+    find the newest artifact under ARTIFACT_PREFIX by listing every page of
+    the bucket, keeping only the newest object seen so far
+    """
+    aws_s3 = get_client('s3')
+    kwargs = {'Bucket': bucket, 'Prefix': ARTIFACT_PREFIX}
+    newest = None
+    while True:
+        page = call('s3', aws_s3.list_objects_v2, **kwargs)
+        for artifact in page.get('Contents', []):
+            if newest is None or artifact['LastModified'] > newest['LastModified']:
+                newest = artifact
+        if not page.get('IsTruncated'):
+            break
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
+    if newest is None:
+        raise KeyError('No artifacts found in s3://' + bucket + '/' + ARTIFACT_PREFIX)
+    return 's3://' + bucket + '/' + str(newest['Key'])
+
 def find_newest_artifact(bucket):
     """
-    find and return the newest artifact in codepipeline bucket
+    find and return the newest artifact in codepipeline bucket, cached for
+    ARTIFACT_CACHE.ttl seconds
     """
-    #TODO
-    #implement boto collections to support more than 1000 artifacts per bucket
+    deployment = find_latest_deployment(bucket)
+    return deployment['Artifact'] if deployment else False
+
+def find_latest_deployment(bucket):
+    """
+    find the newest artifact in codepipeline bucket, along with its Version
+    and the Commands that deploy it when the main function recorded them,
+    cached for ARTIFACT_CACHE.ttl seconds
+    """
+    return ARTIFACT_CACHE.get(bucket, lambda: lookup_latest_deployment(bucket))
+
+def lookup_latest_deployment(bucket):
+    """
+    look up the newest artifact in the bucket, from the latest artifact
+    pointer if there is one
+    """
+    pointer = read_latest_pointer(bucket)
+    if pointer:
+        return pointer
     try:
-        aws_s3 = boto3.client('s3')
-        objects = aws_s3.list_objects(Bucket=bucket)
-        artifact_list = [artifact for artifact in objects['Contents']]
-        artifact_list.sort(key=lambda artifact: artifact['LastModified'], reverse=True)
-        return 's3://' + bucket + '/' + str(artifact_list[0]['Key'])
+        return {'Artifact': scan_newest_artifact(bucket)}
     except (ClientError, KeyError) as err:
         LOGGER.error(err)
         return False
 
-def ssm_commands(artifact):
+def find_deployment():
+    """
+    find the pipeline bucket and its latest deployment, False for either
+    that could not be found
+    """
+    with metrics.span('FindBucket'):
+        bucket = find_bucket()
+    if not bucket:
+        return bucket, False
+    with metrics.span('FindArtifact'):
+        return bucket, find_latest_deployment(bucket)
+
+def deployment_commands(deployment):
     """
-    Builds commands to be sent to SSM (Run Command)
+    Returns the commands that deploy the latest deployment's artifact, as
+    the main function built them when it recorded them
     """
-    utc_datetime = datetime.datetime.utcnow()
-    timestamp = utc_datetime.strftime("%Y%m%d%H%M%S")
-    return [
-        'export AWS_DEFAULT_REGION=`curl -s http://169.254.169.254/' \
-        "latest/dynamic/instance-identity/document | grep region | awk -F\\\" '{print $4}'`",
-        'aws configure set s3.signature_version s3v4',
-        'aws s3 cp {0} /tmp/{1}.zip --quiet'.format(artifact, timestamp),
-        'unzip -qq /tmp/{0}.zip -d /tmp/{1}'.format(timestamp, timestamp),
-        'bash /tmp/{0}/generate_inventory_file.sh'.format(timestamp),
-        'ansible-playbook -i "/tmp/inventory" /tmp/{0}/ansible/playbook.yml'.format(timestamp)
-    ]
+    return deployment.get('Commands') or ssm_commands(deployment['Artifact'])
 
-def send_run_command(instance_id, commands):
+def send_run_command(instance_ids, commands):
     """
-    Sends the Run Command API Call
+    Sends the Run Command API Call for up to SSM_MAX_INSTANCE_IDS instances,
+    retrying with backoff while it is throttled
     """
     try:
-        ssm = boto3.client('ssm')
+        ssm = get_client('ssm')
     except ClientError as err:
         LOGGER.error("Run Command Failed!\n%s", str(err))
         return False
 
     try:
-        ssm.send_command(
-            InstanceIds=[instance_id],
-            DocumentName='AWS-RunShellScript',
-            TimeoutSeconds=900,
-            Parameters={
-                'commands': commands,
-                'executionTimeout': ['600'] # Seconds all commands have to complete in
-            }
+        call(
+            'ssm', ssm.send_command,
+            InstanceIds=instance_ids,
+            **send_command_args(commands)
         )
         return True
     except ClientError as err:
-        if 'ThrottlingException' in str(err):
-            LOGGER.info("RunCommand throttled, automatically retrying...")
-            send_run_command(instance_id, commands)
-        else:
-            LOGGER.error("Run Command Failed!\n%s", str(err))
-            return False
+        LOGGER.error("Run Command Failed!\n%s", str(err))
+        return False
+
+def invalidate_caches():
+    """
+    Forgets the cached pipeline bucket, newest artifact and its version
+    """
+    BUCKET_CACHE.invalidate()
+    ARTIFACT_CACHE.invalidate()
+    VERSION_CACHE.invalidate()
 
 def log_event(event):
     """Logs event information for debugging"""
@@ -124,6 +216,80 @@ def get_instance_id(event):
         LOGGER.error(err)
         return False
 
+def get_batch_instance_ids(records):
+    """
+    Grab the instance IDs out of a batch of queued cloudwatch events, once
+    each and in the order they were launched
+    """
+    instance_ids = []
+    for record in records:
+        try:
+            instance_id = get_instance_id(json.loads(record['body']))
+        except (TypeError, KeyError, ValueError) as err:
+            LOGGER.error("Could not parse queued event!\n%s", err)
+            continue
+        if instance_id and instance_id not in instance_ids:
+            instance_ids.append(instance_id)
+    return instance_ids
+
+def find_garlc_instances(instance_ids, versions=None):
+    """
+    Returns the subset of instance_ids that are GARLC enabled, in the order
+    given.  EC2 does the filtering: instances are matched by the instance-id
+    filter rather than InstanceIds, so an ID EC2 does not know yet is left
+    out instead of failing the whole call.  When versions is a dict the
+    version each instance has applied, if any, is stored in it by ID.
+    """
+    found = set()
+    ec2 = get_client('ec2')
+    for i in range(0, len(instance_ids), MAX_FILTER_VALUES):
+        kwargs = {
+            'Filters': GARLC_INSTANCE_FILTERS + [
+                {'Name': 'instance-id', 'Values': instance_ids[i:i + MAX_FILTER_VALUES]}
+            ]
+        }
+        while True:
+            response = call('ec2', ec2.describe_instances, **kwargs)
+            for reservation in response.get('Reservations', []):
+                for instance in reservation.get('Instances', []):
+                    found.add(instance['InstanceId'])
+                    if versions is not None:
+                        record_version(instance, versions)
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+    return [instance_id for instance_id in instance_ids if instance_id in found]
+
+def record_version(instance, versions):
+    """
+    Stores the version instance has applied in versions
+    """
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == VERSION_TAG and tag['Value']:
+            versions[instance['InstanceId']] = tag['Value']
+
+def find_artifact_version(artifact):
+    """
+    Returns the version of artifact, cached for VERSION_CACHE.ttl seconds
+    """
+    return VERSION_CACHE.get(artifact, lambda: artifact_version(artifact))
+
+def pending_instance_ids(instance_ids, versions, artifact, version=None):
+    """
+    Returns the instance_ids that have not applied artifact yet.  The
+    artifact's version, unless given, is only looked up when one of them has
+    applied a version, which new instances have not.
+    """
+    if FORCE or not artifact or not any(versions.get(i) for i in instance_ids):
+        return instance_ids
+    version = version or find_artifact_version(artifact)
+    pending = [i for i in instance_ids if versions.get(i) != version]
+    if len(pending) < len(instance_ids):
+        metrics.count('Skipped', len(instance_ids) - len(pending))
+        LOGGER.info('%d instances have already applied %s', len(instance_ids) - len(pending),
+                    artifact)
+    return pending
+
 def resources_exist(instance_id, bucket):
     """
     Validates instance_id and bucket have values
@@ -137,16 +303,102 @@ def resources_exist(instance_id, bucket):
     else: return True
 
 
+def handle_batch(records):
+    """
+    Bootstraps every GARLC instance launched in a batch of queued events with
+    one DescribeInstances and one SendCommand per SSM_MAX_INSTANCE_IDS
+    instances.  Returns False when none of them is a GARLC instance, and
+    raises when they could not all be sent their commands, so SQS delivers
+    the batch again rather than deleting it.
+    """
+    instance_ids = get_batch_instance_ids(records)
+    if not instance_ids:
+        LOGGER.error('Unable to retrieve Instance ID!')
+        return False
+
+    metrics.count('Instances', len(instance_ids))
+    # The instances are checked while the bucket and artifact are found
+    versions = {}
+    lookups = [('FindDeployment', find_deployment, (False, False))]
+    if VALIDATE_INSTANCES:
+        lookups.append(('Validation',
+                        lambda: find_garlc_instances(instance_ids, versions), []))
+    try:
+        results = run_lookups(lookups)
+    except ClientError as err:
+        LOGGER.error(str(err))
+        raise
+    bucket, deployment = results[0]
+    garlc_instance_ids = results[1] if VALIDATE_INSTANCES else instance_ids
+    if not garlc_instance_ids:
+        LOGGER.error("None of %s are GARLC instances!", instance_ids)
+        return False
+    if not resources_exist(garlc_instance_ids, bucket) or not deployment:
+        raise RuntimeError('No deployment found for %d launched instances' %
+                           len(garlc_instance_ids))
+
+    pending_ids = pending_instance_ids(garlc_instance_ids, versions, deployment['Artifact'],
+                                       deployment.get('Version'))
+    if not pending_ids:
+        return True
+    commands = deployment_commands(deployment)
+    with metrics.span('Send'):
+        results = [
+            send_run_command(pending_ids[i:i + SSM_MAX_INSTANCE_IDS], commands)
+            for i in range(0, len(pending_ids), SSM_MAX_INSTANCE_IDS)
+        ]
+    LOGGER.info('%d of %d launched instances sent to Run Command in %d calls',
+                len(pending_ids), len(instance_ids), len(results))
+    if not all(results):
+        # SQS delivers the whole batch again.  When instances are checked,
+        # those that have applied the artifact by then are skipped.
+        raise RuntimeError('Failed to send %d of %d calls to Run Command' % (
+            len(results) - len([sent for sent in results if sent]), len(results)))
+    return True
+
+def prewarm():
+    """
+    Loads the SSM client, the pipeline bucket and the latest deployment into
+    this container ahead of the launches of a scale out
+    """
+    get_client('ssm')
+    bucket = find_bucket()
+    return bool(bucket and find_latest_deployment(bucket))
+
+@metrics.instrument('bootstrap')
 def handle(event, _context):
     """ Lambda Handler """
     log_event(event)
+    if isinstance(event, dict) and 'Records' in event:
+        return handle_batch(event['Records'])
+    if isinstance(event, dict) and event.get('Prewarm'):
+        return prewarm()
+
     instance_id = get_instance_id(event)
-    bucket = find_bucket()
+    # No need to look up the bucket for an instance we will not bootstrap
+    if not instance_id:
+        LOGGER.error('Unable to retrieve Instance ID!')
+        return False
+    # The instance is checked while the bucket and artifact are found
+    versions = {}
+    lookups = [('FindDeployment', find_deployment, (False, False))]
+    if VALIDATE_INSTANCES:
+        lookups.append(('Validation', lambda: is_a_garlc_instance(instance_id, versions), False))
+    results = run_lookups(lookups)
+    if VALIDATE_INSTANCES and not results[1]:
+        return False
 
-    if resources_exist(instance_id, bucket) and is_a_garlc_instance(instance_id):
-        artifact = find_newest_artifact(bucket)
-        commands = ssm_commands(artifact)
-        send_run_command(instance_id, commands)
+    bucket, deployment = results[0]
+    if resources_exist(instance_id, bucket):
+        if not deployment:
+            return False
+        pending = pending_instance_ids([instance_id], versions, deployment['Artifact'],
+                                       deployment.get('Version'))
+        if not pending:
+            return True
+        commands = deployment_commands(deployment)
+        with metrics.span('Send'):
+            send_run_command([instance_id], commands)
         LOGGER.info('===SUCCESS===')
         return True
     else:
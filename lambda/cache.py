@@ -0,0 +1,76 @@
+"""
+In-process caches that live as long as the Lambda container, so bursts of
+warm invocations share the results of identical lookups.  Entries expire
+after a TTL and can be invalidated explicitly.
+"""
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+CACHES = []
+
+class TTLCache(object):
+    """
+    Thread safe cache of values that expire ttl seconds after being loaded.
+    Hits and misses are counted and logged.
+    """
+    def __init__(self, name, ttl):
+        self.name = name
+        self.ttl = float(ttl)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        CACHES.append(self)
+
+    def get(self, key, loader):
+        """
+        Returns the cached value for key, calling loader() to load it when it
+        is missing or expired.  Falsy values are returned but not cached, so
+        failed lookups are retried on the next call.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                self.hits += 1
+                LOGGER.info("%s cache hit for %s (%d hits, %d misses)",
+                            self.name, key, self.hits, self.misses)
+                return entry[0]
+            self.misses += 1
+            LOGGER.info("%s cache miss for %s (%d hits, %d misses)",
+                        self.name, key, self.hits, self.misses)
+
+        value = loader()
+        if value and self.ttl > 0:
+            with self.lock:
+                self.entries[key] = (value, time.time() + self.ttl)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Forgets the value for key, or every value if key is None
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def reset(self):
+        """
+        Forgets every value and zeroes the counters
+        """
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+def reset_all():
+    """
+    Resets every cache in this container
+    """
+    for cache in CACHES:
+        cache.reset()
@@ -0,0 +1,99 @@
+"""
+Registry of the boto3 clients used by GARLC.  Each client is created the
+first time it is asked for and then reused by every call site for the life of
+the Lambda container, so warm invocations skip endpoint resolution, credential
+lookup and new TLS connections.  boto3 itself is only imported when the first
+client is created, so invocations that exit early never pay for it.  Clients
+for another account are created from the credentials of a role assumed there,
+which are renewed well before they expire.  Tests can inject stubs with
+set_client and start from scratch with reset.
+"""
+import os
+import threading
+import time
+
+# Connections each client keeps open, enough for the helper's dispatch workers
+MAX_POOL_CONNECTIONS = int(os.environ.get('GARLC_MAX_POOL_CONNECTIONS', '10'))
+# Enables TCP keep-alive on client sockets (needs botocore 1.27 or later)
+TCP_KEEPALIVE = os.environ.get('GARLC_TCP_KEEPALIVE', 'false').lower() == 'true'
+
+# Seconds the credentials of an assumed role last, and the seconds before
+# they expire from which they are renewed (longer than any invocation)
+ROLE_SESSION_SECONDS = int(os.environ.get('GARLC_ROLE_SESSION_SECONDS', '3600'))
+ROLE_RENEW_SECONDS = int(os.environ.get('GARLC_ROLE_RENEW_SECONDS', '900'))
+
+CLIENTS = {}
+SESSIONS = {}
+LOCK = threading.Lock()
+
+def client_config():
+    """
+    Returns the botocore configuration shared by every client
+    """
+    from botocore.config import Config
+    options = {'max_pool_connections': MAX_POOL_CONNECTIONS}
+    if TCP_KEEPALIVE:
+        options['tcp_keepalive'] = True
+    return Config(**options)
+
+def role_session(role_arn):
+    """
+    Returns a boto3 session holding credentials for role_arn, assuming it
+    again (and forgetting the clients made with the old credentials) when
+    they are about to expire.  The caller must hold LOCK.
+    """
+    session, expires = SESSIONS.get(role_arn, (None, 0))
+    if time.time() < expires - ROLE_RENEW_SECONDS:
+        return session
+    import boto3
+    # Imported here as throttling itself needs nothing from this module
+    from throttling import call
+    if ('sts', None, None) not in CLIENTS:
+        CLIENTS[('sts', None, None)] = boto3.client('sts', config=client_config())
+    sts = CLIENTS[('sts', None, None)]
+    credentials = call('sts', sts.assume_role, RoleArn=role_arn, RoleSessionName='garlc',
+                       DurationSeconds=ROLE_SESSION_SECONDS)['Credentials']
+    session = boto3.session.Session(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken']
+    )
+    for key in [key for key in CLIENTS if key[2] == role_arn]:
+        del CLIENTS[key]
+    SESSIONS[role_arn] = (session, time.time() + ROLE_SESSION_SECONDS)
+    return session
+
+def get_client(service, region=None, role_arn=None):
+    """
+    Returns the client for service in region (the default region if None),
+    with the credentials of role_arn when given, creating it on first use
+    """
+    key = (service, region, role_arn)
+    with LOCK:
+        if role_arn is not None:
+            session = role_session(role_arn)
+            if key not in CLIENTS:
+                CLIENTS[key] = session.client(service, region_name=region,
+                                              config=client_config())
+        elif key not in CLIENTS:
+            import boto3
+            CLIENTS[key] = boto3.client(service, region_name=region, config=client_config())
+        return CLIENTS[key]
+
+def set_client(service, client, region=None, role_arn=None):
+    """
+    Registers client as the one to return for service in region (and
+    role_arn)
+    """
+    with LOCK:
+        CLIENTS[(service, region, role_arn)] = client
+        if role_arn is not None:
+            SESSIONS[role_arn] = (None, float('inf'))
+
+def reset():
+    """
+    Forgets every client so the next call creates new ones
+    """
+    with LOCK:
+        CLIENTS.clear()
+        SESSIONS.clear()
@@ -0,0 +1,28 @@
+"""
+Shared fixtures for the GARLC unit tests
+"""
+import pytest
+import cache
+import clients
+import metrics
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    """
+    Gives every test its own boto3 clients so patched constructors are used
+    """
+    clients.reset()
+
+@pytest.fixture(autouse=True)
+def reset_caches():
+    """
+    Gives every test empty caches
+    """
+    cache.reset_all()
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    """
+    Gives every test empty metrics
+    """
+    metrics.reset()
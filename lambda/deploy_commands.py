@@ -0,0 +1,161 @@
+"""
+The commands that deploy an artifact on an instance, shared by the main
+function and bootstrap so both always run the same deployment.  What the
+commands do is described by CommandOptions, read from the environment once
+per container, so the on-instance cache, region lookup and Ansible run are
+changed in one place for every path that deploys.
+"""
+import collections
+import os
+from artifacts import split_s3_url
+from documents import DELIVERY_TIMEOUT
+from documents import EXECUTION_TIMEOUT
+from documents import deploy_document
+from documents import shell_document
+
+# How the deploy commands run on the instances
+#   cache_dir      - directory holding the deployed artifacts, one per ETag
+#   cache_versions - artifacts kept there, the least recently deployed removed first
+#   region         - 'lambda' for the region of this function (the one SendCommand
+#                    reaches), 'instance' to look it up on the instance, or a region
+#   inventory      - Ansible inventory written by generate_inventory_file.sh
+#   roles_tag      - tag holding the instance's comma separated Ansible roles
+#   playbook       - playbook to run, relative to the artifact
+#   ansible_args   - extra ansible-playbook arguments (e.g. "--forks 1")
+#   version_tag    - tag the instance records the version it has applied in,
+#                    '' not to record it
+#   partial        - True to only run the roles that changed since the version
+#                    the instance last applied, when it still has that version
+#   execution_timeout - seconds the commands have to complete in on an instance
+#   delivery_timeout  - seconds an instance has to start the commands before
+#                       Run Command gives up on it
+CommandOptions = collections.namedtuple('CommandOptions', [
+    'cache_dir', 'cache_versions', 'region', 'inventory', 'roles_tag', 'playbook',
+    'ansible_args', 'version_tag', 'partial', 'execution_timeout', 'delivery_timeout'
+])
+
+# Region lookup on the instance, unless its environment already has one
+INSTANCE_REGION = '${AWS_DEFAULT_REGION:-`curl -s http://169.254.169.254/' \
+    "latest/dynamic/instance-identity/document | grep region | awk -F\\\" '{print $4}'`}"
+
+# The instance's own ID, looked up on the instance
+INSTANCE_ID = '`curl -s http://169.254.169.254/latest/meta-data/instance-id`'
+
+def command_options(**overrides):
+    """
+    Returns the CommandOptions set by the environment, with overrides applied
+    """
+    options = CommandOptions(
+        cache_dir=os.environ.get('GARLC_INSTANCE_CACHE_DIR', '/var/cache/garlc'),
+        cache_versions=int(os.environ.get('GARLC_INSTANCE_CACHE_VERSIONS', '5')),
+        region=os.environ.get('GARLC_INSTANCE_REGION', 'lambda'),
+        inventory='/tmp/inventory',
+        roles_tag='Ansible_Roles',
+        playbook='ansible/playbook.yml',
+        ansible_args=os.environ.get('GARLC_ANSIBLE_ARGS', ''),
+        version_tag=os.environ.get('GARLC_VERSION_TAG', 'GARLC_Version'),
+        partial=False,
+        execution_timeout=int(os.environ.get('GARLC_EXECUTION_TIMEOUT', EXECUTION_TIMEOUT)),
+        delivery_timeout=int(os.environ.get('GARLC_DELIVERY_TIMEOUT', DELIVERY_TIMEOUT))
+    )
+    return options._replace(**overrides)
+
+DEFAULT_COMMAND_OPTIONS = command_options()
+
+def instance_region(options):
+    """
+    Returns the region the commands export, as a literal when it is known
+    here and otherwise as the shell that looks it up on the instance
+    """
+    region = options.region
+    if region == 'lambda':
+        region = os.environ.get('AWS_REGION', '')
+    if not region or region == 'instance':
+        return INSTANCE_REGION
+    return region
+
+def scope_commands(options):
+    """
+    Returns the commands setting tags to the roles that changed since the
+    version the instance last applied, or to '' for a full run when the
+    Ansible files outside the roles changed or that version is gone
+    """
+    previous = '{0}/$applied'.format(options.cache_dir)
+    return [
+        'applied=`cat {0}/applied 2>/dev/null`'.format(options.cache_dir),
+        'tags=; if [ -n "$applied" ] && [ "$applied" != "$etag" ] && [ -d {0}/ansible ] && ' \
+        'cmp -s {0}/generate_inventory.py $artifact/generate_inventory.py && ' \
+        'diff -rq --exclude=roles {0}/ansible $artifact/ansible >/dev/null 2>&1; then ' \
+        'tags=`(ls {0}/ansible/roles; ls $artifact/ansible/roles) 2>/dev/null | sort -u | ' \
+        'while read role; do diff -rq {0}/ansible/roles/$role $artifact/ansible/roles/$role ' \
+        '>/dev/null 2>&1 || echo $role; done | paste -sd, -`; fi'.format(previous)
+    ]
+
+def document_parameters(options):
+    """
+    Returns the deploy document's parameters for options, with the region
+    left to the instance to look up when it is not known here
+    """
+    region = instance_region(options)
+    return {
+        'cacheDir': options.cache_dir,
+        'cacheVersions': str(options.cache_versions),
+        'region': '' if region == INSTANCE_REGION else region,
+        'rolesTag': options.roles_tag,
+        'ansibleArgs': options.ansible_args,
+        'versionTag': options.version_tag,
+        'partialDeploy': 'true' if options.partial else 'false',
+        'executionTimeout': str(options.execution_timeout)
+    }
+
+def ssm_commands(artifact, options=None):
+    """
+    Builds commands to be sent to SSM (Run Command), or the deploy document
+    to run when one is configured.  Commands with timeouts other than the
+    defaults are returned as the AWS-RunShellScript arguments that run them.
+    """
+    options = options or DEFAULT_COMMAND_OPTIONS
+    document = deploy_document(artifact, document_parameters(options),
+                               options.delivery_timeout)
+    if document is not None:
+        return document
+    bucket, key = split_s3_url(artifact)
+    ansible_args = ' ' + options.ansible_args if options.ansible_args else ''
+    if options.partial:
+        ansible_args += '${tags:+ --tags $tags}'
+    commands = [
+        'export AWS_DEFAULT_REGION=' + instance_region(options),
+        'aws configure set s3.signature_version s3v4',
+        # Artifacts are cached by ETag, so a bundle already on the instance is
+        # reused and every deployment of a new one gets its own directory
+        "etag=`aws s3api head-object --bucket {0} --key '{1}' --query ETag --output text" \
+        " | tr -dc '[:alnum:]-'`".format(bucket, key),
+        '[ -n "$etag" ] || exit 1',
+        'artifact={0}/$etag'.format(options.cache_dir),
+        # Downloaded and extracted aside and moved into place, so a cached
+        # artifact is always complete
+        'if [ ! -d $artifact ]; then incoming={0}/.incoming.$$ && mkdir -p $incoming && ' \
+        "aws s3 cp '{1}' $incoming.zip --quiet && unzip -qq $incoming.zip -d $incoming && " \
+        'mv -T $incoming $artifact; rm -rf $incoming $incoming.zip; fi'.format(
+            options.cache_dir, artifact),
+        '[ -d $artifact ] || exit 1'
+    ] + (scope_commands(options) if options.partial else []) + [
+        # The least recently used artifacts beyond cache_versions are removed
+        'touch -c $artifact',
+        'ls -1dt {0}/*/ | tail -n +{1} | xargs -r rm -rf'.format(
+            options.cache_dir, options.cache_versions + 1),
+        'bash $artifact/generate_inventory_file.sh --output "{0}" --tag {1}'.format(
+            options.inventory, options.roles_tag),
+        'ansible-playbook -i "{0}" $artifact/{1}{2}'.format(
+            options.inventory, options.playbook, ansible_args) + ' || exit $?',
+        # Only a successful run is recorded, and failing to record it does
+        # not fail the deployment
+        'echo $etag > {0}/applied'.format(options.cache_dir)
+    ]
+    if options.version_tag:
+        commands.append('aws ec2 create-tags --resources {0} --tags Key={1},Value=$etag' \
+                        ' || true'.format(INSTANCE_ID, options.version_tag))
+    if (options.execution_timeout, options.delivery_timeout) != \
+            (EXECUTION_TIMEOUT, DELIVERY_TIMEOUT):
+        return shell_document(commands, options.execution_timeout, options.delivery_timeout)
+    return commands
@@ -0,0 +1,77 @@
+"""
+The Run Command documents GARLC deploys with.  By default the deploy script
+is sent inline with every SendCommand, as the commands of AWS-RunShellScript.
+When GARLC_SSM_DOCUMENT names the GARLC deploy document (GARLC-Deploy, created
+by Terraform) the script lives in the document and only the artifact URL,
+and the options not at the document's defaults, are sent, so every
+SendCommand request and every event that hands the commands on stays small
+and the same size.  Commands run with timeouts other than the defaults carry
+them along, the inline ones as AWS-RunShellScript arguments.
+"""
+import os
+
+SHELL_DOCUMENT = 'AWS-RunShellScript'
+# Seconds all commands have to complete in, and seconds an instance has to
+# start them, unless the commands say otherwise
+EXECUTION_TIMEOUT = 600
+DELIVERY_TIMEOUT = 900
+
+# Name of the deploy document, or '' to send the commands inline
+DEPLOY_DOCUMENT = os.environ.get('GARLC_SSM_DOCUMENT', '')
+# Version of the deploy document to run, or '' for its default version
+# (needs botocore 1.8 or later)
+DEPLOY_DOCUMENT_VERSION = os.environ.get('GARLC_SSM_DOCUMENT_VERSION', '')
+# Defaults of the deploy document's parameters (terraform/lambda/garlc_deploy.json)
+DEPLOY_DOCUMENT_DEFAULTS = {
+    'cacheDir': '/var/cache/garlc',
+    'cacheVersions': '5',
+    'region': '',
+    'rolesTag': 'Ansible_Roles',
+    'ansibleArgs': '',
+    'versionTag': 'GARLC_Version',
+    'partialDeploy': 'false',
+    'executionTimeout': str(EXECUTION_TIMEOUT)
+}
+
+def deploy_document(artifact, parameters=None, delivery_timeout=DELIVERY_TIMEOUT):
+    """
+    Returns the deploy document and its parameters for artifact, along with
+    those of the other parameters given (by name and value) not at their
+    defaults and the delivery timeout when it is not the default, or None
+    when the commands are sent inline
+    """
+    if not DEPLOY_DOCUMENT:
+        return None
+    document = {'DocumentName': DEPLOY_DOCUMENT, 'Parameters': {'artifact': [artifact]}}
+    document['Parameters'].update(
+        (name, [value]) for name, value in (parameters or {}).items()
+        if value != DEPLOY_DOCUMENT_DEFAULTS.get(name))
+    if DEPLOY_DOCUMENT_VERSION:
+        document['DocumentVersion'] = DEPLOY_DOCUMENT_VERSION
+    if delivery_timeout != DELIVERY_TIMEOUT:
+        document['TimeoutSeconds'] = delivery_timeout
+    return document
+
+def shell_document(commands, execution_timeout=EXECUTION_TIMEOUT,
+                   delivery_timeout=DELIVERY_TIMEOUT):
+    """
+    Returns the SendCommand arguments that run shell commands with
+    AWS-RunShellScript and the timeouts given
+    """
+    return {
+        'DocumentName': SHELL_DOCUMENT,
+        'Parameters': {'commands': commands, 'executionTimeout': [str(execution_timeout)]},
+        'TimeoutSeconds': delivery_timeout
+    }
+
+def send_command_args(commands):
+    """
+    Returns the SendCommand arguments that run commands, either a list of
+    shell commands or the arguments returned by deploy_document or
+    shell_document
+    """
+    if isinstance(commands, dict):
+        args = dict(commands)
+        args.setdefault('TimeoutSeconds', DELIVERY_TIMEOUT)
+        return args
+    return shell_document(commands)
@@ -0,0 +1,241 @@
+"""
+Ledger of the chunks the RunCommand helper sends, so sending is idempotent.
+A helper claims each chunk before sending it and records the CommandId (or
+the failure) afterwards, and skips chunks that were sent or that another
+helper is sending.  A helper invocation Lambda retries, or a stalled
+deployment the main function hands off again, then only sends the chunks
+that never went out.  Claims name the invocation (its Lambda request ID)
+holding them, and Lambda retries an invocation with the same request ID, so
+a retry takes back the chunks it claimed before it failed straight away.
+The ledger is kept in a DynamoDB table in production or in an SQLite
+database for tests and local runs, named by GARLC_LEDGER (e.g.
+dynamodb:garlc_dispatch_ledger or sqlite:/tmp/garlc-ledger.db).
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from botocore.exceptions import ClientError
+from clients import get_client
+from throttling import call
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Where the ledger is kept, '' for no ledger
+LEDGER = os.environ.get('GARLC_LEDGER', '')
+# Seconds a claim lasts, after which a chunk still not sent may be claimed again
+CLAIM_SECONDS = int(os.environ.get('GARLC_LEDGER_CLAIM_SECONDS', '120'))
+# Seconds entries are kept for (by the table's TTL in DynamoDB)
+ENTRY_SECONDS = int(os.environ.get('GARLC_LEDGER_ENTRY_SECONDS', str(7 * 24 * 3600)))
+
+CLAIMED = 'Claimed'
+SENT = 'Sent'
+FAILED = 'Failed'
+
+STORE_ERRORS = (ClientError, sqlite3.Error)
+
+LEDGERS = {}
+LOCK = threading.Lock()
+
+def chunk_key(instance_ids):
+    """
+    Returns the key of a chunk, the same however often it is handed on
+    """
+    return hashlib.sha1(','.join(instance_ids).encode('utf-8')).hexdigest()
+
+def is_claimable(status, updated, now, owner=None, holder=None):
+    """
+    Returns whether a chunk with status, last updated at updated by holder,
+    may be claimed by owner at now
+    """
+    return status == FAILED or (status == CLAIMED and (
+        updated < now - CLAIM_SECONDS or (owner is not None and holder == owner)))
+
+class SQLiteStore(object):
+    """
+    Ledger kept in an SQLite database, shared by the threads of a process
+    and, through its file, by other processes on the same host
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS chunks (deployment TEXT, chunk TEXT, status TEXT, '
+            'command_id TEXT, updated REAL, owner TEXT, PRIMARY KEY (deployment, chunk))')
+        self.lock = threading.Lock()
+
+    def claim(self, deployment, chunk, now, owner=None):
+        """
+        Claims a chunk for owner, returning False when it was sent or another
+        owner claimed it
+        """
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute(
+                    'SELECT status, updated, owner FROM chunks '
+                    'WHERE deployment = ? AND chunk = ?', (deployment, chunk)).fetchone()
+                claimed = row is None or is_claimable(row[0], row[1], now, owner, row[2])
+                if claimed:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, NULL, ?, ?)',
+                        (deployment, chunk, CLAIMED, now, owner))
+                self.connection.execute('COMMIT')
+            except sqlite3.Error:
+                self.connection.execute('ROLLBACK')
+                raise
+        return claimed
+
+    def record(self, deployment, chunk, status, command_id, now):
+        """
+        Records the status of a chunk and the command that sent it
+        """
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, NULL)',
+                                    (deployment, chunk, status, command_id, now))
+
+    def chunks(self, deployment):
+        """
+        Returns the status and CommandId of every chunk of deployment
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT chunk, status, command_id FROM chunks WHERE deployment = ?',
+                (deployment,)).fetchall()
+        return dict((chunk, {'Status': status, 'CommandId': command_id})
+                    for chunk, status, command_id in rows)
+
+class DynamoDBStore(object):
+    """
+    Ledger kept in a DynamoDB table keyed by Deployment and Chunk, with its
+    TTL on Expires.  Claims are conditional writes, so only one helper
+    anywhere holds a chunk.
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def item(self, deployment, chunk, status, now):
+        """
+        Returns the item recording status
+        """
+        return {
+            'Deployment': {'S': deployment},
+            'Chunk': {'S': chunk},
+            'Status': {'S': status},
+            'Updated': {'N': repr(now)},
+            'Expires': {'N': str(int(now + ENTRY_SECONDS))}
+        }
+
+    def claim(self, deployment, chunk, now, owner=None):
+        """
+        Claims a chunk for owner, returning False when it was sent or another
+        owner claimed it
+        """
+        item = self.item(deployment, chunk, CLAIMED, now)
+        condition = 'attribute_not_exists(Chunk) OR #status = :failed OR ' \
+            '(#status = :claimed AND Updated < :expired)'
+        names = {'#status': 'Status'}
+        values = {
+            ':failed': {'S': FAILED},
+            ':claimed': {'S': CLAIMED},
+            ':expired': {'N': repr(now - CLAIM_SECONDS)}
+        }
+        if owner is not None:
+            item['Owner'] = {'S': owner}
+            condition += ' OR (#status = :claimed AND #owner = :owner)'
+            names['#owner'] = 'Owner'
+            values[':owner'] = {'S': owner}
+        dynamodb = get_client('dynamodb')
+        try:
+            call('dynamodb', dynamodb.put_item, TableName=self.table, Item=item,
+                 ConditionExpression=condition, ExpressionAttributeNames=names,
+                 ExpressionAttributeValues=values)
+            return True
+        except ClientError as err:
+            if err.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def record(self, deployment, chunk, status, command_id, now):
+        """
+        Records the status of a chunk and the command that sent it
+        """
+        item = self.item(deployment, chunk, status, now)
+        if command_id:
+            item['CommandId'] = {'S': command_id}
+        dynamodb = get_client('dynamodb')
+        call('dynamodb', dynamodb.put_item, TableName=self.table, Item=item)
+
+    def chunks(self, deployment):
+        """
+        Returns the status and CommandId of every chunk of deployment
+        """
+        dynamodb = get_client('dynamodb')
+        kwargs = {
+            'TableName': self.table,
+            'KeyConditionExpression': 'Deployment = :deployment',
+            'ExpressionAttributeValues': {':deployment': {'S': deployment}}
+        }
+        chunks = {}
+        while True:
+            page = call('dynamodb', dynamodb.query, **kwargs)
+            for item in page.get('Items', []):
+                chunks[item['Chunk']['S']] = {
+                    'Status': item['Status']['S'],
+                    'CommandId': item.get('CommandId', {}).get('S')
+                }
+            if not page.get('LastEvaluatedKey'):
+                return chunks
+            kwargs['ExclusiveStartKey'] = page['LastEvaluatedKey']
+
+STORES = {
+    'dynamodb': DynamoDBStore,
+    'sqlite': SQLiteStore
+}
+
+def get_ledger(spec=None):
+    """
+    Returns the store of the ledger spec (GARLC_LEDGER by default) names,
+    opened once per container, or None when there is no ledger
+    """
+    spec = LEDGER if spec is None else spec
+    if not spec:
+        return None
+    with LOCK:
+        if spec not in LEDGERS:
+            kind, _, location = spec.partition(':')
+            if kind not in STORES or not location:
+                raise ValueError('Unknown ledger: %s' % spec)
+            LEDGERS[spec] = STORES[kind](location)
+        return LEDGERS[spec]
+
+def claim_chunk(ledger, deployment, instance_ids, owner=None):
+    """
+    Returns the key of a chunk once owner (a request ID) has claimed it, or
+    None when it was sent already or another helper is sending it.  A
+    ledger that cannot be reached does not hold up the deployment, the
+    chunk is claimed anyway.
+    """
+    chunk = chunk_key(instance_ids)
+    try:
+        if ledger.claim(deployment, chunk, time.time(), owner):
+            return chunk
+        LOGGER.info('Chunk %s of %s was sent already', chunk, deployment)
+        return None
+    except STORE_ERRORS as err:
+        LOGGER.error("Failed to claim chunk %s, sending it anyway!\n%s", chunk, err)
+        return chunk
+
+def record_chunk(ledger, deployment, chunk, command_id=None):
+    """
+    Records a chunk as sent by command_id, or as failed without one so it is
+    sent again on the next attempt
+    """
+    try:
+        ledger.record(deployment, chunk, SENT if command_id else FAILED, command_id,
+                      time.time())
+    except STORE_ERRORS as err:
+        LOGGER.error("Failed to record chunk %s!\n%s", chunk, err)
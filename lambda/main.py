@@ -2,20 +2,151 @@
 Triggers RunCommand on all instances with tag has_ssm_agent set to true.
 Fetches artifact from S3 via CodePipeline, extracts the contents, and finally
 runs Ansible locally on the instance to configure itself.  Uses
-runcommand_helper.py to actually execute RunCommand.
+runcommand_helper.py to actually execute RunCommand.  Instances in every
+region and account of the Targets option are found and handed off at the
+same time, and tracked as one deployment.
 joshcb@amazon.com
 v1.0.0
 """
 from __future__ import print_function
+import itertools
 import json
-import datetime
 import logging
+import math
+import os
+import re
+import time
 from botocore.exceptions import ClientError
-import boto3
+import metrics
+from artifacts import artifact_version
+from artifacts import record_latest_artifact
+from artifacts import split_s3_url
+from clients import get_client
+from ledger import LEDGER
+from deploy_commands import command_options
+from deploy_commands import ssm_commands
+from manifests import INLINE_PAYLOAD_BYTES
+from manifests import delete_failures
+from manifests import delete_manifests
+from manifests import failures_event
+from manifests import failures_prefix
+from manifests import manifest_event
+from manifests import manifest_key
+from manifests import save_manifest
+from parallel import Done
+from parallel import start_lookup
+from role_changes import RoleChanges
+from rolling import delete_plan
+from rolling import instance_roles
+from rolling import load_plan
+from rolling import plan_waves
+from rolling import save_plan
+from targets import LOCAL_TARGET
+from targets import budget
+from targets import is_local
+from targets import map_targets
+from targets import parse_targets
+from targets import target_client
+from targets import target_event
+from targets import target_name
+from throttling import call
+from tracking import POLL_MIN_SECONDS
+from tracking import TRACKING_TIMEOUT_SECONDS
+from tracking import command_comment
+from tracking import decode_state
+from tracking import deployment_job
+from tracking import encode_state
+from tracking import new_state
+from tracking import poll
+from tracking import poll_due
+from tracking import reported_failures
+from tracking import stalled
+from tracking import waiting_summary
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+# SendCommand accepts at most this many InstanceIds per call
+SSM_MAX_INSTANCE_IDS = 50
+
+INSTANCE_FILTERS = [
+    {'Name': 'tag:has_ssm_agent', 'Values': ['true', 'True']},
+    {'Name': 'instance-state-name', 'Values': ['running']}
+]
+
+# Deployment options and their defaults.  Each can be overridden by an
+# environment variable (e.g. GARLC_CHUNK_SIZE) or by a key in the JSON object
+# given as the UserParameters of the CodePipeline action.
+DEFAULT_OPTIONS = {
+    # Fixed number of instances per SendCommand, 0 to size chunks from the fleet
+    'ChunkSize': 0,
+    # Number of SendCommand calls the fleet should be spread across
+    'TargetConcurrency': 8,
+    # 'size' chunks the whole fleet, 'group' never mixes rollout groups in a chunk
+    'ChunkStrategy': 'size',
+    # Tag whose value defines an instance's rollout group
+    'RolloutGroupTag': 'Rollout_Group',
+    # Instances per DescribeInstances page (5 to 1000), each chunked and
+    # handed off on its own
+    'PageSize': 1000,
+    # 1 to only succeed once every instance has run the commands, 0 to
+    # succeed as soon as they have been handed off
+    'TrackResults': 1,
+    # 'all' deploys to every instance at once, 'rolling' deploys in waves
+    'DeploymentStrategy': 'all',
+    # Instances per wave of a rolling deployment, 0 to use MaxConcurrentPercent
+    'MaxConcurrent': 0,
+    'MaxConcurrentPercent': 25,
+    # Failed instances tolerated in a wave before the deployment halts
+    'MaxErrorsPerWave': 0,
+    # Comma separated Ansible roles deployed first, in order (e.g. "dbserver,appserver")
+    'WaveOrder': '',
+    # Tag holding an instance's comma separated Ansible roles
+    'RolesTag': 'Ansible_Roles',
+    # Tag instances record the version of the artifact they have applied in,
+    # '' to neither record it nor skip instances already at the version
+    'VersionTag': 'GARLC_Version',
+    # 1 to deploy to instances that have already applied the artifact
+    'Force': 0,
+    # 1 to leave out instances none of whose roles the artifact changes and
+    # only run the changed roles on the others
+    'PartialDeploy': 0,
+    # Regions and accounts to deploy to, '' for this function's own.  A list
+    # of regions or of {"Region": ..., "RoleArn": ...} objects naming a role
+    # to assume in another account, or a comma separated list of regions
+    'Targets': ''
+}
+
+def get_options(event):
+    """
+    Returns the deployment options for this job.  UserParameters take
+    precedence over environment variables, which take precedence over
+    DEFAULT_OPTIONS.
+    """
+    options = dict(DEFAULT_OPTIONS)
+    for name in options:
+        env_name = 'GARLC_' + re.sub(r'(?<=[a-z0-9])(?=[A-Z])', '_', name).upper()
+        if env_name in os.environ:
+            options[name] = os.environ[env_name]
+
+    try:
+        user_parameters = event['CodePipeline.job']['data']['actionConfiguration'] \
+            ['configuration']['UserParameters']
+        options.update(json.loads(user_parameters))
+    except KeyError:
+        pass
+    except (TypeError, ValueError) as err:
+        LOGGER.error("Could not parse UserParameters, using defaults!\n%s", err)
+
+    for name, default in DEFAULT_OPTIONS.items():
+        if isinstance(default, int):
+            try:
+                options[name] = int(options[name])
+            except (TypeError, ValueError):
+                LOGGER.error("Invalid value for %s: %s", name, options[name])
+                options[name] = default
+    return options
+
 def find_artifact(event):
     """
     Returns the S3 Object that holds the artifact
@@ -29,32 +160,36 @@ def find_artifact(event):
     except KeyError as err:
         raise KeyError("Couldn't get S3 object!\n%s", err)
 
-def ssm_commands(artifact):
+def codepipeline_success(job_id, summary=None):
     """
-    Builds commands to be sent to SSM (Run Command)
+    Puts CodePipeline Success Result
     """
-    # TODO
-    # Error handling in the command generation
-    utc_datetime = datetime.datetime.utcnow()
-    timestamp = utc_datetime.strftime("%Y%m%d%H%M%S")
-    return [
-        'export AWS_DEFAULT_REGION=`curl -s http://169.254.169.254/' \
-        "latest/dynamic/instance-identity/document | grep region | awk -F\\\" '{print $4}'`",
-        'aws configure set s3.signature_version s3v4',
-        'aws s3 cp {0} /tmp/{1}.zip --quiet'.format(artifact, timestamp),
-        'unzip -qq /tmp/{0}.zip -d /tmp/{1}'.format(timestamp, timestamp),
-        'bash /tmp/{0}/generate_inventory_file.sh'.format(timestamp),
-        'ansible-playbook -i "/tmp/inventory" /tmp/{0}/ansible/playbook.yml'.format(timestamp)
-    ]
+    kwargs = {'jobId': job_id}
+    if summary:
+        kwargs['executionDetails'] = {'summary': summary, 'percentComplete': 100}
+    try:
+        codepipeline = get_client('codepipeline')
+        call('codepipeline', codepipeline.put_job_success_result, **kwargs)
+        LOGGER.info('===SUCCESS===')
+        return True
+    except ClientError as err:
+        LOGGER.error("Failed to PutJobSuccessResult for CodePipeline!\n%s", err)
+        return False
 
-def codepipeline_success(job_id):
+def codepipeline_continue(job_id, continuation_token, summary, percent_complete):
     """
-    Puts CodePipeline Success Result
+    Puts CodePipeline Success Result with a continuation token, so the job
+    is handed back to this function later with that token
     """
     try:
-        codepipeline = boto3.client('codepipeline')
-        codepipeline.put_job_success_result(jobId=job_id)
-        LOGGER.info('===SUCCESS===')
+        codepipeline = get_client('codepipeline')
+        call(
+            'codepipeline', codepipeline.put_job_success_result,
+            jobId=job_id,
+            continuationToken=continuation_token,
+            executionDetails={'summary': summary, 'percentComplete': percent_complete}
+        )
+        LOGGER.info('===CONTINUE===')
         return True
     except ClientError as err:
         LOGGER.error("Failed to PutJobSuccessResult for CodePipeline!\n%s", err)
@@ -65,8 +200,9 @@ def codepipeline_failure(job_id, message):
     Puts CodePipeline Failure Result
     """
     try:
-        codepipeline = boto3.client('codepipeline')
-        codepipeline.put_job_failure_result(
+        codepipeline = get_client('codepipeline')
+        call(
+            'codepipeline', codepipeline.put_job_failure_result,
             jobId=job_id,
             failureDetails={'type': 'JobFailed', 'message': message}
         )
@@ -76,68 +212,555 @@ def codepipeline_failure(job_id, message):
         LOGGER.error("Failed to PutJobFailureResult for CodePipeline!\n%s", err)
         return False
 
-def find_instances():
+def describe_instance_pages(filters, page_size=None, target=LOCAL_TARGET):
     """
-    Find Instances to invoke Run Command against
+    Yields the instances in target matched by the filters one
+    DescribeInstances page at a time, so callers can act on a page before the
+    next one is fetched
     """
-    instance_ids = []
-    filters = [
-        {'Name': 'tag:has_ssm_agent', 'Values': ['true', 'True']},
-        {'Name': 'instance-state-name', 'Values': ['running']}
-    ]
-    try:
-        instance_ids = find_instance_ids(filters)
-        print(instance_ids)
-    except ClientError as err:
-        LOGGER.error("Failed to DescribeInstances with EC2!\n%s", err)
-
-    return instance_ids
+    ec2 = target_client('ec2', target)
+    kwargs = {'Filters': filters, 'MaxResults': page_size or DEFAULT_OPTIONS['PageSize']}
+    while True:
+        page = call('ec2', ec2.describe_instances, budget=budget(target), **kwargs)
+        yield [instance for reservation in page['Reservations']
+               for instance in reservation['Instances']]
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
 
 def find_instance_ids(filters):
     """
     EC2 API calls to retrieve instances matched by the filter
     """
-    ec2 = boto3.resource('ec2')
-    return [i.id for i in ec2.instances.all().filter(Filters=filters)]
+    return [instance['InstanceId'] for page in describe_instance_pages(filters)
+            for instance in page]
+
+def target_version(artifact, options):
+    """
+    Returns the version of artifact that instances which have already
+    applied it are tagged with, or None when no instance is to be skipped
+    """
+    if options['Force'] or not options['VersionTag']:
+        return None
+    return artifact_version(artifact)
+
+def find_versions(artifact, options):
+    """
+    Returns the version of artifact instances that applied it are tagged with
+    and the RoleChanges of a partial deployment of it (see target_version
+    and role_changes)
+    """
+    version = target_version(artifact, options)
+    return version, role_changes(artifact, version, options)
+
+def role_changes(artifact, version, options):
+    """
+    Returns the RoleChanges of a partial deployment of artifact, or None
+    when every instance not at version is deployed to
+    """
+    if not options['PartialDeploy'] or version is None:
+        return None
+    bucket, key = split_s3_url(artifact)
+    with metrics.span('Fingerprint'):
+        return RoleChanges.for_artifact(bucket, key, version)
+
+def pending_instances(instances, options, version, changes=None):
+    """
+    Returns the instances that have not applied version yet, leaving out
+    those none of whose roles changed when changes are given
+    """
+    if version is None:
+        return instances
+    pending = []
+    for instance in instances:
+        tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+        applied = tags.get(options['VersionTag'])
+        if applied == version:
+            continue
+        if changes is not None and \
+                not changes.affects(applied, instance_roles(instance, options['RolesTag'])):
+            metrics.count('Unaffected')
+            continue
+        pending.append(instance)
+    metrics.count('Skipped', len(instances) - len(pending))
+    return pending
+
+def group_instances_by_tag(instances, tag_key):
+    """
+    Returns the IDs of instances keyed by the value of tag_key ('' for
+    instances without the tag)
+    """
+    groups = {}
+    for instance in instances:
+        tags = dict((tag['Key'], tag['Value']) for tag in instance.get('Tags', []))
+        groups.setdefault(tags.get(tag_key, ''), []).append(instance['InstanceId'])
+    return groups
 
-def break_instance_ids_into_chunks(instance_ids):
+def chunk_size(instance_count, options):
+    """
+    Returns the number of instances to put in each SendCommand.  Unless a
+    fixed ChunkSize is configured the instances (a page of the fleet) are
+    spread across TargetConcurrency calls, capped at the SendCommand maximum.
+    """
+    if options['ChunkSize'] > 0:
+        size = options['ChunkSize']
+    else:
+        size = int(math.ceil(instance_count / float(max(options['TargetConcurrency'], 1))))
+    return min(max(size, 1), SSM_MAX_INSTANCE_IDS)
+
+def break_instance_ids_into_chunks(instance_ids, size=None):
     """
     Returns successive chunks from instance_ids
     """
-    size = 3
+    if size is None:
+        size = chunk_size(len(instance_ids), DEFAULT_OPTIONS)
     chunks = []
     for i in range(0, len(instance_ids), size):
         chunks.append(instance_ids[i:i + size])
     return chunks
 
-def execute_runcommand(chunked_instance_ids, commands, job_id):
+def break_instance_groups_into_chunks(groups, size):
+    """
+    Returns successive chunks from each group in turn, so that a chunk never
+    holds instances from more than one group
+    """
+    chunks = []
+    for group in sorted(groups):
+        chunks.extend(break_instance_ids_into_chunks(groups[group], size))
+    return chunks
+
+def chunk_instances(instances, options):
     """
-    Handoff RunCommand to the RunCommand Helper AWS Lambda function
+    Breaks instances into chunks according to the ChunkStrategy option
     """
+    size = chunk_size(len(instances), options)
+    if options['ChunkStrategy'] == 'group':
+        groups = group_instances_by_tag(instances, options['RolloutGroupTag'])
+        return break_instance_groups_into_chunks(groups, size)
+    instance_ids = [instance['InstanceId'] for instance in instances]
+    return break_instance_ids_into_chunks(instance_ids, size)
+
+def stream_chunks(options, versions=None, target=LOCAL_TARGET):
+    """
+    Yields the number of instances and the chunks of those still to deploy
+    to (see pending_instances) for each page of instances in target to invoke
+    Run Command against.  versions, the lookup of find_versions, is only
+    waited for once the first page has been listed.  A failed
+    DescribeInstances is raised, even after earlier pages were yielded, so
+    the job is never taken for done with only part of target listed.
+    """
+    versions = versions or Done((None, None))
     try:
-        client = boto3.client('lambda')
+        for instances in describe_instance_pages(INSTANCE_FILTERS, options['PageSize'], target):
+            metrics.count('Instances', len(instances))
+            version, changes = versions.result()
+            with metrics.span('Chunking'):
+                chunked_instance_ids = chunk_instances(
+                    pending_instances(instances, options, version, changes), options
+                )
+            yield len(instances), chunked_instance_ids
     except ClientError as err:
-        LOGGER.error("Failed to created a Lambda client!\n%s", err)
-        codepipeline_failure(job_id, err)
-        return False
+        LOGGER.error("Failed to DescribeInstances with EC2 in %s!\n%s", target_name(target), err)
+        raise
 
+def execute_runcommand(chunked_instance_ids, commands, comment=None, manifest=None,
+                       target=LOCAL_TARGET, failures=None):
+    """
+    Handoff RunCommand to the RunCommand Helper AWS Lambda function, which
+    sends it to target and records chunks that fail to send where failures
+    (see failures_event) says.  When the chunks are too large to pass inline,
+    or there is a ledger to resume the deployment from, and manifest (a
+    bucket and key) is given they are stored there and the helper is passed
+    a reference.
+    """
     event = {
         "ChunkedInstanceIds": chunked_instance_ids,
-        "Commands": commands
+        "Commands": commands,
+        "Comment": comment
     }
-    response = client.invoke_async(
-        FunctionName='garlc_runcommand_helper',
-        InvokeArgs=json.dumps(event)
-    )
+    if target != LOCAL_TARGET:
+        event["Target"] = target_event(target)
+    if failures is not None:
+        event["Failures"] = failures
+    payload = json.dumps(event, separators=(',', ':'))
+    try:
+        if manifest is not None and (LEDGER or len(payload) > INLINE_PAYLOAD_BYTES):
+            payload = json.dumps(save_manifest(manifest[0], manifest[1], chunked_instance_ids,
+                                               commands, comment, target_event(target),
+                                               failures))
+    except ClientError as err:
+        LOGGER.error("Failed to save the manifest!\n%s", err)
+        return False
+    return invoke_runcommand_helper(payload)
 
-    if response['Status'] is 202:
-        codepipeline_success(job_id)
+def invoke_runcommand_helper(payload):
+    """
+    Invokes the RunCommand Helper AWS Lambda function with the payload
+    """
+    try:
+        client = get_client('lambda')
+        response = call(
+            'lambda', client.invoke_async,
+            FunctionName='garlc_runcommand_helper',
+            InvokeArgs=payload
+        )
+    except ClientError as err:
+        LOGGER.error("Failed to invoke the RunCommand helper!\n%s", err)
+        return False
+
+    if response['Status'] == 202:
+        return True
+    else:
+        LOGGER.error(response)
+        return False
+
+def find_continuation_token(event):
+    """
+    Returns the continuation token CodePipeline hands back when it invokes
+    this function again for a job in progress, or None
+    """
+    try:
+        return event['CodePipeline.job']['data']['continuationToken']
+    except KeyError:
+        return None
+
+def remove_manifests(job_id, state, artifact):
+    """
+    Removes the manifests handed to the helper once a deployment has ended
+    """
+    try:
+        delete_manifests(split_s3_url(artifact)[0], deployment_job(job_id, state),
+                         state.get('Manifests', 0))
+    except (ClientError, ValueError) as err:
+        LOGGER.error("Failed to delete the manifests!\n%s", err)
+
+def remove_failures(job_id, state, progress, artifact):
+    """
+    Removes the records of chunks the helper failed to send once progress
+    has counted them for good
+    """
+    if len(progress.unsent_instance_ids) == 0:
+        return
+    try:
+        delete_failures(split_s3_url(artifact)[0], deployment_job(job_id, state))
+    except (ClientError, ValueError) as err:
+        LOGGER.error("Failed to delete the records of failed chunks!\n%s", err)
+
+def track_deployment(job_id, continuation_token, options, artifact, targets=None):
+    """
+    Checks the Run Command jobs of a deployment handed off earlier, in each
+    of its targets, once the check is due, and puts the CodePipeline result
+    once every instance has finished, or hands the job back to CodePipeline
+    to be checked again later
+    """
+    targets = targets or [LOCAL_TARGET]
+    try:
+        state = decode_state(continuation_token)
+        if not poll_due(state):
+            # CodePipeline handed the job back before the next check is due
+            summary, percent_complete = waiting_summary(state)
+            codepipeline_continue(job_id, encode_state(state), summary, percent_complete)
+            return True
+        with metrics.span('Tracking'):
+            progress = poll(job_id, state, targets, split_s3_url(artifact)[0])
+    except (ClientError, KeyError, TypeError, ValueError) as err:
+        LOGGER.error("Failed to track the deployment!\n%s", err)
+        codepipeline_failure(job_id, 'Failed to track the deployment: %s' % err)
+        return False
+
+    elapsed = int(time.time()) - state['Started']
+    if 'Wave' in state and progress.done:
+        return finish_wave(job_id, state, progress, options, artifact, targets)
+    elif progress.succeeded:
+        LOGGER.info('Deployment to %d instances completed in %d seconds',
+                    progress.instance_count, elapsed)
+        remove_manifests(job_id, state, artifact)
+        # Bootstrap only deploys the artifact to new instances once every
+        # instance has applied it
+        record_artifact(artifact, deployment_job(job_id, state), state.get('Version'))
+        codepipeline_success(job_id, '%s in %d seconds' % (progress.summary(), elapsed))
         return True
+    elif progress.done:
+        message = '%s: %s' % (progress.summary(), ', '.join(reported_failures(progress)))
+        LOGGER.error('Deployment failed after %d seconds, %s', elapsed, message)
+        remove_manifests(job_id, state, artifact)
+        remove_failures(job_id, state, progress, artifact)
+        codepipeline_failure(job_id, message)
+        return False
+    elif LEDGER and stalled(progress, state):
+        return resume_deployment(job_id, state, progress, artifact, targets)
+    elif elapsed > TRACKING_TIMEOUT_SECONDS:
+        remove_manifests(job_id, state, artifact)
+        remove_failures(job_id, state, progress, artifact)
+        codepipeline_failure(job_id, 'Timed out after %d seconds, %s' % (
+            elapsed, progress.summary()))
+        return False
     else:
-        codepipeline_failure(job_id, response)
+        codepipeline_continue(job_id, encode_state(state), progress.summary(),
+                              progress.percent_complete)
+        return True
+
+def resume_deployment(job_id, state, progress, artifact, targets):
+    """
+    Hands the manifests of a stalled deployment, or of the wave it is at, to
+    the helper again.  The ledger shows the helper which chunks were sent,
+    so only the ones that were lost or failed are sent this time.
+    """
+    if 'Wave' in state:
+        counts = state.get('Targets', [1] * len(targets))
+        parts = [state['Wave'] * len(targets) + index
+                 for index, count in enumerate(counts) if count]
+    else:
+        parts = range(state.get('Manifests', 0))
+    LOGGER.info('Resuming the deployment, %d of %d instances have been sent commands',
+                progress.targets, progress.instance_count)
+    bucket = split_s3_url(artifact)[0]
+    started_by = deployment_job(job_id, state)
+    for part in parts:
+        invoke_runcommand_helper(json.dumps(manifest_event(bucket, manifest_key(started_by, part),
+                                                           0, None)))
+    metrics.count('Resumes')
+    state.update({'Resumed': int(time.time()), 'Resumes': state.get('Resumes', 0) + 1})
+    codepipeline_continue(job_id, encode_state(state), 'Resumed, %s' % progress.summary(),
+                          progress.percent_complete)
+    return True
+
+def target_commands(artifact, options, target=LOCAL_TARGET):
+    """
+    Returns the commands that deploy artifact on the instances of target,
+    exporting the target's region there
+    """
+    overrides = {
+        'roles_tag': options['RolesTag'],
+        'version_tag': options['VersionTag'],
+        'partial': bool(options['PartialDeploy'])
+    }
+    if target.region:
+        overrides['region'] = target.region
+    return ssm_commands(artifact, command_options(**overrides))
+
+def find_pending_instances(options, versions=None, target=LOCAL_TARGET):
+    """
+    Returns the number of instances in target and those still to deploy to
+    (see pending_instances), waiting for versions, the lookup of
+    find_versions, once the first page has been listed, or None when
+    target could not be listed
+    """
+    versions = versions or Done((None, None))
+    instance_count = 0
+    instances = []
+    try:
+        for page in describe_instance_pages(INSTANCE_FILTERS, options['PageSize'], target):
+            instance_count += len(page)
+            version, changes = versions.result()
+            instances.extend(pending_instances(page, options, version, changes))
+    except ClientError as err:
+        LOGGER.error("Failed to DescribeInstances with EC2 in %s!\n%s", target_name(target), err)
+        return None
+    return instance_count, instances
+
+def start_rolling_deployment(job_id, artifact, options, versions=None, targets=None):
+    """
+    Plans the waves of a rolling deployment to the instances still to deploy
+    to (see pending_instances) across every target, keeps the plan in the
+    pipeline bucket and hands off the first wave
+    """
+    targets = targets or [LOCAL_TARGET]
+    versions = versions or Done((None, None))
+    found = map_targets(lambda target: find_pending_instances(options, versions, target),
+                        targets)
+    if None in found:
+        return unlisted_failure(job_id, targets, found)
+    instance_count = sum(count for count, _ in found)
+    instances = [instance for _, pending in found for instance in pending]
+    if instance_count == 0:
+        codepipeline_failure(job_id, 'No Instance IDs Provided!')
+        return False
+    elif len(instances) == 0:
+        return skip_deployment(job_id, artifact, instance_count, versions.result()[0])
+    with metrics.span('Planning'):
+        waves = plan_waves(instances, options)
+    LOGGER.info('Rolling out to %d instances in %d waves', len(instances), len(waves))
+
+    # Commands are kept for each target, and which target each instance is in
+    # when there is more than one
+    plan = {
+        'Waves': waves,
+        'Commands': [target_commands(artifact, options, target) for target in targets]
+    }
+    if not is_local(targets):
+        plan['InstanceTargets'] = dict((instance['InstanceId'], index)
+                                       for index, (_, pending) in enumerate(found)
+                                       for instance in pending)
+    try:
+        save_plan(split_s3_url(artifact)[0], job_id, plan)
+    except (ClientError, ValueError) as err:
+        LOGGER.error("Failed to save the deployment plan!\n%s", err)
+        codepipeline_failure(job_id, 'Failed to save the deployment plan!')
+        return False
+
+    state = new_state(0, job_id)
+    state.update({
+        'Version': versions.result()[0],
+        'Wave': 0,
+        'Waves': len(waves),
+        'DeploymentStarted': state['Started'],
+        'Finished': 0,
+        'Errors': 0,
+        'Manifests': len(waves) * len(targets)
+    })
+    return start_wave(job_id, state, plan, options, split_s3_url(artifact)[0], targets)
+
+def start_wave(job_id, state, plan, options, bucket, targets=None):
+    """
+    Hands off the wave the state is at, to each of its targets at the same
+    time, and hands the job back to CodePipeline to track it
+    """
+    targets = targets or [LOCAL_TARGET]
+    started_by = deployment_job(job_id, state)
+    failures = failures_event(bucket, failures_prefix(started_by, state['Wave']))
+    wave = plan['Waves'][state['Wave']]
+    target_waves = [[] for _ in targets]
+    for instance_id in wave:
+        target_waves[plan.get('InstanceTargets', {}).get(instance_id, 0)].append(instance_id)
+
+    def hand_off(index):
+        """Hands off the wave's instances in one target"""
+        instance_ids = target_waves[index]
+        if len(instance_ids) == 0:
+            return True
+        chunked_instance_ids = break_instance_ids_into_chunks(
+            instance_ids, chunk_size(len(instance_ids), options))
+        return execute_runcommand(chunked_instance_ids, plan['Commands'][index],
+                                  command_comment(started_by, state['Wave']),
+                                  (bucket, manifest_key(started_by,
+                                                        state['Wave'] * len(targets) + index)),
+                                  target=targets[index], failures=failures)
+
+    state.update({'Started': int(time.time()), 'Instances': len(wave)})
+    # Each wave may be resumed as often as MAX_RESUMES allows, and is first
+    # checked as soon as CodePipeline hands the job back
+    for key in ('Resumed', 'Resumes', 'Completed', 'NotBefore'):
+        state.pop(key, None)
+    state['Interval'] = POLL_MIN_SECONDS
+    if not is_local(targets):
+        state['Targets'] = [len(instance_ids) for instance_ids in target_waves]
+    if not all(map_targets(hand_off, list(range(len(targets))))):
+        codepipeline_failure(job_id, 'Failed to invoke the RunCommand helper!')
+        return False
+
+    summary = 'Wave %d of %d: %d instances handed off to Run Command' % (
+        state['Wave'] + 1, state['Waves'], len(wave))
+    LOGGER.info(summary)
+    codepipeline_continue(job_id, encode_state(state), summary,
+                          int(100 * state['Wave'] / float(state['Waves'])))
+    return True
+
+def finish_wave(job_id, state, progress, options, artifact, targets=None):
+    """
+    Halts a rolling deployment when the wave that just finished had more
+    than MaxErrorsPerWave failures, otherwise starts the next wave or puts
+    success after the last one
+    """
+    state['Finished'] += progress.completed
+    state['Errors'] += progress.errors
+    bucket = split_s3_url(artifact)[0]
+    started_by = deployment_job(job_id, state)
+    # The wave's failed chunks are counted in Errors from now on
+    remove_failures(job_id, state, progress, artifact)
+    elapsed = int(time.time()) - state['DeploymentStarted']
+    wave = 'wave %d of %d' % (state['Wave'] + 1, state['Waves'])
+
+    if progress.errors > options['MaxErrorsPerWave']:
+        message = 'Halted after %s, %s: %s' % (wave, progress.summary(),
+                                               ', '.join(reported_failures(progress)))
+        LOGGER.error(message)
+        delete_plan(bucket, started_by)
+        remove_manifests(job_id, state, artifact)
+        codepipeline_failure(job_id, message)
         return False
+    elif state['Wave'] + 1 == state['Waves']:
+        summary = '%d instances finished in %d waves, %d failed, in %d seconds' % (
+            state['Finished'], state['Waves'], state['Errors'], elapsed)
+        LOGGER.info(summary)
+        delete_plan(bucket, started_by)
+        remove_manifests(job_id, state, artifact)
+        record_artifact(artifact, started_by, state.get('Version'))
+        codepipeline_success(job_id, summary)
+        return True
+
+    LOGGER.info('Finished %s, %s', wave, progress.summary())
+    try:
+        plan = load_plan(bucket, started_by)
+    except (ClientError, KeyError, ValueError) as err:
+        LOGGER.error("Failed to load the deployment plan!\n%s", err)
+        codepipeline_failure(job_id, 'Failed to load the deployment plan!')
+        return False
+    state['Wave'] += 1
+    return start_wave(job_id, state, plan, options, bucket, targets)
+
+def hand_off_target(job_id, artifact, options, target, parts, versions=None):
+    """
+    Hands off each page of target's instances still to deploy to as soon as
+    it has been fetched, so Run Command starts on the first page while later
+    ones are still listed.  Manifests are numbered from parts, shared by all
+    targets.  Returns the number of instances in target, the number handed
+    off and whether every hand-off succeeded, or None when target could not
+    be listed.
+    """
+    commands = target_commands(artifact, options, target)
+    bucket = split_s3_url(artifact)[0]
+    # Failures are only recorded for a deployment that is tracked, and so
+    # cleaned up after
+    failures = failures_event(bucket, failures_prefix(job_id)) if options['TrackResults'] \
+        else None
+    instance_count = 0
+    pending_count = 0
+    handed_off = True
+    try:
+        for page_count, chunked_instance_ids in stream_chunks(options, versions, target=target):
+            instance_count += page_count
+            if len(chunked_instance_ids) != 0:
+                pending_count += sum(len(chunk) for chunk in chunked_instance_ids)
+                manifest = (bucket, manifest_key(job_id, next(parts)))
+                handed_off = execute_runcommand(chunked_instance_ids, commands,
+                                                command_comment(job_id), manifest,
+                                                target=target, failures=failures) and handed_off
+    except ClientError:
+        return None
+    LOGGER.info('%d of %d instances in %s handed off to Run Command',
+                pending_count, instance_count, target_name(target))
+    return instance_count, pending_count, handed_off
+
+def unlisted_failure(job_id, targets, results):
+    """
+    Fails the job naming each target whose result is None, as its instances
+    could not be listed (or its role assumed)
+    """
+    unlisted = [target_name(target) for target, result in zip(targets, results)
+                if result is None]
+    codepipeline_failure(job_id, 'Failed to list the instances in %s!' % ', '.join(unlisted))
+    return False
+
+def record_artifact(artifact, job_id, version=None):
+    """
+    Records artifact as the latest, along with its version and the commands
+    bootstrap sends new instances, so bootstrap works neither out itself
+    """
+    return record_latest_artifact(artifact, job_id, version, ssm_commands(artifact))
+
+def skip_deployment(job_id, artifact, instance_count, version):
+    """
+    Succeeds without deploying when every instance is up to date
+    """
+    summary = 'All %d instances are up to date with version %s' % (instance_count, version)
+    LOGGER.info(summary)
+    record_artifact(artifact, job_id, version)
+    codepipeline_success(job_id, summary)
+    return True
 
-def handle(event, _context):
+@metrics.instrument('main')
+def handle(event, context):
     """
     Lambda main handler
     """
@@ -148,12 +771,65 @@ def handle(event, _context):
         LOGGER.error("Could not retrieve CodePipeline Job ID!\n%s", err)
         return False
 
-    instance_ids = find_instances()
-    commands = ssm_commands(find_artifact(event))
-    if len(instance_ids) != 0:
-        chunked_instance_ids = break_instance_ids_into_chunks(instance_ids)
-        execute_runcommand(chunked_instance_ids, commands, job_id)
-        return True
-    else:
+    options = get_options(event)
+    artifact = find_artifact(event)
+    try:
+        targets = parse_targets(options['Targets'])
+    except (AttributeError, IndexError, TypeError, ValueError) as err:
+        LOGGER.error("Invalid Targets!\n%s", err)
+        codepipeline_failure(job_id, 'Invalid Targets: %s' % err)
+        return False
+    continuation_token = find_continuation_token(event)
+    if continuation_token is not None:
+        return track_deployment(job_id, continuation_token, options, artifact, targets)
+
+    # Instances tagged with the artifact's version have already applied it.
+    # The version (and fingerprint) are read while the first page of
+    # instances is listed, and every instance is deployed to when that takes
+    # too long.
+    versions = start_lookup('FindVersions', find_versions, artifact, options,
+                            default=(None, None))
+    if options['DeploymentStrategy'] == 'rolling':
+        return start_rolling_deployment(job_id, artifact, options, versions, targets)
+
+    # Every target is handed off at the same time, and next() on the shared
+    # count numbers their manifests without a lock
+    state = new_state(0, job_id)
+    parts = itertools.count()
+    results = map_targets(
+        lambda target: hand_off_target(job_id, artifact, options, target, parts, versions),
+        targets
+    )
+    if None in results:
+        # Pages already handed off go on, but the job fails as not every
+        # instance was listed
+        return unlisted_failure(job_id, targets, results)
+    version = versions.result()[0]
+    instance_count = sum(counts[0] for counts in results)
+    pending_count = sum(counts[1] for counts in results)
+    if len(targets) > 1:
+        LOGGER.info('%d of %d instances in %d targets handed off to Run Command',
+                    pending_count, instance_count, len(targets))
+
+    if instance_count == 0:
         codepipeline_failure(job_id, 'No Instance IDs Provided!')
         return False
+    elif not all(counts[2] for counts in results):
+        codepipeline_failure(job_id, 'Failed to invoke the RunCommand helper!')
+        return False
+    elif pending_count == 0:
+        return skip_deployment(job_id, artifact, instance_count, version)
+
+    if options['TrackResults']:
+        # CodePipeline hands the job back with the token to check on progress,
+        # and the artifact is recorded for bootstrap once the deployment succeeds
+        state.update({'Instances': pending_count, 'Manifests': next(parts), 'Version': version})
+        if not is_local(targets):
+            state['Targets'] = [counts[1] for counts in results]
+        codepipeline_continue(job_id, encode_state(state),
+                              '%d instances handed off to Run Command' % pending_count, 0)
+    else:
+        # Lets bootstrap find this artifact without listing the bucket
+        record_artifact(artifact, job_id, version)
+        codepipeline_success(job_id)
+    return True
@@ -0,0 +1,144 @@
+"""
+Manifests of the work handed to the RunCommand helper.  Instead of passing
+every remaining chunk and the commands on each hop between helper functions,
+large hand-offs store them once in a manifest object in the pipeline bucket
+and each hop only passes a reference to it and the range of chunks still to
+send.  Hand-offs small enough to stay well under the asynchronous invocation
+payload limit are still passed inline, saving the round trip to S3.  Chunks
+the helper fails to send are recorded next to the manifests, so tracking
+counts their instances as failed rather than waiting for them.
+"""
+import json
+import os
+from cache import TTLCache
+from clients import get_client
+from throttling import call
+
+# Prefix of the manifest objects, one per hand-off from the main function
+MANIFEST_PREFIX = os.environ.get('GARLC_MANIFEST_PREFIX', 'garlc-manifests/')
+# Largest event passed inline, well under the 128 KB limit of InvokeAsync
+INLINE_PAYLOAD_BYTES = int(os.environ.get('GARLC_INLINE_PAYLOAD_BYTES', '32768'))
+
+# Manifests never change, so a warm helper reads each one once
+MANIFEST_CACHE = TTLCache('manifest', os.environ.get('GARLC_MANIFEST_CACHE_TTL', '900'))
+
+def manifest_key(job_id, part):
+    """
+    Returns the key of the manifest for one part of job_id's hand-off
+    """
+    return '%s%s/%d.json' % (MANIFEST_PREFIX, job_id, part)
+
+def manifest_event(bucket, key, start, end):
+    """
+    Returns the helper event for chunks start to end of a manifest (to its
+    last chunk when end is None)
+    """
+    return {'Manifest': {'Bucket': bucket, 'Key': key}, 'Start': start, 'End': end}
+
+def failures_prefix(job_id, wave=None):
+    """
+    Returns the prefix of the records of chunks the helper failed to send for
+    job_id's deployment, or for one wave of it
+    """
+    return '%s%s/failed/%s/' % (MANIFEST_PREFIX, job_id, 'all' if wave is None else
+                                'wave-%d' % wave)
+
+def failures_event(bucket, prefix):
+    """
+    Returns where the helper records the chunks it fails to send
+    """
+    return {'Bucket': bucket, 'Prefix': prefix}
+
+def save_manifest(bucket, key, chunked_instance_ids, commands, comment=None, target=None,
+                  failures=None):
+    """
+    Stores a manifest, naming the target its chunks are sent to and where
+    failures are recorded when given, and returns the helper event for all
+    of its chunks
+    """
+    aws_s3 = get_client('s3')
+    manifest = {
+        'ChunkedInstanceIds': chunked_instance_ids,
+        'Commands': commands,
+        'Comment': comment
+    }
+    if target is not None:
+        manifest['Target'] = target
+    if failures is not None:
+        manifest['Failures'] = failures
+    body = json.dumps(manifest, separators=(',', ':'))
+    call('s3', aws_s3.put_object, Bucket=bucket, Key=key, Body=body,
+         ContentType='application/json')
+    return manifest_event(bucket, key, 0, len(chunked_instance_ids))
+
+def read_manifest(bucket, key):
+    """
+    Reads a manifest from S3
+    """
+    aws_s3 = get_client('s3')
+    manifest = call('s3', aws_s3.get_object, Bucket=bucket, Key=key)
+    return json.loads(manifest['Body'].read().decode('utf-8'))
+
+def load_manifest(bucket, key):
+    """
+    Returns a manifest, read once per container
+    """
+    return MANIFEST_CACHE.get((bucket, key), lambda: read_manifest(bucket, key))
+
+def delete_manifests(bucket, job_id, parts):
+    """
+    Removes the manifests of job_id's hand-off once the deployment has ended
+    """
+    if parts == 0:
+        return
+    aws_s3 = get_client('s3')
+    for start in range(0, parts, 1000):
+        call('s3', aws_s3.delete_objects, Bucket=bucket, Delete={
+            'Objects': [{'Key': manifest_key(job_id, part)}
+                        for part in range(start, min(start + 1000, parts))],
+            'Quiet': True
+        })
+
+def save_failure(failures, chunk, instance_ids):
+    """
+    Records a chunk the helper failed to send where failures (see
+    failures_event) says, once however often it fails
+    """
+    aws_s3 = get_client('s3')
+    body = json.dumps({'InstanceIds': instance_ids}, separators=(',', ':'))
+    call('s3', aws_s3.put_object, Bucket=failures['Bucket'],
+         Key=failures['Prefix'] + chunk + '.json', Body=body, ContentType='application/json')
+
+def failure_keys(bucket, prefix):
+    """
+    Returns the keys of every object under prefix
+    """
+    aws_s3 = get_client('s3')
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    keys = []
+    while True:
+        page = call('s3', aws_s3.list_objects_v2, **kwargs)
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        if not page.get('NextContinuationToken'):
+            return keys
+        kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+def read_failures(bucket, prefix):
+    """
+    Returns the instances of every chunk recorded under prefix as failed to
+    send.  Records never change, so each is read once per container.
+    """
+    return [instance_id for key in failure_keys(bucket, prefix)
+            for instance_id in load_manifest(bucket, key)['InstanceIds']]
+
+def delete_failures(bucket, job_id):
+    """
+    Removes the records of chunks that failed to send for job_id's deployment
+    """
+    keys = failure_keys(bucket, '%s%s/failed/' % (MANIFEST_PREFIX, job_id))
+    aws_s3 = get_client('s3')
+    for start in range(0, len(keys), 1000):
+        call('s3', aws_s3.delete_objects, Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+            'Quiet': True
+        })
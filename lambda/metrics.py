@@ -0,0 +1,137 @@
+"""
+Per-invocation timing and counters for the GARLC handlers.  Every AWS call
+made through the throttling module and every handler phase wrapped in a span
+is timed, and throttled calls and retries are counted.  At the end of an
+invocation the totals are written to stdout as a single line in CloudWatch
+Embedded Metric Format, so they become CloudWatch metrics without any further
+API calls.  Set GARLC_METRICS to true to enable it; when disabled spans are a
+shared no-op and nothing is recorded.
+"""
+from __future__ import print_function
+import functools
+import json
+import os
+import threading
+import time
+
+ENABLED = os.environ.get('GARLC_METRICS', 'false').lower() == 'true'
+NAMESPACE = os.environ.get('GARLC_METRICS_NAMESPACE', 'GARLC')
+
+TIMINGS = {}
+COUNTERS = {}
+LOCK = threading.Lock()
+
+class Span(object):
+    """
+    Context manager adding the milliseconds it was open to the named timing
+    """
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *_exc_info):
+        elapsed_ms = (time.time() - self.started) * 1000
+        with LOCK:
+            total, calls = TIMINGS.get(self.name, (0.0, 0))
+            TIMINGS[self.name] = (total + elapsed_ms, calls + 1)
+        return False
+
+class NullSpan(object):
+    """
+    Span that records nothing, used while metrics are disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        return False
+
+NULL_SPAN = NullSpan()
+
+def span(name):
+    """
+    Returns a context manager timing the named phase or call
+    """
+    if not ENABLED:
+        return NULL_SPAN
+    return Span(name)
+
+def count(name, value=1):
+    """
+    Adds value to the named counter
+    """
+    if not ENABLED:
+        return
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+def reset():
+    """
+    Forgets everything recorded so far
+    """
+    with LOCK:
+        TIMINGS.clear()
+        COUNTERS.clear()
+
+def document(function_name):
+    """
+    Returns everything recorded as an Embedded Metric Format document.
+    Timings are reported as total milliseconds, with the number of calls
+    alongside as <name>.Count.
+    """
+    with LOCK:
+        values = {}
+        units = {}
+        for name, (total, calls) in TIMINGS.items():
+            values[name] = round(total, 3)
+            units[name] = 'Milliseconds'
+            values[name + '.Count'] = calls
+            units[name + '.Count'] = 'Count'
+        for name, value in COUNTERS.items():
+            values[name] = value
+            units[name] = 'Count'
+
+    result = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Function']],
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in sorted(units)]
+            }]
+        },
+        'Function': function_name
+    }
+    result.update(values)
+    return result
+
+def emit(function_name):
+    """
+    Writes everything recorded as one Embedded Metric Format line
+    """
+    print(json.dumps(document(function_name), sort_keys=True))
+
+def instrument(function_name):
+    """
+    Decorates a Lambda handler so each invocation starts from nothing, is
+    timed as a whole and emits its metrics when it returns or raises
+    """
+    def decorator(handler):
+        """Wraps the handler"""
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            """Runs the handler with metrics recorded"""
+            if not ENABLED:
+                return handler(event, context)
+            reset()
+            try:
+                with span('Invocation'):
+                    return handler(event, context)
+            finally:
+                emit(function_name)
+        return wrapper
+    return decorator
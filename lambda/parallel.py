@@ -0,0 +1,106 @@
+"""
+Runs independent AWS lookups side by side, so a handler waits for the
+slowest of them rather than for each in turn.  Lookups run on a small thread
+pool kept for the life of the container, each timed as a phase by its name.
+A lookup not done within its timeout of being started is given up on and its
+default used instead, while the lookup itself runs on to its end on the pool.
+"""
+import logging
+import os
+import threading
+import time
+import metrics
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Lookups run at the same time
+LOOKUP_WORKERS = int(os.environ.get('GARLC_LOOKUP_WORKERS', '4'))
+# Seconds a lookup is waited for before its default is used
+LOOKUP_TIMEOUT_SECONDS = float(os.environ.get('GARLC_LOOKUP_TIMEOUT_SECONDS', '20'))
+
+POOL = []
+LOCK = threading.Lock()
+
+def get_pool():
+    """
+    Returns the container's lookup pool, started on first use
+    """
+    with LOCK:
+        if not POOL:
+            # Imported here so handlers that never look up two things at once
+            # skip loading concurrent.futures
+            from concurrent.futures import ThreadPoolExecutor
+            POOL.append(ThreadPoolExecutor(max(LOOKUP_WORKERS, 1)))
+        return POOL[0]
+
+def timed(name, func, args):
+    """
+    Returns func(*args), timed as the named phase
+    """
+    with metrics.span(name):
+        return func(*args)
+
+class Lookup(object):
+    """
+    A lookup running on the pool.  result() waits for it, re-raising what it
+    raised, or returns default once timeout seconds have passed since it
+    started.  Any number of threads may wait for it.
+    """
+    def __init__(self, name, func, args=(), default=None, timeout=None):
+        self.name = name
+        self.default = default
+        self.timeout = LOOKUP_TIMEOUT_SECONDS if timeout is None else timeout
+        self.deadline = time.time() + self.timeout
+        self.pending = get_pool().submit(timed, name, func, args)
+        self.value = None
+        self.done = False
+        self.lock = threading.Lock()
+
+    def result(self):
+        """
+        Returns what the lookup returned, or its default when it timed out
+        """
+        with self.lock:
+            if not self.done:
+                # Imported here, like the pool, which has already loaded it
+                from concurrent.futures import TimeoutError as LookupTimeout
+                try:
+                    self.value = self.pending.result(max(self.deadline - time.time(), 0))
+                except LookupTimeout:
+                    LOGGER.error("%s took over %s seconds, going on without it!",
+                                 self.name, self.timeout)
+                    metrics.count('LookupTimeouts')
+                    self.value = self.default
+                self.done = True
+            return self.value
+
+class Done(object):
+    """
+    A lookup that did not need to run, holding its result
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def result(self):
+        """
+        Returns the result
+        """
+        return self.value
+
+def start_lookup(name, func, *args, **kwargs):
+    """
+    Starts func(*args) on the pool and returns its Lookup.  Takes default
+    and timeout keyword arguments.
+    """
+    return Lookup(name, func, args, kwargs.get('default'), kwargs.get('timeout'))
+
+def run_lookups(lookups, timeout=None):
+    """
+    Runs each (name, func, default) of lookups at the same time and returns
+    their results in order.  A single lookup runs on the calling thread.
+    """
+    if len(lookups) == 1:
+        return [timed(lookups[0][0], lookups[0][1], ())]
+    started = [Lookup(name, func, (), default, timeout) for name, func, default in lookups]
+    return [lookup.result() for lookup in started]
@@ -0,0 +1,197 @@
+"""
+Works out which Ansible roles an artifact changes, so partial deployments
+leave out the instances none of whose roles changed.  The fingerprint of an
+artifact holds a digest of each role under ansible/roles/ and one of the rest
+of the Ansible files, made from the names, sizes and CRCs in the zip's
+central directory, so only the end of the artifact is read.  Fingerprints are
+kept in the pipeline bucket by version, the ETag instances record once they
+have applied an artifact, and each instance is compared against the version
+it has.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import zipfile
+from botocore.exceptions import ClientError
+from cache import TTLCache
+from clients import get_client
+from throttling import call
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Prefix of the fingerprint objects, one per version
+FINGERPRINT_PREFIX = os.environ.get('GARLC_FINGERPRINT_PREFIX', 'garlc-fingerprints/')
+ROLES_PREFIX = 'ansible/roles/'
+# Files outside the roles that change what Ansible does on every instance
+SHARED_PREFIXES = ('ansible/', 'generate_inventory')
+# Roles every instance runs (the plays for all hosts)
+COMMON_ROLES = [role.strip() for role in
+                os.environ.get('GARLC_COMMON_ROLES', 'common').split(',') if role.strip()]
+# Bytes read from the end of an artifact, enough for the central directory of
+# all but the largest repositories (which are downloaded whole instead)
+TAIL_BYTES = int(os.environ.get('GARLC_FINGERPRINT_TAIL_BYTES', '65536'))
+
+# Fingerprints never change, and a fleet has only a few versions applied
+FINGERPRINT_CACHE = TTLCache('fingerprint', os.environ.get('GARLC_FINGERPRINT_CACHE_TTL', '900'))
+
+class TailFile(object):
+    """
+    Read only file holding the last bytes of an object at their offsets in
+    the whole object, which is all zipfile reads to list an archive
+    """
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.start = size - len(data)
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        """Moves to offset"""
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        """Returns the position"""
+        return self.position
+
+    def read(self, size=-1):
+        """Reads from the tail, failing for anything before it"""
+        if self.position < self.start:
+            raise IOError('Only the last %d bytes were read' % len(self.data))
+        end = self.size if size is None or size < 0 else min(self.position + size, self.size)
+        data = self.data[self.position - self.start:end - self.start]
+        self.position += len(data)
+        return data
+
+def list_artifact(bucket, key):
+    """
+    Returns the ZipInfo of every file in an artifact, reading only its end
+    when the central directory fits in TAIL_BYTES
+    """
+    aws_s3 = get_client('s3')
+    tail = call('s3', aws_s3.get_object, Bucket=bucket, Key=key, Range='bytes=-%d' % TAIL_BYTES)
+    data = tail['Body'].read()
+    size = int(tail.get('ContentRange', '/%d' % len(data)).rsplit('/', 1)[1])
+    try:
+        return zipfile.ZipFile(TailFile(data, size)).infolist()
+    except (IOError, zipfile.BadZipfile):
+        LOGGER.info('Central directory of %s is not in its last %d bytes', key, TAIL_BYTES)
+    whole = call('s3', aws_s3.get_object, Bucket=bucket, Key=key)
+    return zipfile.ZipFile(io.BytesIO(whole['Body'].read())).infolist()
+
+def fingerprint(infolist):
+    """
+    Returns the digest of each role and of the shared Ansible files
+    """
+    roles = {}
+    shared = hashlib.sha1()
+    for info in sorted(infolist, key=lambda info: info.filename):
+        name = info.filename
+        if name.endswith('/'):
+            continue
+        entry = ('%s %08x %d\n' % (name, info.CRC, info.file_size)).encode('utf-8')
+        if name.startswith(ROLES_PREFIX) and '/' in name[len(ROLES_PREFIX):]:
+            role = name[len(ROLES_PREFIX):].split('/', 1)[0]
+            roles.setdefault(role, hashlib.sha1()).update(entry)
+        elif name.startswith(SHARED_PREFIXES):
+            shared.update(entry)
+    return {
+        'Roles': dict((role, digest.hexdigest()) for role, digest in roles.items()),
+        'Shared': shared.hexdigest()
+    }
+
+def changed_roles(old, new):
+    """
+    Returns the roles that differ between two fingerprints, or None when
+    files shared by every role differ
+    """
+    if old['Shared'] != new['Shared']:
+        return None
+    return set(role for role in set(old['Roles']) | set(new['Roles'])
+               if old['Roles'].get(role) != new['Roles'].get(role))
+
+def fingerprint_key(version):
+    """
+    Returns the key of the fingerprint of version
+    """
+    return '%s%s.json' % (FINGERPRINT_PREFIX, version)
+
+def read_fingerprint(bucket, version):
+    """
+    Reads the fingerprint of version, or returns None when there is none
+    """
+    try:
+        aws_s3 = get_client('s3')
+        stored = call('s3', aws_s3.get_object, Bucket=bucket, Key=fingerprint_key(version))
+        return json.loads(stored['Body'].read().decode('utf-8'))
+    except ClientError as err:
+        LOGGER.info("No fingerprint of %s: %s", version, err)
+    except (KeyError, TypeError, ValueError) as err:
+        LOGGER.error("Invalid fingerprint of %s!\n%s", version, err)
+    return None
+
+def load_fingerprint(bucket, version):
+    """
+    Returns the fingerprint of version, read once per container
+    """
+    return FINGERPRINT_CACHE.get((bucket, version), lambda: read_fingerprint(bucket, version))
+
+def save_fingerprint(bucket, version, artifact_fingerprint):
+    """
+    Stores the fingerprint of version
+    """
+    aws_s3 = get_client('s3')
+    call('s3', aws_s3.put_object, Bucket=bucket, Key=fingerprint_key(version),
+         Body=json.dumps(artifact_fingerprint, sort_keys=True), ContentType='application/json')
+
+class RoleChanges(object):
+    """
+    The roles an artifact changes for instances at each version applied
+    """
+    def __init__(self, bucket, new):
+        self.bucket = bucket
+        self.new = new
+        self.changes = {}
+
+    @classmethod
+    def for_artifact(cls, bucket, key, version):
+        """
+        Returns the RoleChanges of the artifact at version, fingerprinting
+        and storing it the first time, or None when it cannot be read
+        """
+        new = load_fingerprint(bucket, version)
+        if new is None:
+            try:
+                new = fingerprint(list_artifact(bucket, key))
+                save_fingerprint(bucket, version, new)
+            except (ClientError, IOError, zipfile.BadZipfile, ValueError) as err:
+                LOGGER.error("Failed to fingerprint %s!\n%s", key, err)
+                return None
+        return cls(bucket, new)
+
+    def changed(self, applied):
+        """
+        Returns the roles changed since the applied version, or None when
+        they are not known
+        """
+        if applied not in self.changes:
+            old = load_fingerprint(self.bucket, applied) if applied else None
+            self.changes[applied] = None if old is None else changed_roles(old, self.new)
+        return self.changes[applied]
+
+    def affects(self, applied, roles):
+        """
+        Returns whether an instance with roles, at the applied version, has
+        any role that changed
+        """
+        changed = self.changed(applied)
+        if changed is None:
+            return True
+        return bool(changed & set(list(roles) + COMMON_ROLES))
@@ -0,0 +1,103 @@
+"""
+Plans rolling deployments.  Instances are ordered by their Ansible roles and
+split into waves of at most MaxConcurrent instances (or MaxConcurrentPercent
+of the fleet), and a wave never holds instances from more than one tier of
+WaveOrder.  The plan is kept in the pipeline bucket, as it is too large for a
+continuation token, so every wave of a deployment comes from the same plan.
+"""
+import json
+import logging
+import math
+import os
+from botocore.exceptions import ClientError
+from clients import get_client
+from throttling import call
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Prefix of the objects holding the plan of each rolling deployment
+PLAN_PREFIX = os.environ.get('GARLC_PLAN_PREFIX', 'garlc-deployments/')
+
+def wave_size(instance_count, options):
+    """
+    Returns the number of instances deployed to at once
+    """
+    if options['MaxConcurrent'] > 0:
+        size = options['MaxConcurrent']
+    else:
+        size = int(math.ceil(instance_count * options['MaxConcurrentPercent'] / 100.0))
+    return max(size, 1)
+
+def instance_roles(instance, tag_key):
+    """
+    Returns the roles in the instance's roles tag
+    """
+    for tag in instance.get('Tags', []):
+        if tag['Key'] == tag_key:
+            return [role.strip() for role in tag['Value'].split(',') if role.strip()]
+    return []
+
+def instance_tier(roles, wave_order):
+    """
+    Returns the position in wave_order of the first listed role the instance
+    has, or len(wave_order) when it has none of them
+    """
+    positions = [wave_order.index(role) for role in roles if role in wave_order]
+    return min(positions) if positions else len(wave_order)
+
+def plan_waves(instances, options):
+    """
+    Returns the waves, lists of instance IDs, to deploy to one after another
+    """
+    wave_order = [role.strip() for role in options['WaveOrder'].split(',') if role.strip()]
+    tiers = {}
+    for instance in instances:
+        roles = instance_roles(instance, options['RolesTag'])
+        tiers.setdefault(instance_tier(roles, wave_order), []).append(
+            (','.join(sorted(roles)), instance['InstanceId'])
+        )
+
+    size = wave_size(len(instances), options)
+    waves = []
+    for tier in sorted(tiers):
+        instance_ids = [instance_id for _, instance_id in sorted(tiers[tier])]
+        waves.extend(instance_ids[i:i + size] for i in range(0, len(instance_ids), size))
+    return waves
+
+def plan_key(job_id):
+    """
+    Returns the key of the object holding job_id's plan
+    """
+    return PLAN_PREFIX + str(job_id) + '.json'
+
+def save_plan(bucket, job_id, plan):
+    """
+    Stores job_id's plan in the bucket
+    """
+    aws_s3 = get_client('s3')
+    call(
+        's3', aws_s3.put_object,
+        Bucket=bucket,
+        Key=plan_key(job_id),
+        Body=json.dumps(plan),
+        ContentType='application/json'
+    )
+
+def load_plan(bucket, job_id):
+    """
+    Returns job_id's plan from the bucket
+    """
+    aws_s3 = get_client('s3')
+    plan = call('s3', aws_s3.get_object, Bucket=bucket, Key=plan_key(job_id))
+    return json.loads(plan['Body'].read().decode('utf-8'))
+
+def delete_plan(bucket, job_id):
+    """
+    Removes job_id's plan from the bucket once the deployment has ended
+    """
+    try:
+        aws_s3 = get_client('s3')
+        call('s3', aws_s3.delete_object, Bucket=bucket, Key=plan_key(job_id))
+    except ClientError as err:
+        LOGGER.error("Failed to delete the deployment plan!\n%s", err)
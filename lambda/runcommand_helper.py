@@ -1,50 +1,95 @@
 """
 Triggers Run Command on all instances specified.  This helper function is used
-in order to scale out GARLC.  The function is recursively called in batches
-so AWS Lambda timeout's are avoided.  RunCommand throttling is handled as well.
+in order to scale out GARLC.  Chunks are sent to Run Command concurrently and
+the remaining chunks are handed off to new invocations of this function, one
+or several in parallel, only when the AWS Lambda timeout is about to be hit.
+RunCommand throttling is handled by the throttling module.  Large hand-offs
+refer to a manifest in S3 and each hop only passes the range of chunks left.
+Work for another region or account names its target, which every hop
+sends to.  With a ledger (see ledger.py) every chunk sent is checkpointed,
+so a retried or resumed invocation only sends the chunks that never went
+out, and a failed hand-off is left to Lambda to retry.  Chunks that fail to
+send are recorded where the event says, for tracking to count as failed.
 joshcb@amazon.com
 v1.0.0
 """
 from __future__ import print_function
 import json
 import logging
+import math
+import os
+import time
 from botocore.exceptions import ClientError
-import boto3
+import metrics
+from clients import get_client
+from documents import send_command_args
+from ledger import chunk_key
+from ledger import claim_chunk
+from ledger import get_ledger
+from ledger import record_chunk
+from manifests import load_manifest
+from manifests import manifest_event
+from manifests import save_failure
+from targets import LOCAL_TARGET
+from targets import budget
+from targets import event_target
+from targets import target_client
+from targets import target_event
+from throttling import call
+from tracking import remaining_time_in_millis
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
-def send_run_command(instance_ids, commands):
+# Number of chunks sent to Run Command concurrently
+DISPATCH_WORKERS = int(os.environ.get('GARLC_DISPATCH_WORKERS', '8'))
+# Number of helper functions the remaining chunks are split across on handoff
+HELPER_FANOUT = int(os.environ.get('GARLC_HELPER_FANOUT', '1'))
+# Milliseconds of the invocation kept in reserve for handing off remaining chunks
+HANDOFF_RESERVE_MS = int(os.environ.get('GARLC_HANDOFF_RESERVE_MS', '10000'))
+
+def send_run_command(instance_ids, commands, ssm=None, comment=None, target=LOCAL_TARGET,
+                     ledger=None, deadline=None, owner=None):
     """
-    Tries to queue a RunCommand job.  If a ThrottlingException is encountered
-    recursively calls itself until success.
+    Tries to queue a RunCommand job in target, retrying with backoff while it
+    is throttled, unless the retry would start after deadline (a time.time()
+    value).  An existing SSM client can be passed in so concurrent callers
+    share one.  Commands sent for a CodePipeline job carry a comment
+    naming it so the deployment can be tracked, and with a ledger are only
+    sent once for the job, claimed for owner (the request ID of the
+    invocation sending them).
     """
-    try:
-        ssm = boto3.client('ssm')
-    except ClientError as err:
-        LOGGER.error("Run Command Failed!\n%s", str(err))
-        return False
+    chunk = None
+    if ledger is not None and comment:
+        chunk = claim_chunk(ledger, comment, instance_ids, owner)
+        if chunk is None:
+            metrics.count('ChunksAlreadySent')
+            return True
+
+    if ssm is None:
+        try:
+            ssm = target_client('ssm', target)
+        except ClientError as err:
+            LOGGER.error("Run Command Failed!\n%s", str(err))
+            return False
 
+    kwargs = send_command_args(commands)
+    if comment:
+        kwargs['Comment'] = comment
     try:
-        ssm.send_command(
-            InstanceIds=instance_ids,
-            DocumentName='AWS-RunShellScript',
-            Parameters={
-                'commands': commands,
-                'executionTimeout': ['600'] # Seconds all commands have to complete in
-            }
-        )
+        response = call('ssm', ssm.send_command, deadline=deadline, budget=budget(target),
+                        InstanceIds=instance_ids, **kwargs)
         LOGGER.info('============RunCommand sent successfully')
+        if chunk is not None:
+            record_chunk(ledger, comment, chunk, response['Command']['CommandId'])
         return True
     except ClientError as err:
-        if 'ThrottlingException' in str(err):
-            LOGGER.info("RunCommand throttled, automatically retrying...")
-            send_run_command(instance_ids, commands)
-        else:
-            LOGGER.error("Run Command Failed!\n%s", str(err))
-            return False
+        LOGGER.error("Run Command Failed!\n%s", str(err))
+        if chunk is not None:
+            record_chunk(ledger, comment, chunk)
+        return False
 
-def invoke_lambda(chunks, commands):
+def invoke_lambda(chunks, commands, comment=None, target=LOCAL_TARGET, failures=None):
     """
     Hands off the remaining work to another Lambda function.  This is done
     to avoid hitting AWS Lambda timeouts with a single Lambda function.
@@ -54,48 +99,196 @@ def invoke_lambda(chunks, commands):
         return True
     else:
         try:
-            client = boto3.client('lambda')
+            client = get_client('lambda')
         except ClientError as err:
             # Log the error and keep trying until we timeout
             LOGGER.error("Failed to create a Lambda client!\n%s", err)
-            invoke_lambda(chunks, commands)
+            invoke_lambda(chunks, commands, comment, target, failures)
             return False
 
         event = {
             "ChunkedInstanceIds": chunks,
-            "Commands": commands
+            "Commands": commands,
+            "Comment": comment
         }
-        response = client.invoke_async(
-            FunctionName='garlc_runcommand_helper',
-            InvokeArgs=json.dumps(event)
-        )
+        if target != LOCAL_TARGET:
+            event["Target"] = target_event(target)
+        if failures is not None:
+            event["Failures"] = failures
+        return invoke_helper(event, client)
 
-        if response['Status'] is 202:
-            LOGGER.info('Invoked the next Lambda function to continue...')
-            return True
-        else:
-            LOGGER.error(response)
-            return False
+def invoke_helper(event, client=None):
+    """
+    Invokes another helper function with the event
+    """
+    if client is None:
+        client = get_client('lambda')
+    response = call(
+        'lambda', client.invoke_async,
+        FunctionName='garlc_runcommand_helper',
+        InvokeArgs=json.dumps(event, separators=(',', ':'))
+    )
 
-def handle(event, _context):
+    if response['Status'] == 202:
+        LOGGER.info('Invoked the next Lambda function to continue...')
+        return True
+    else:
+        LOGGER.error(response)
+        return False
+
+def dispatch_chunks(chunks, commands, context, comment=None, target=LOCAL_TARGET):
+    """
+    Sends chunks to Run Command in target concurrently, DISPATCH_WORKERS at a
+    time, until there are none left or the time remaining in this invocation
+    would not cover another batch plus the handoff reserve.  The first batch
+    is always sent, so every invocation makes progress however little time
+    it was given, and throttled sends stop retrying when the reserve is
+    reached.  Returns the chunks that were not sent yet, and those that
+    failed to send.  Every chunk fails when no SSM client can be created
+    for target, as handing them off would only fail again.
+    """
+    try:
+        ssm = target_client('ssm', target)
+    except ClientError as err:
+        LOGGER.error("Failed to create an SSM client!\n%s", err)
+        return [], chunks
+    ledger = get_ledger()
+    # A retry of this invocation has the same request ID, and takes back its claims
+    owner = getattr(context, 'aws_request_id', None)
+
+    # Imported here so invocations that exit early skip loading it.  Threads
+    # rather than multiprocessing, which needs the /dev/shm Lambda lacks.
+    from concurrent.futures import ThreadPoolExecutor
+    executor = ThreadPoolExecutor(DISPATCH_WORKERS)
+    slowest_batch_ms = 0
+    dispatched = False
+    failed = []
+    try:
+        while len(chunks) != 0:
+            remaining_ms = remaining_time_in_millis(context)
+            if remaining_ms is not None and dispatched and \
+                    remaining_ms - HANDOFF_RESERVE_MS < slowest_batch_ms:
+                LOGGER.info('Time budget exhausted with %d chunks remaining', len(chunks))
+                break
+            batch = chunks[:DISPATCH_WORKERS]
+            chunks = chunks[DISPATCH_WORKERS:]
+            started = time.time()
+            deadline = None
+            if remaining_ms is not None:
+                deadline = started + max(remaining_ms - HANDOFF_RESERVE_MS, 0) / 1000.0
+            sent = list(executor.map(
+                lambda instance_ids: send_run_command(instance_ids, commands, ssm, comment,
+                                                      target, ledger, deadline, owner),
+                batch))
+            failed.extend(chunk for chunk, ok in zip(batch, sent) if not ok)
+            slowest_batch_ms = max(slowest_batch_ms, (time.time() - started) * 1000)
+            dispatched = True
+    finally:
+        executor.shutdown()
+    return chunks, failed
+
+def report_failures(failures, failed):
+    """
+    Records each chunk that failed to send where failures says, when it
+    says anywhere
+    """
+    if failures is None or len(failed) == 0:
+        return
+    for instance_ids in failed:
+        try:
+            save_failure(failures, chunk_key(instance_ids), instance_ids)
+        except ClientError as err:
+            LOGGER.error("Failed to record a chunk that failed to send!\n%s", err)
+
+def split_chunks(chunks, parts):
+    """
+    Splits chunks into at most the given number of contiguous parts
+    """
+    size = max(int(math.ceil(len(chunks) / float(max(parts, 1)))), 1)
+    return [chunks[i:i + size] for i in range(0, len(chunks), size)]
+
+def fan_out(chunks, commands, comment=None, target=LOCAL_TARGET, failures=None):
+    """
+    Hands off the remaining chunks to HELPER_FANOUT new helper functions
+    """
+    if len(chunks) == 0:
+        return invoke_lambda(chunks, commands, comment, target, failures)
+    try:
+        results = [invoke_lambda(part, commands, comment, target, failures)
+                   for part in split_chunks(chunks, HELPER_FANOUT)]
+    except ClientError as err:
+        LOGGER.error("Failed to invoke the next Lambda function!\n%s", err)
+        return False
+    return all(results)
+
+def fan_out_manifest(manifest, start, end):
+    """
+    Hands off chunks start to end of a manifest to HELPER_FANOUT new helper
+    functions, passing only the manifest reference and their ranges
+    """
+    if start >= end:
+        LOGGER.info('No more chunks of instances to process')
+        return True
+    size = max(int(math.ceil((end - start) / float(max(HELPER_FANOUT, 1)))), 1)
+    try:
+        results = [invoke_helper(manifest_event(manifest['Bucket'], manifest['Key'],
+                                                i, min(i + size, end)))
+                   for i in range(start, end, size)]
+    except ClientError as err:
+        LOGGER.error("Failed to invoke the next Lambda function!\n%s", err)
+        return False
+    return all(results)
+
+def read_event(event):
+    """
+    Returns the chunks, commands, comment, target and where failures are
+    recorded of an event, reading them from the manifest the event refers to
+    when they are not passed inline
+    """
+    if 'Manifest' in event:
+        manifest = load_manifest(event['Manifest']['Bucket'], event['Manifest']['Key'])
+        if event.get('End') is None:
+            event['End'] = len(manifest['ChunkedInstanceIds'])
+        chunked_instance_ids = manifest['ChunkedInstanceIds'][event['Start']:event['End']]
+        return chunked_instance_ids, manifest['Commands'], manifest.get('Comment'), \
+            event_target(manifest.get('Target')), manifest.get('Failures')
+    return event['ChunkedInstanceIds'], event['Commands'], event.get('Comment'), \
+        event_target(event.get('Target')), event.get('Failures')
+
+@metrics.instrument('runcommand_helper')
+def handle(event, context):
     """
     Lambda main handler
     """
     LOGGER.info(event)
     try:
-        chunked_instance_ids = event['ChunkedInstanceIds']
+        chunked_instance_ids, commands, comment, target, failures = read_event(event)
         LOGGER.debug('==========Chunks remaining:')
         LOGGER.debug(len(chunked_instance_ids))
-        commands = event['Commands']
-    except (TypeError, KeyError) as err:
+    except (TypeError, KeyError, ValueError, AttributeError) as err:
         LOGGER.error("Could not parse event!\n%s", err)
         return False
+    except ClientError as err:
+        LOGGER.error("Could not read the manifest!\n%s", err)
+        return False
 
-    # We work on one chunk at a time until there are no more chunks left.
-    # Each chunk is handled by a new AWS Lambda function.
-    instance_ids = chunked_instance_ids.pop(0)
-    LOGGER.debug('==========Instances in this chunk:')
-    LOGGER.debug(instance_ids)
-    send_run_command(instance_ids, commands)
-    invoke_lambda(chunked_instance_ids, commands)
+    # We send as many chunks as this function has time for and hand off the
+    # rest to new AWS Lambda functions.
+    metrics.count('Chunks', len(chunked_instance_ids))
+    with metrics.span('Dispatch'):
+        remaining_chunks, failed_chunks = dispatch_chunks(chunked_instance_ids, commands,
+                                                          context, comment, target)
+    metrics.count('ChunksFailed', len(failed_chunks))
+    report_failures(failures, failed_chunks)
+    metrics.count('ChunksHandedOff', len(remaining_chunks))
+    with metrics.span('Handoff'):
+        if 'Manifest' in event:
+            # Only the range still to send goes to the next helpers
+            handed_off = fan_out_manifest(event['Manifest'],
+                                          event['End'] - len(remaining_chunks), event['End'])
+        else:
+            handed_off = fan_out(remaining_chunks, commands, comment, target, failures)
+    if not handed_off and comment and get_ledger() is not None:
+        # Lambda retries the invocation, which skips the chunks already sent
+        raise RuntimeError('Failed to hand off %d chunks' % len(remaining_chunks))
     return True
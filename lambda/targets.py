@@ -0,0 +1,117 @@
+"""
+The regions and accounts a deployment reaches.  By default GARLC deploys to
+the instances in its own region and account.  The Targets option lists
+others, each a region and optionally a role to assume there, so a single
+pipeline job finds and deploys to every one of them at the same time.  Each
+target gets its own clients and its own throttling budget, since AWS rate
+limits apply per account and region.
+"""
+import collections
+import json
+import os
+from clients import get_client
+
+# A region (None for this function's own) and a role to assume in another
+# account (None to use this function's own role)
+Target = collections.namedtuple('Target', ['region', 'role_arn'])
+
+LOCAL_TARGET = Target(None, None)
+
+STRING_TYPES = (str, type(u''))
+
+# Targets discovered, handed off to and tracked at the same time
+TARGET_WORKERS = int(os.environ.get('GARLC_TARGET_WORKERS', '8'))
+
+def parse_target(value):
+    """
+    Returns the Target of a region name or a {"Region": ..., "RoleArn": ...}
+    object
+    """
+    if isinstance(value, dict):
+        unknown = set(value) - set(['Region', 'RoleArn'])
+        if unknown:
+            raise ValueError('Unknown target keys: %s' % ', '.join(sorted(unknown)))
+        return Target(value.get('Region') or None, value.get('RoleArn') or None)
+    if isinstance(value, STRING_TYPES):
+        return Target(value.strip() or None, None)
+    raise ValueError('Invalid target: %r' % (value,))
+
+def parse_targets(value):
+    """
+    Returns the Targets of the Targets option, a list (or its JSON) of
+    targets or a comma separated list of regions, in order and once each.
+    An empty option means this function's own region and account.
+    """
+    if isinstance(value, STRING_TYPES):
+        value = value.strip()
+        if value.startswith('['):
+            value = json.loads(value)
+        else:
+            value = [region for region in value.split(',') if region.strip()]
+    if not isinstance(value, list):
+        raise ValueError('Targets must be a list, not %r' % (value,))
+    targets = []
+    for target in [parse_target(item) for item in value] or [LOCAL_TARGET]:
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+def is_local(targets):
+    """
+    Returns True when targets are only this function's region and account
+    """
+    return list(targets) == [LOCAL_TARGET]
+
+def target_name(target):
+    """
+    Returns the name of a target for logs and summaries, e.g.
+    123456789012/eu-west-1
+    """
+    region = target.region or os.environ.get('AWS_REGION', 'local')
+    if target.role_arn:
+        return '%s/%s' % (target.role_arn.split(':')[4], region)
+    return region
+
+def budget(target):
+    """
+    Returns the name of the throttling budget calls to target draw from,
+    None for the one shared with this function's own region and account
+    """
+    if target.role_arn is None and target.region in (None, os.environ.get('AWS_REGION')):
+        return None
+    return target_name(target)
+
+def target_client(service, target):
+    """
+    Returns the client for service in target
+    """
+    return get_client(service, target.region, target.role_arn)
+
+def target_event(target):
+    """
+    Returns target as it is passed in events and manifests, None for the
+    local target
+    """
+    if target == LOCAL_TARGET:
+        return None
+    return {'Region': target.region, 'RoleArn': target.role_arn}
+
+def event_target(value):
+    """
+    Returns the Target passed in an event or manifest
+    """
+    if not value:
+        return LOCAL_TARGET
+    return Target(value.get('Region'), value.get('RoleArn'))
+
+def map_targets(func, targets):
+    """
+    Returns [func(target) for target in targets], calling func for up to
+    TARGET_WORKERS targets at a time
+    """
+    if len(targets) <= 1:
+        return [func(target) for target in targets]
+    # Imported here so single target deployments skip loading it
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(min(len(targets), max(TARGET_WORKERS, 1))) as executor:
+        return list(executor.map(func, targets))
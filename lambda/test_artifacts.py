@@ -0,0 +1,128 @@
+"""
+Unit Tests for the artifacts module
+"""
+import json
+import pytest
+from mock import patch, MagicMock
+from botocore.exceptions import ClientError
+from artifacts import split_s3_url
+from artifacts import record_latest_artifact
+from artifacts import read_latest_artifact
+from artifacts import read_latest_pointer
+from artifacts import artifact_version
+from artifacts import LATEST_ARTIFACT_KEY
+
+def pointer(body):
+    """
+    Returns a GetObject response holding body
+    """
+    return {'Body': MagicMock(read=MagicMock(return_value=body))}
+
+def test_split_s3_url():
+    """
+    Test split_s3_url splits the bucket from the key
+    """
+    assert split_s3_url('s3://bucket/GARLC/MyApp/abc') == ('bucket', 'GARLC/MyApp/abc')
+    with pytest.raises(ValueError):
+        split_s3_url('https://bucket/key')
+    with pytest.raises(ValueError):
+        split_s3_url('s3://bucket')
+
+@patch('boto3.client')
+def test_record_latest_artifact(mock_client):
+    """
+    Test record_latest_artifact writes the pointer into the artifact's bucket
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    assert record_latest_artifact('s3://bucket/GARLC/MyApp/abc', 'job') is True
+    kwargs = aws_s3.put_object.call_args[1]
+    assert kwargs['Bucket'] == 'bucket'
+    assert kwargs['Key'] == LATEST_ARTIFACT_KEY
+    assert json.loads(kwargs['Body']) == {'Artifact': 's3://bucket/GARLC/MyApp/abc', 'JobId': 'job'}
+
+@patch('boto3.client')
+def test_record_latest_artifact_with_commands(mock_client):
+    """
+    Test the pointer carries the artifact's version and deploy commands, and
+    reads back whole
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    assert record_latest_artifact('s3://bucket/key', 'job', 'abc', ['echo deploy']) is True
+    body = aws_s3.put_object.call_args[1]['Body']
+    aws_s3.get_object.return_value = pointer(body.encode('utf-8'))
+    assert read_latest_pointer('bucket') == {
+        'Artifact': 's3://bucket/key', 'JobId': 'job', 'Version': 'abc',
+        'Commands': ['echo deploy']
+    }
+
+@patch('boto3.client')
+def test_record_latest_artifact_with_clienterror(mock_client):
+    """
+    Test record_latest_artifact returns False when the pointer can't be written
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.put_object.side_effect = ClientError(
+        {'Error': {'Code': 'AccessDenied', 'Message': 'Denied'}}, 'PutObject'
+    )
+    assert record_latest_artifact('s3://bucket/key') is False
+
+@patch('boto3.client')
+def test_read_latest_artifact(mock_client):
+    """
+    Test read_latest_artifact returns the artifact the pointer refers to
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.return_value = pointer(b'{"Artifact": "s3://bucket/key", "JobId": "job"}')
+    assert read_latest_artifact('bucket') == 's3://bucket/key'
+    aws_s3.get_object.assert_called_once_with(Bucket='bucket', Key=LATEST_ARTIFACT_KEY)
+
+@patch('boto3.client')
+def test_read_latest_artifact_without_pointer(mock_client):
+    """
+    Test read_latest_artifact returns None when there is no pointer
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.side_effect = ClientError(
+        {'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, 'GetObject'
+    )
+    assert read_latest_artifact('bucket') is None
+
+@patch('boto3.client')
+def test_read_latest_artifact_with_invalid_pointer(mock_client):
+    """
+    Test read_latest_artifact returns None for a pointer it can't parse
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    for body in (b'not json', b'{"JobId": "job"}', b'{"Artifact": "bucket/key"}'):
+        aws_s3.get_object.return_value = pointer(body)
+        assert read_latest_artifact('bucket') is None
+
+@patch('boto3.client')
+def test_artifact_version(mock_client):
+    """
+    Test artifact_version returns the artifact's ETag without its quotes
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.head_object.return_value = {'ETag': '"9b2cf535f27731c974343645a3985328-2"'}
+    assert artifact_version('s3://bucket/GARLC/MyApp/abc') == \
+        '9b2cf535f27731c974343645a3985328-2'
+    aws_s3.head_object.assert_called_once_with(Bucket='bucket', Key='GARLC/MyApp/abc')
+
+@patch('boto3.client')
+def test_artifact_version_with_clienterror(mock_client):
+    """
+    Test artifact_version returns None when the artifact can't be read
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.head_object.side_effect = ClientError(
+        {'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject'
+    )
+    assert artifact_version('s3://bucket/key') is None
@@ -1,6 +1,9 @@
 """
 Unit Tests for trigger_run_command Lambda function
 """
+import datetime
+import json
+import pytest
 from mock import patch, MagicMock
 from aws_lambda_sample_events import SampleEvent
 from botocore.exceptions import ClientError
@@ -11,6 +14,11 @@ from bootstrap import get_instance_id
 from bootstrap import resources_exist
 from bootstrap import send_run_command
 from bootstrap import handle
+from bootstrap import invalidate_caches
+from bootstrap import get_batch_instance_ids
+from bootstrap import find_garlc_instances
+from bootstrap import pending_instance_ids
+from bootstrap import find_latest_deployment
 
 @patch('boto3.client')
 def test_find_bucket(mock_client):
@@ -29,6 +37,23 @@ def test_find_bucket(mock_client):
     codepipeline.get_pipeline.return_value = pipeline_object
     assert find_bucket() == 'blah'
 
+@patch('boto3.client')
+def test_find_bucket_is_cached(mock_client):
+    """
+    test find_bucket looks the bucket up once until the caches are invalidated
+    """
+    codepipeline = MagicMock()
+    mock_client.return_value = codepipeline
+    codepipeline.get_pipeline.return_value = {
+        'pipeline': {'artifactStore': {'location': 'blah'}}
+    }
+    assert find_bucket() == 'blah'
+    assert find_bucket() == 'blah'
+    assert codepipeline.get_pipeline.call_count == 1
+    invalidate_caches()
+    assert find_bucket() == 'blah'
+    assert codepipeline.get_pipeline.call_count == 2
+
 @patch('boto3.client')
 def test_find_bucket_with_typeerror(mock_client):
     """
@@ -66,12 +91,13 @@ def test_find_bucket_with_clienterror(mock_client):
 @patch('boto3.client')
 def test_is_a_garlc_instance(mock_client):
     """
-    Test is_a_garlc_instance returns true when EC2 API Call
-    returns a string
+    Test is_a_garlc_instance returns true when EC2 returns the instance
     """
     ec2 = MagicMock()
     mock_client.return_value = ec2
-    ec2.describe_instances.return_value = "instance"
+    ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': [{'InstanceId': 'instance'}]}]
+    }
     assert is_a_garlc_instance("instance") is True
 
 @patch('boto3.client')
@@ -81,8 +107,11 @@ def test_is_a_garlc_instance_except_when_its_not(mock_client):
     """
     ec2 = MagicMock()
     mock_client.return_value = ec2
-    ec2.describe_instances.return_value = ""
+    ec2.describe_instances.return_value = {'Reservations': []}
     assert is_a_garlc_instance("instance") is False
+    filters = ec2.describe_instances.call_args[1]['Filters']
+    assert {'Name': 'tag:has_ssm_agent', 'Values': ['true', 'True']} in filters
+    assert {'Name': 'instance-id', 'Values': ['instance']} in filters
 
 @patch('boto3.client')
 def test_is_a_garlc_instance_with_clienterror(mock_client):
@@ -98,6 +127,8 @@ def test_is_a_garlc_instance_with_clienterror(mock_client):
     mock_client.side_effect = ClientError(err_msg, 'sad response')
     assert is_a_garlc_instance('foo') is False
 
+NO_POINTER = ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, 'GetObject')
+
 @patch('boto3.client')
 def test_find_newest_artifact(mock_client):
     """
@@ -106,15 +137,83 @@ def test_find_newest_artifact(mock_client):
     bucket_objects = {
         "Contents": [
             {
-                "Key": "blah",
-                "LastModified": "datetime.datetime(2016, 3, 18, 19, 20, 29, tzinfo=tzutc())"
+                "Key": "GARLC/MyApp/old",
+                "LastModified": datetime.datetime(2016, 3, 17, 19, 20, 29)
+            },
+            {
+                "Key": "GARLC/MyApp/blah",
+                "LastModified": datetime.datetime(2016, 3, 18, 19, 20, 29)
             }
         ]
     }
     aws_s3 = MagicMock()
     mock_client.return_value = aws_s3
-    aws_s3.list_objects.return_value = bucket_objects
-    assert find_newest_artifact('blah') == 's3://blah/blah'
+    aws_s3.get_object.side_effect = NO_POINTER
+    aws_s3.list_objects_v2.return_value = bucket_objects
+    assert find_newest_artifact('blah') == 's3://blah/GARLC/MyApp/blah'
+    aws_s3.list_objects_v2.assert_called_once_with(Bucket='blah', Prefix='GARLC/')
+
+@patch('boto3.client')
+def test_find_newest_artifact_is_cached(mock_client):
+    """
+    test find_newest_artifact shares its result per bucket
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.return_value = {
+        'Body': MagicMock(read=MagicMock(return_value=b'{"Artifact": "s3://blah/GARLC/new"}'))
+    }
+    assert find_newest_artifact('blah') == 's3://blah/GARLC/new'
+    assert find_newest_artifact('blah') == 's3://blah/GARLC/new'
+    assert aws_s3.get_object.call_count == 1
+    find_newest_artifact('other')
+    assert aws_s3.get_object.call_count == 2
+
+@patch('boto3.client')
+def test_find_newest_artifact_across_pages(mock_client):
+    """
+    test find_newest_artifact keeps the newest artifact across listing pages
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.side_effect = NO_POINTER
+    aws_s3.list_objects_v2.side_effect = [
+        {
+            "Contents": [{"Key": "GARLC/a", "LastModified": datetime.datetime(2016, 3, 18)}],
+            "IsTruncated": True,
+            "NextContinuationToken": "page-2"
+        },
+        {
+            "Contents": [{"Key": "GARLC/b", "LastModified": datetime.datetime(2016, 3, 19)}],
+            "IsTruncated": False
+        }
+    ]
+    assert find_newest_artifact('blah') == 's3://blah/GARLC/b'
+    assert aws_s3.list_objects_v2.call_args[1]['ContinuationToken'] == 'page-2'
+
+@patch('boto3.client')
+def test_find_newest_artifact_from_pointer(mock_client):
+    """
+    test find_newest_artifact uses the latest artifact pointer without listing
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.return_value = {
+        'Body': MagicMock(read=MagicMock(return_value=b'{"Artifact": "s3://blah/GARLC/new"}'))
+    }
+    assert find_newest_artifact('blah') == 's3://blah/GARLC/new'
+    assert aws_s3.list_objects_v2.call_count == 0
+
+@patch('boto3.client')
+def test_find_newest_artifact_with_empty_bucket(mock_client):
+    """
+    test find_newest_artifact returns false when there are no artifacts
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.side_effect = NO_POINTER
+    aws_s3.list_objects_v2.return_value = {"KeyCount": 0}
+    assert find_newest_artifact('blah') is False
 
 @patch('boto3.client')
 def test_find_newest_artifact_with_keyerror(mock_client):
@@ -124,13 +223,14 @@ def test_find_newest_artifact_with_keyerror(mock_client):
     bucket_objects = {
         "Contents": [
             {
-                "LastModified": "datetime.datetime(2016, 3, 18, 19, 20, 29, tzinfo=tzutc())"
+                "LastModified": datetime.datetime(2016, 3, 18, 19, 20, 29)
             }
         ]
     }
     aws_s3 = MagicMock()
     mock_client.return_value = aws_s3
-    aws_s3.list_objects.return_value = bucket_objects
+    aws_s3.get_object.side_effect = NO_POINTER
+    aws_s3.list_objects_v2.return_value = bucket_objects
     assert find_newest_artifact('blah') is False
 
 @patch('boto3.client')
@@ -208,7 +308,7 @@ def test_send_run_command_with_clienterror(mock_client):
         }
     }
     mock_client.side_effect = ClientError(err_msg, 'blah')
-    assert send_run_command('blah', 'blah') is False
+    assert send_run_command(['blah'], 'blah') is False
 
 @patch('boto3.client')
 def test_send_run_command_with_clienterror_during_send_command(mock_client):
@@ -224,13 +324,13 @@ def test_send_run_command_with_clienterror_during_send_command(mock_client):
     ssm = MagicMock()
     mock_client.return_value = ssm
     ssm.send_command.side_effect = ClientError(err_msg, 'blah')
-    assert send_run_command('blah', 'blah') is False
+    assert send_run_command(['blah'], 'blah') is False
 
-@patch('bootstrap.send_run_command')
+@patch('throttling.sleep')
 @patch('boto3.client')
-def test_send_run_command_with_throttlingexception(mock_client, mock_run_command):
+def test_send_run_command_with_throttlingexception(mock_client, mock_sleep):
     """
-    Test the send_run_command function with a ThrottlingException
+    Test the send_run_command function retries after a ThrottlingException
     """
     err_msg = {
         'Error': {
@@ -240,11 +340,29 @@ def test_send_run_command_with_throttlingexception(mock_client, mock_run_command
     }
     ssm = MagicMock()
     mock_client.return_value = ssm
+    ssm.send_command.side_effect = [ClientError(err_msg, 'blah'), True]
+    assert send_run_command(['blah'], 'blah') is True
+    assert ssm.send_command.call_count == 2
+
+@patch('throttling.sleep')
+@patch('boto3.client')
+def test_send_run_command_when_always_throttled(mock_client, mock_sleep):
+    """
+    Test the send_run_command function gives up once retries are exhausted
+    """
+    err_msg = {
+        'Error': {
+            'Code': 'ThrottlingException',
+            'Message': 'Rate exceeded'
+        }
+    }
+    ssm = MagicMock()
+    mock_client.return_value = ssm
     ssm.send_command.side_effect = ClientError(err_msg, 'blah')
-    assert send_run_command('blah', 'blah') is not False
+    assert send_run_command(['blah'], 'blah') is False
 
 @patch('bootstrap.send_run_command')
-@patch('bootstrap.find_newest_artifact')
+@patch('bootstrap.find_latest_deployment')
 @patch('bootstrap.is_a_garlc_instance')
 @patch('bootstrap.find_bucket')
 def test_handle(mock_find_bucket, mock_is_instance, mock_artifact, mock_ssm):
@@ -254,16 +372,18 @@ def test_handle(mock_find_bucket, mock_is_instance, mock_artifact, mock_ssm):
     event = SampleEvent('cloudwatch_events')
     mock_find_bucket.return_value = 'buckette'
     mock_is_instance.return_value = True
-    mock_artifact.return_value = 's3://blah/blah.zip'
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
     mock_ssm.return_value = True
     assert handle(event.event, 'blah') is True
 
+@patch('bootstrap.is_a_garlc_instance')
 @patch('bootstrap.find_bucket')
-def test_handle_with_invalid_bucket(mock_find_bucket):
+def test_handle_with_invalid_bucket(mock_find_bucket, mock_is_instance):
     """
     Test the handle function with invalid bucket
     """
     event = SampleEvent('cloudwatch_events')
+    mock_is_instance.return_value = True
     mock_find_bucket.return_value = ''
     assert handle(event.event, 'blah') is False
 
@@ -275,3 +395,247 @@ def test_handle_with_invalid_event(mock_find_bucket):
     event = 'blah'
     mock_find_bucket.return_value = 'buckette'
     assert handle(event, 'blah') is False
+
+@patch('bootstrap.find_bucket')
+def test_handle_with_invalid_event_skips_lookups(mock_find_bucket):
+    """
+    Test the handle function exits before any AWS call with an invalid event
+    """
+    assert handle('blah', 'blah') is False
+    assert mock_find_bucket.call_count == 0
+
+def queued_event(instance_id):
+    """
+    Returns an SQS record holding the launch event of instance_id
+    """
+    event = SampleEvent('cloudwatch_events').event
+    event['detail']['instance-id'] = instance_id
+    return {'body': json.dumps(event)}
+
+def test_get_batch_instance_ids():
+    """
+    test get_batch_instance_ids skips duplicates and unparseable records
+    """
+    records = [queued_event('i-1'), {'body': 'blah'}, queued_event('i-2'), queued_event('i-1')]
+    assert get_batch_instance_ids(records) == ['i-1', 'i-2']
+
+@patch('boto3.client')
+def test_find_garlc_instances(mock_client):
+    """
+    test find_garlc_instances returns the tagged subset in launch order
+    """
+    ec2 = MagicMock()
+    mock_client.return_value = ec2
+    ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': [{'InstanceId': 'i-3'}, {'InstanceId': 'i-1'}]}]
+    }
+    assert find_garlc_instances(['i-1', 'i-2', 'i-3']) == ['i-1', 'i-3']
+    assert ec2.describe_instances.call_count == 1
+
+@patch('boto3.client')
+def test_find_garlc_instances_in_batches(mock_client):
+    """
+    test find_garlc_instances filters on at most 200 instances per call and
+    follows NextToken
+    """
+    ec2 = MagicMock()
+    mock_client.return_value = ec2
+    ec2.describe_instances.side_effect = [
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-0'}]}], 'NextToken': 'page-2'},
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-199'}]}]},
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-200'}]}]}
+    ]
+    assert find_garlc_instances(['i-%d' % i for i in range(250)]) == ['i-0', 'i-199', 'i-200']
+    assert ec2.describe_instances.call_count == 3
+    assert ec2.describe_instances.call_args_list[1][1]['NextToken'] == 'page-2'
+    assert len(ec2.describe_instances.call_args[1]['Filters'][-1]['Values']) == 50
+
+@patch('bootstrap.send_run_command')
+@patch('bootstrap.find_latest_deployment')
+@patch('bootstrap.find_garlc_instances')
+@patch('bootstrap.find_bucket')
+def test_handle_batch(mock_find_bucket, mock_garlc_instances, mock_artifact, mock_ssm):
+    """
+    Test the handle function sends one Run Command per 50 queued instances
+    """
+    instance_ids = ['i-%d' % i for i in range(60)]
+    mock_find_bucket.return_value = 'buckette'
+    mock_garlc_instances.side_effect = lambda ids, versions: ids[:-1]
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
+    mock_ssm.return_value = True
+    event = {'Records': [queued_event(instance_id) for instance_id in instance_ids]}
+    assert handle(event, 'blah') is True
+    mock_garlc_instances.assert_called_once_with(instance_ids, {})
+    assert [len(args[0]) for args, _ in mock_ssm.call_args_list] == [50, 9]
+
+@patch('boto3.client')
+def test_find_garlc_instances_with_versions(mock_client):
+    """
+    test find_garlc_instances stores the version each instance has applied
+    """
+    ec2 = MagicMock()
+    mock_client.return_value = ec2
+    ec2.describe_instances.return_value = {'Reservations': [{'Instances': [
+        {'InstanceId': 'i-1', 'Tags': [{'Key': 'GARLC_Version', 'Value': 'abc'}]},
+        {'InstanceId': 'i-2', 'Tags': [{'Key': 'has_ssm_agent', 'Value': 'true'}]}
+    ]}]}
+    versions = {}
+    assert find_garlc_instances(['i-1', 'i-2'], versions) == ['i-1', 'i-2']
+    assert versions == {'i-1': 'abc'}
+
+@patch('bootstrap.artifact_version')
+def test_pending_instance_ids(mock_version):
+    """
+    Test pending_instance_ids leaves out instances at the artifact's version
+    and only looks the version up when an instance has applied one
+    """
+    mock_version.return_value = 'abc'
+    assert pending_instance_ids(['i-1', 'i-2'], {}, 's3://blah/blah.zip') == ['i-1', 'i-2']
+    assert mock_version.call_count == 0
+    versions = {'i-1': 'abc', 'i-2': 'old'}
+    assert pending_instance_ids(['i-1', 'i-2'], versions, 's3://blah/blah.zip') == ['i-2']
+    with patch('bootstrap.FORCE', True):
+        assert pending_instance_ids(['i-1'], versions, 's3://blah/blah.zip') == ['i-1']
+    assert pending_instance_ids(['i-1', 'i-2'], versions, 's3://blah/blah.zip', 'old') == ['i-1']
+    assert mock_version.call_count == 1
+
+@patch('bootstrap.send_run_command')
+@patch('bootstrap.artifact_version')
+@patch('bootstrap.find_latest_deployment')
+@patch('bootstrap.find_bucket')
+@patch('boto3.client')
+def test_handle_with_applied_instance(mock_client, mock_find_bucket, mock_artifact,
+                                      mock_version, mock_ssm):
+    """
+    Test the handle function sends nothing to a restarted instance that has
+    already applied the newest artifact
+    """
+    mock_client.return_value.describe_instances.return_value = {'Reservations': [{
+        'Instances': [{'InstanceId': 'i-1', 'Tags': [{'Key': 'GARLC_Version', 'Value': 'abc'}]}]
+    }]}
+    mock_find_bucket.return_value = 'buckette'
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
+    mock_version.return_value = 'abc'
+    assert handle({'detail': {'instance-id': 'i-1'}}, 'blah') is True
+    assert mock_ssm.call_count == 0
+
+@patch('bootstrap.send_run_command')
+@patch('bootstrap.find_latest_deployment')
+@patch('bootstrap.find_garlc_instances')
+@patch('bootstrap.find_bucket')
+def test_handle_batch_without_garlc_instances(mock_find_bucket, mock_garlc_instances,
+                                              mock_artifact, mock_ssm):
+    """
+    Test the handle function sends nothing when no queued instance is GARLC enabled
+    """
+    mock_find_bucket.return_value = 'buckette'
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
+    mock_garlc_instances.return_value = []
+    assert handle({'Records': [queued_event('i-1')]}, 'blah') is False
+    assert mock_ssm.call_count == 0
+
+@patch('bootstrap.send_run_command')
+@patch('bootstrap.find_latest_deployment')
+@patch('bootstrap.find_garlc_instances')
+@patch('bootstrap.find_bucket')
+def test_handle_batch_with_failed_send(mock_find_bucket, mock_garlc_instances, mock_artifact,
+                                      mock_ssm):
+    """
+    Test the handle function raises, so SQS delivers the batch again, when a
+    Run Command call fails
+    """
+    mock_find_bucket.return_value = 'buckette'
+    mock_garlc_instances.side_effect = lambda ids, versions: ids
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
+    mock_ssm.side_effect = [True, False]
+    event = {'Records': [queued_event('i-%d' % i) for i in range(60)]}
+    with pytest.raises(RuntimeError):
+        handle(event, 'blah')
+    assert mock_ssm.call_count == 2
+
+@patch('bootstrap.send_run_command')
+@patch('bootstrap.find_latest_deployment')
+@patch('bootstrap.find_garlc_instances')
+@patch('bootstrap.find_bucket')
+def test_handle_batch_without_deployment(mock_find_bucket, mock_garlc_instances, mock_artifact,
+                                         mock_ssm):
+    """
+    Test the handle function raises when no deployment is found, or a lookup
+    fails, rather than dropping the batch
+    """
+    mock_find_bucket.return_value = 'buckette'
+    mock_garlc_instances.side_effect = lambda ids, versions: ids
+    mock_artifact.return_value = False
+    with pytest.raises(RuntimeError):
+        handle({'Records': [queued_event('i-1')]}, 'blah')
+    mock_garlc_instances.side_effect = ClientError(
+        {'Error': {'Code': 'RequestLimitExceeded', 'Message': ''}}, 'DescribeInstances')
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
+    with pytest.raises(ClientError):
+        handle({'Records': [queued_event('i-1')]}, 'blah')
+    assert mock_ssm.call_count == 0
+
+@patch('bootstrap.find_bucket')
+def test_handle_batch_with_invalid_records(mock_find_bucket):
+    """
+    Test the handle function skips lookups when no record holds an instance
+    """
+    assert handle({'Records': [{'body': 'blah'}]}, 'blah') is False
+    assert mock_find_bucket.call_count == 0
+
+@patch('bootstrap.send_run_command')
+@patch('bootstrap.find_latest_deployment')
+@patch('bootstrap.find_bucket')
+@patch('boto3.client')
+def test_handle_with_untagged_instance(mock_client, mock_find_bucket, mock_artifact, mock_ssm):
+    """
+    Test the handle function sends nothing to an instance without the
+    has_ssm_agent tag
+    """
+    mock_client.return_value.describe_instances.return_value = {'Reservations': []}
+    mock_find_bucket.return_value = 'buckette'
+    mock_artifact.return_value = {'Artifact': 's3://blah/blah.zip'}
+    event = SampleEvent('cloudwatch_events')
+    assert handle(event.event, 'blah') is False
+    assert mock_ssm.call_count == 0
+
+@patch('boto3.client')
+def test_find_latest_deployment(mock_client):
+    """
+    test find_latest_deployment returns the commands recorded with the newest
+    artifact, and builds them for an artifact found by listing the bucket
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.return_value = {'Body': MagicMock(read=MagicMock(return_value=json.dumps(
+        {'Artifact': 's3://blah/GARLC/new', 'Version': 'abc', 'Commands': ['echo new']}
+    ).encode('utf-8')))}
+    assert find_latest_deployment('blah') == {
+        'Artifact': 's3://blah/GARLC/new', 'Version': 'abc', 'Commands': ['echo new']}
+    aws_s3.get_object.side_effect = NO_POINTER
+    aws_s3.list_objects_v2.return_value = {
+        'Contents': [{'Key': 'GARLC/old', 'LastModified': datetime.datetime(2016, 3, 18)}]
+    }
+    assert find_latest_deployment('other') == {'Artifact': 's3://other/GARLC/old'}
+
+@patch('bootstrap.VALIDATE_INSTANCES', False)
+@patch('bootstrap.PIPELINE_BUCKET', 'buckette')
+@patch('boto3.client')
+def test_handle_fast_path(mock_client):
+    """
+    Test the handle function goes from the event straight to SendCommand
+    with the commands the main function recorded, once they are cached
+    """
+    aws = mock_client.return_value
+    aws.get_object.return_value = {'Body': MagicMock(read=MagicMock(return_value=json.dumps(
+        {'Artifact': 's3://buckette/GARLC/new', 'Commands': ['echo new']}
+    ).encode('utf-8')))}
+    event = {'detail': {'instance-id': 'i-1'}}
+    assert handle({'Prewarm': True}, 'blah') is True
+    assert handle(event, 'blah') is True
+    assert handle(event, 'blah') is True
+    assert aws.get_object.call_count == 1
+    assert aws.get_pipeline.call_count == 0
+    assert aws.describe_instances.call_count == 0
+    assert aws.send_command.call_count == 2
+    assert aws.send_command.call_args[1]['Parameters']['commands'] == ['echo new']
@@ -0,0 +1,66 @@
+"""
+Unit Tests for the cache module
+"""
+from mock import patch, MagicMock
+import cache
+from cache import TTLCache
+from cache import reset_all
+
+@patch('cache.time.time')
+def test_get_caches_until_expiry(mock_time):
+    """
+    Test values are loaded once and reloaded after the TTL
+    """
+    mock_time.return_value = 100.0
+    ttl_cache = TTLCache('test', 10)
+    loader = MagicMock(side_effect=['first', 'second'])
+    assert ttl_cache.get('key', loader) == 'first'
+    mock_time.return_value = 109.0
+    assert ttl_cache.get('key', loader) == 'first'
+    mock_time.return_value = 111.0
+    assert ttl_cache.get('key', loader) == 'second'
+    assert loader.call_count == 2
+    assert (ttl_cache.hits, ttl_cache.misses) == (1, 2)
+
+def test_get_does_not_cache_failures():
+    """
+    Test falsy values are retried on the next call
+    """
+    ttl_cache = TTLCache('test', 10)
+    loader = MagicMock(side_effect=[False, 'value'])
+    assert ttl_cache.get('key', loader) is False
+    assert ttl_cache.get('key', loader) == 'value'
+
+def test_get_with_zero_ttl():
+    """
+    Test a TTL of 0 disables caching
+    """
+    ttl_cache = TTLCache('test', 0)
+    loader = MagicMock(return_value='value')
+    ttl_cache.get('key', loader)
+    ttl_cache.get('key', loader)
+    assert loader.call_count == 2
+
+def test_invalidate():
+    """
+    Test invalidate forgets a single key or every key
+    """
+    ttl_cache = TTLCache('test', 10)
+    ttl_cache.get('a', lambda: 'a')
+    ttl_cache.get('b', lambda: 'b')
+    ttl_cache.invalidate('a')
+    assert ttl_cache.get('a', lambda: 'new a') == 'new a'
+    assert ttl_cache.get('b', lambda: 'new b') == 'b'
+    ttl_cache.invalidate()
+    assert ttl_cache.get('b', lambda: 'new b') == 'new b'
+
+def test_reset_all():
+    """
+    Test reset_all empties every cache and zeroes its counters
+    """
+    ttl_cache = TTLCache('test', 10)
+    ttl_cache.get('a', lambda: 'a')
+    reset_all()
+    assert ttl_cache in cache.CACHES
+    assert (ttl_cache.hits, ttl_cache.misses) == (0, 0)
+    assert ttl_cache.get('a', lambda: 'new a') == 'new a'
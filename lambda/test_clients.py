@@ -0,0 +1,73 @@
+"""
+Unit Tests for the clients module
+"""
+from mock import patch, MagicMock
+import clients
+from clients import get_client
+from clients import set_client
+from clients import reset
+
+@patch('boto3.client')
+def test_get_client_is_reused(mock_client):
+    """
+    Test a client is created once per service and region
+    """
+    mock_client.side_effect = lambda *args, **kwargs: MagicMock()
+    assert get_client('ssm') is get_client('ssm')
+    assert get_client('ssm') is not get_client('ssm', 'us-west-2')
+    assert get_client('ssm') is not get_client('ec2')
+    assert mock_client.call_count == 3
+
+@patch('boto3.client')
+def test_get_client_config(mock_client):
+    """
+    Test clients are created with the shared connection pool size
+    """
+    get_client('ssm', 'eu-west-1')
+    _, kwargs = mock_client.call_args
+    assert kwargs['region_name'] == 'eu-west-1'
+    assert kwargs['config'].max_pool_connections == clients.MAX_POOL_CONNECTIONS
+
+@patch('boto3.client')
+def test_set_client(mock_client):
+    """
+    Test an injected client is returned instead of a new one
+    """
+    ssm = MagicMock()
+    set_client('ssm', ssm)
+    assert get_client('ssm') is ssm
+    assert mock_client.call_count == 0
+
+@patch('boto3.client')
+def test_reset(mock_client):
+    """
+    Test reset forgets existing clients
+    """
+    mock_client.side_effect = lambda *args, **kwargs: MagicMock()
+    ssm = get_client('ssm')
+    reset()
+    assert get_client('ssm') is not ssm
+
+@patch('clients.time.time')
+@patch('boto3.session.Session')
+@patch('boto3.client')
+def test_get_client_with_role(mock_client, mock_session, mock_time):
+    """
+    Test clients for a role use its assumed credentials, which are renewed
+    before they expire
+    """
+    mock_time.return_value = 1000.0
+    sts = MagicMock()
+    mock_client.return_value = sts
+    sts.assume_role.return_value = {'Credentials': {
+        'AccessKeyId': 'id', 'SecretAccessKey': 'secret', 'SessionToken': 'token'}}
+    mock_session.side_effect = lambda **kwargs: MagicMock()
+    role_arn = 'arn:aws:iam::123456789012:role/garlc_target_role'
+    ssm = get_client('ssm', 'eu-west-1', role_arn)
+    assert get_client('ssm', 'eu-west-1', role_arn) is ssm
+    assert sts.assume_role.call_args[1]['RoleArn'] == role_arn
+    assert mock_session.call_args[1]['aws_session_token'] == 'token'
+
+    mock_time.return_value += clients.ROLE_SESSION_SECONDS - clients.ROLE_RENEW_SECONDS
+    assert get_client('ssm', 'eu-west-1', role_arn) is not ssm
+    assert sts.assume_role.call_count == 2
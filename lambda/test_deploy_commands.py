@@ -0,0 +1,136 @@
+"""
+Unit Tests for the deploy_commands module
+"""
+from mock import patch
+from deploy_commands import command_options
+from deploy_commands import instance_region
+from deploy_commands import ssm_commands
+from deploy_commands import INSTANCE_ID
+from deploy_commands import INSTANCE_REGION
+
+ARTIFACT = 's3://bucket/test/key'
+
+def test_ssm_commands():
+    """
+    Test the ssm_commands function
+    """
+    commands = ssm_commands(ARTIFACT, command_options(region='instance'))
+    assert commands[0] == 'export AWS_DEFAULT_REGION=' + INSTANCE_REGION
+    assert commands[2] == "etag=`aws s3api head-object --bucket bucket --key 'test/key' " \
+        "--query ETag --output text | tr -dc '[:alnum:]-'`"
+    assert commands[4] == 'artifact=/var/cache/garlc/$etag'
+    assert "aws s3 cp 's3://bucket/test/key' $incoming.zip --quiet" in commands[5]
+    assert commands[8] == 'ls -1dt /var/cache/garlc/*/ | tail -n +6 | xargs -r rm -rf'
+    assert commands[9] == \
+        'bash $artifact/generate_inventory_file.sh --output "/tmp/inventory" --tag Ansible_Roles'
+    assert commands[10] == \
+        'ansible-playbook -i "/tmp/inventory" $artifact/ansible/playbook.yml || exit $?'
+    assert commands[11] == 'echo $etag > /var/cache/garlc/applied'
+    assert commands[12] == 'aws ec2 create-tags --resources ' + INSTANCE_ID + \
+        ' --tags Key=GARLC_Version,Value=$etag || true'
+
+@patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy')
+def test_ssm_commands_with_document():
+    """
+    Test the ssm_commands function only passes the artifact to the deploy
+    document when one is configured
+    """
+    assert ssm_commands(ARTIFACT) == {
+        'DocumentName': 'GARLC-Deploy',
+        'Parameters': {'artifact': ['s3://bucket/test/key']}
+    }
+
+def test_ssm_commands_options():
+    """
+    Test the ssm_commands function applies the cache and Ansible options,
+    without tagging the instance when the version tag is ''
+    """
+    commands = ssm_commands(ARTIFACT, command_options(
+        cache_dir='/opt/garlc', cache_versions=2, ansible_args='--forks 1', version_tag=''
+    ))
+    assert commands[4] == 'artifact=/opt/garlc/$etag'
+    assert commands[8] == 'ls -1dt /opt/garlc/*/ | tail -n +3 | xargs -r rm -rf'
+    assert commands[-2] == \
+        'ansible-playbook -i "/tmp/inventory" $artifact/ansible/playbook.yml --forks 1 || exit $?'
+    assert commands[-1] == 'echo $etag > /opt/garlc/applied'
+
+def test_ssm_commands_partial():
+    """
+    Test the ssm_commands function only runs the changed roles of a partial
+    deployment
+    """
+    commands = ssm_commands(ARTIFACT, command_options(partial=True))
+    assert commands[7] == 'applied=`cat /var/cache/garlc/applied 2>/dev/null`'
+    assert commands[8].startswith('tags=; if [ -n "$applied" ]')
+    assert commands[12] == 'ansible-playbook -i "/tmp/inventory" ' \
+        '$artifact/ansible/playbook.yml${tags:+ --tags $tags} || exit $?'
+
+@patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy')
+def test_ssm_commands_partial_with_document():
+    """
+    Test the ssm_commands function asks the deploy document for a partial
+    deployment
+    """
+    assert ssm_commands(ARTIFACT, command_options(partial=True))['Parameters'] == {
+        'artifact': ['s3://bucket/test/key'], 'partialDeploy': ['true']
+    }
+
+@patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy')
+def test_ssm_commands_options_with_document():
+    """
+    Test the ssm_commands function passes the cache, region, Ansible and
+    version tag options to the deploy document
+    """
+    assert ssm_commands(ARTIFACT, command_options(cache_versions=2, version_tag=''))[
+        'Parameters'] == {
+            'artifact': ['s3://bucket/test/key'], 'cacheVersions': ['2'], 'versionTag': ['']
+        }
+    assert ssm_commands(ARTIFACT, command_options(
+        cache_dir='/opt/garlc', region='eu-west-1', roles_tag='Roles', ansible_args='--forks 1'
+    ))['Parameters'] == {
+        'artifact': ['s3://bucket/test/key'], 'cacheDir': ['/opt/garlc'],
+        'region': ['eu-west-1'], 'rolesTag': ['Roles'], 'ansibleArgs': ['--forks 1']
+    }
+
+def test_ssm_commands_timeouts():
+    """
+    Test the ssm_commands function runs the commands with the timeouts in
+    the options, inline or in the deploy document
+    """
+    assert isinstance(ssm_commands(ARTIFACT), list)
+    options = command_options(execution_timeout=1800, delivery_timeout=3600)
+    shell = ssm_commands(ARTIFACT, options)
+    assert shell['DocumentName'] == 'AWS-RunShellScript'
+    assert shell['Parameters']['executionTimeout'] == ['1800']
+    assert shell['Parameters']['commands'][0].startswith('export AWS_DEFAULT_REGION=')
+    assert shell['TimeoutSeconds'] == 3600
+    with patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy'):
+        document = ssm_commands(ARTIFACT, options)
+    assert document['Parameters'] == {'artifact': ['s3://bucket/test/key'],
+                                      'executionTimeout': ['1800']}
+    assert document['TimeoutSeconds'] == 3600
+
+@patch.dict('os.environ', {'GARLC_EXECUTION_TIMEOUT': '1200', 'GARLC_DELIVERY_TIMEOUT': '60'})
+def test_command_options_timeouts():
+    """
+    Test the timeouts are read from the environment
+    """
+    options = command_options()
+    assert (options.execution_timeout, options.delivery_timeout) == (1200, 60)
+
+@patch.dict('os.environ', {'AWS_REGION': 'eu-west-1'})
+def test_instance_region():
+    """
+    Test instance_region only looks the region up on the instance when it
+    is not known here
+    """
+    assert instance_region(command_options(region='lambda')) == 'eu-west-1'
+    assert instance_region(command_options(region='us-east-2')) == 'us-east-2'
+    assert instance_region(command_options(region='instance')) == INSTANCE_REGION
+
+@patch.dict('os.environ', clear=True)
+def test_instance_region_unknown():
+    """
+    Test instance_region falls back to the instance outside Lambda
+    """
+    assert instance_region(command_options(region='lambda')) == INSTANCE_REGION
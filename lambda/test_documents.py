@@ -0,0 +1,68 @@
+"""
+Unit Tests for the documents module
+"""
+from mock import patch
+from documents import deploy_document
+from documents import send_command_args
+from documents import shell_document
+
+def test_deploy_document_disabled():
+    """
+    Test deploy_document returns None when no document is configured
+    """
+    assert deploy_document('s3://bucket/artifact.zip') is None
+
+@patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy')
+def test_deploy_document():
+    """
+    Test deploy_document only passes the artifact, and the parameters not at
+    their defaults
+    """
+    assert deploy_document('s3://bucket/artifact.zip') == {
+        'DocumentName': 'GARLC-Deploy',
+        'Parameters': {'artifact': ['s3://bucket/artifact.zip']}
+    }
+    assert deploy_document('s3://bucket/artifact.zip', {
+        'cacheVersions': '5', 'versionTag': 'Version'
+    })['Parameters'] == {'artifact': ['s3://bucket/artifact.zip'], 'versionTag': ['Version']}
+
+@patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy')
+def test_deploy_document_timeouts():
+    """
+    Test deploy_document passes timeouts other than the defaults
+    """
+    document = deploy_document('s3://bucket/artifact.zip', {'executionTimeout': '1800'}, 3600)
+    assert document['Parameters'] == {'artifact': ['s3://bucket/artifact.zip'],
+                                      'executionTimeout': ['1800']}
+    assert document['TimeoutSeconds'] == 3600
+    assert 'TimeoutSeconds' not in deploy_document('s3://bucket/artifact.zip',
+                                                   {'executionTimeout': '600'}, 900)
+
+@patch('documents.DEPLOY_DOCUMENT', 'GARLC-Deploy')
+@patch('documents.DEPLOY_DOCUMENT_VERSION', '3')
+def test_deploy_document_version():
+    """
+    Test deploy_document pins the configured version
+    """
+    assert deploy_document('s3://bucket/artifact.zip')['DocumentVersion'] == '3'
+
+def test_send_command_args():
+    """
+    Test send_command_args runs shell commands with AWS-RunShellScript and
+    documents as they are, with the default timeouts unless they say
+    otherwise
+    """
+    assert send_command_args(['blah']) == {
+        'DocumentName': 'AWS-RunShellScript',
+        'Parameters': {'commands': ['blah'], 'executionTimeout': ['600']},
+        'TimeoutSeconds': 900
+    }
+    document = {'DocumentName': 'GARLC-Deploy', 'Parameters': {'artifact': ['s3://b/a']}}
+    assert send_command_args(document) == dict(document, TimeoutSeconds=900)
+    assert 'TimeoutSeconds' not in document
+    shell = shell_document(['blah'], 1200, 300)
+    assert send_command_args(shell) == {
+        'DocumentName': 'AWS-RunShellScript',
+        'Parameters': {'commands': ['blah'], 'executionTimeout': ['1200']},
+        'TimeoutSeconds': 300
+    }
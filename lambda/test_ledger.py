@@ -0,0 +1,135 @@
+"""
+Unit Tests for the ledger module
+"""
+import sqlite3
+import pytest
+from botocore.exceptions import ClientError
+from mock import patch, MagicMock
+import clients
+import ledger
+from ledger import DynamoDBStore
+from ledger import SQLiteStore
+from ledger import chunk_key
+from ledger import claim_chunk
+from ledger import get_ledger
+from ledger import record_chunk
+
+def test_sqlite_store(tmpdir):
+    """
+    Test a chunk is claimed once, until it fails or its claim runs out
+    """
+    store = SQLiteStore(str(tmpdir.join('ledger.db')))
+    assert store.claim('job', 'a', 1000.0)
+    assert not store.claim('job', 'a', 1001.0)
+    assert store.claim('job', 'a', 1001.0 + ledger.CLAIM_SECONDS)
+    store.record('job', 'a', ledger.FAILED, None, 1200.0)
+    assert store.claim('job', 'a', 1201.0)
+    store.record('job', 'a', ledger.SENT, 'c-1', 1202.0)
+    assert not store.claim('job', 'a', 1202.0 + ledger.CLAIM_SECONDS * 2)
+    assert store.claim('other job', 'a', 1203.0)
+    assert store.chunks('job') == {'a': {'Status': 'Sent', 'CommandId': 'c-1'}}
+
+def test_sqlite_store_reclaimed_by_owner(tmpdir):
+    """
+    Test the request that claimed a chunk may claim it again at once, and
+    no other request can
+    """
+    store = SQLiteStore(str(tmpdir.join('ledger.db')))
+    assert store.claim('job', 'a', 1000.0, 'request-1')
+    assert store.claim('job', 'a', 1001.0, 'request-1')
+    assert not store.claim('job', 'a', 1002.0, 'request-2')
+    assert not store.claim('job', 'a', 1002.0)
+    store.record('job', 'a', ledger.SENT, 'c-1', 1003.0)
+    assert not store.claim('job', 'a', 1004.0, 'request-1')
+
+def test_sqlite_store_is_shared(tmpdir):
+    """
+    Test claims are seen by every process using the database
+    """
+    path = str(tmpdir.join('ledger.db'))
+    assert SQLiteStore(path).claim('job', 'a', 1000.0)
+    assert not SQLiteStore(path).claim('job', 'a', 1000.0)
+
+def test_dynamodb_store():
+    """
+    Test claims are conditional writes and a failed condition means the
+    chunk is taken
+    """
+    dynamodb = MagicMock()
+    clients.set_client('dynamodb', dynamodb)
+    store = DynamoDBStore('ledger')
+    assert store.claim('job', 'a', 1000.0)
+    kwargs = dynamodb.put_item.call_args[1]
+    assert kwargs['Item']['Status'] == {'S': 'Claimed'}
+    assert kwargs['ExpressionAttributeValues'][':expired'] == \
+        {'N': repr(1000.0 - ledger.CLAIM_SECONDS)}
+    dynamodb.put_item.side_effect = ClientError(
+        {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}, 'PutItem')
+    assert not store.claim('job', 'a', 1001.0)
+    dynamodb.put_item.side_effect = None
+    store.record('job', 'a', 'Sent', 'c-1', 1002.0)
+    assert dynamodb.put_item.call_args[1]['Item']['CommandId'] == {'S': 'c-1'}
+    assert 'ConditionExpression' not in dynamodb.put_item.call_args[1]
+
+def test_dynamodb_store_owner():
+    """
+    Test claims name their owner, who may claim the chunk again at once
+    """
+    dynamodb = MagicMock()
+    clients.set_client('dynamodb', dynamodb)
+    assert DynamoDBStore('ledger').claim('job', 'a', 1000.0, 'request-1')
+    kwargs = dynamodb.put_item.call_args[1]
+    assert kwargs['Item']['Owner'] == {'S': 'request-1'}
+    assert kwargs['ConditionExpression'].endswith('OR (#status = :claimed AND #owner = :owner)')
+    assert kwargs['ExpressionAttributeNames']['#owner'] == 'Owner'
+    assert kwargs['ExpressionAttributeValues'][':owner'] == {'S': 'request-1'}
+
+def test_dynamodb_store_chunks():
+    """
+    Test the chunks of a deployment are read across pages
+    """
+    dynamodb = MagicMock()
+    clients.set_client('dynamodb', dynamodb)
+    dynamodb.query.side_effect = [
+        {'Items': [{'Chunk': {'S': 'a'}, 'Status': {'S': 'Sent'}, 'CommandId': {'S': 'c-1'}}],
+         'LastEvaluatedKey': {'Chunk': {'S': 'a'}}},
+        {'Items': [{'Chunk': {'S': 'b'}, 'Status': {'S': 'Claimed'}}]}
+    ]
+    assert DynamoDBStore('ledger').chunks('job') == {
+        'a': {'Status': 'Sent', 'CommandId': 'c-1'},
+        'b': {'Status': 'Claimed', 'CommandId': None}
+    }
+    assert dynamodb.query.call_args[1]['ExclusiveStartKey'] == {'Chunk': {'S': 'a'}}
+
+def test_claim_and_record_chunk(tmpdir):
+    """
+    Test chunks are keyed by their instances and recorded with their command
+    """
+    store = SQLiteStore(str(tmpdir.join('ledger.db')))
+    chunk = claim_chunk(store, 'job', ['i-1', 'i-2'])
+    assert chunk == chunk_key(['i-1', 'i-2'])
+    assert claim_chunk(store, 'job', ['i-1', 'i-2']) is None
+    record_chunk(store, 'job', chunk, 'c-1')
+    assert store.chunks('job')[chunk]['CommandId'] == 'c-1'
+
+def test_claim_chunk_when_ledger_fails():
+    """
+    Test a ledger that can't be reached does not hold up the deployment
+    """
+    store = MagicMock()
+    store.claim.side_effect = sqlite3.OperationalError('locked')
+    store.record.side_effect = sqlite3.OperationalError('locked')
+    assert claim_chunk(store, 'job', ['i-1']) == chunk_key(['i-1'])
+    record_chunk(store, 'job', chunk_key(['i-1']))
+
+@patch.dict('ledger.LEDGERS', clear=True)
+def test_get_ledger(tmpdir):
+    """
+    Test ledgers are opened once from their spec
+    """
+    assert get_ledger('') is None
+    spec = 'sqlite:' + str(tmpdir.join('ledger.db'))
+    assert get_ledger(spec) is get_ledger(spec)
+    assert isinstance(get_ledger('dynamodb:ledger'), DynamoDBStore)
+    with pytest.raises(ValueError):
+        get_ledger('redis:ledger')
@@ -1,19 +1,33 @@
 """
 Unit Tests for trigger_run_command Lambda function
 """
+import json
+import time
 import pytest
-import boto3
 from botocore.exceptions import ClientError
 from mock import MagicMock, patch
 from main import find_artifact
-from main import ssm_commands
 from main import codepipeline_success
 from main import codepipeline_failure
-from main import find_instances
+from main import stream_chunks
 from main import handle
 from main import execute_runcommand
 from main import find_instance_ids
-from freezegun import freeze_time
+from main import get_options
+from main import chunk_size
+from main import break_instance_ids_into_chunks
+from main import break_instance_groups_into_chunks
+from main import group_instances_by_tag
+from main import chunk_instances
+from main import pending_instances
+from main import DEFAULT_OPTIONS
+from manifests import manifest_key
+from targets import LOCAL_TARGET
+from targets import Target
+from tracking import Progress
+from tracking import encode_state
+from tracking import new_state
+from tracking import TRACKING_TIMEOUT_SECONDS
 from aws_lambda_sample_events import SampleEvent
 
 def test_find_artifact():
@@ -32,23 +46,6 @@ def test_find_artifact_invalid():
     with pytest.raises(KeyError):
         assert find_artifact(event) == 'blah'
 
-@freeze_time('2016-01-01')
-def test_ssm_commands():
-    """
-    Test the ssm_commands function
-    """
-    artifact = 'bucket/test/key'
-    commands = [
-        'export AWS_DEFAULT_REGION=`curl -s http://169.254.169.254/' \
-        "latest/dynamic/instance-identity/document | grep region | awk -F\\\" '{print $4}'`",
-        'aws configure set s3.signature_version s3v4',
-        'aws s3 cp bucket/test/key /tmp/20160101000000.zip --quiet',
-        'unzip -qq /tmp/20160101000000.zip -d /tmp/20160101000000',
-        'bash /tmp/20160101000000/generate_inventory_file.sh',
-        'ansible-playbook -i "/tmp/inventory" /tmp/20160101000000/ansible/playbook.yml'
-    ]
-    assert ssm_commands(artifact) == commands
-
 @patch('boto3.client')
 def test_codepipeline_success(mock_client):
     """
@@ -101,19 +98,26 @@ def test_codepipeline_failure_with_exception(mock_client):
     codepipeline.put_job_failure_result.side_effect = ClientError(err_msg, 'Test')
     assert codepipeline_failure(1, 'blah') is False
 
-@patch('main.find_instance_ids')
-def test_find_instances(mock_instances):
+@patch('boto3.client')
+def test_stream_chunks(mock_client):
     """
-    Test the find_instances function without errors
+    Test stream_chunks chunks each DescribeInstances page on its own
     """
-    instances = ['abcdef-12345']
-    mock_instances.return_value = instances
-    assert find_instances() == instances
+    ec2 = MagicMock()
+    mock_client.return_value = ec2
+    ec2.describe_instances.side_effect = [
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]}],
+         'NextToken': 'page-2'},
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-3'}]}]}
+    ]
+    options = dict(DEFAULT_OPTIONS, ChunkSize=1, PageSize=2)
+    assert list(stream_chunks(options)) == [(2, [['i-1'], ['i-2']]), (1, [['i-3']])]
+    assert ec2.describe_instances.call_args[1]['MaxResults'] == 2
 
-@patch('boto3.resource')
-def test_find_instances_boto_error(mock_client):
+@patch('boto3.client')
+def test_stream_chunks_boto_error(mock_client):
     """
-    Test the find_instances function when a boto exception occurs
+    Test stream_chunks raises a boto exception, even one on a later page
     """
     err_msg = {
         'Error': {
@@ -122,53 +126,503 @@ def test_find_instances_boto_error(mock_client):
         }
     }
     mock_client.side_effect = ClientError(err_msg, 'Test')
-    assert find_instances() == []
+    with pytest.raises(ClientError):
+        list(stream_chunks(DEFAULT_OPTIONS))
 
-@patch('boto3.resources.collection.ResourceCollection.filter')
-def test_find_instance_ids(mock_resource):
+    ec2 = MagicMock()
+    mock_client.side_effect = None
+    mock_client.return_value = ec2
+    ec2.describe_instances.side_effect = [
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}]}], 'NextToken': 'page-2'},
+        ClientError({'Error': {'Code': 'InternalError', 'Message': 'Boom!'}},
+                    'DescribeInstances')
+    ]
+    chunks = stream_chunks(dict(DEFAULT_OPTIONS, PageSize=1))
+    assert next(chunks) == (1, [['i-1']])
+    with pytest.raises(ClientError):
+        next(chunks)
+
+@patch('boto3.client')
+def test_find_instance_ids(mock_client):
     """
     Test the find_instance_ids function
     """
     instance_id = 'abcdef-12345'
-    instance = [MagicMock(id=instance_id)]
-    boto3.setup_default_session(region_name='us-east-1')
-    mock_resource.return_value = instance
+    ec2 = MagicMock()
+    mock_client.return_value = ec2
+    ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': [{'InstanceId': instance_id}]}]
+    }
     assert find_instance_ids('blah') == [instance_id]
+    ec2.describe_instances.assert_called_once_with(
+        Filters='blah', MaxResults=DEFAULT_OPTIONS['PageSize']
+    )
 
+@patch('boto3.client')
+def test_find_instance_ids_with_pages(mock_client):
+    """
+    Test find_instance_ids follows NextToken across pages
+    """
+    ec2 = MagicMock()
+    mock_client.return_value = ec2
+    ec2.describe_instances.side_effect = [
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}]}],
+         'NextToken': 'page-2'},
+        {'Reservations': [{'Instances': [{'InstanceId': 'i-3'}]}]}
+    ]
+    assert find_instance_ids('blah') == ['i-1', 'i-2', 'i-3']
+    assert ec2.describe_instances.call_args[1]['NextToken'] == 'page-2'
+
+def test_get_options_defaults():
+    """
+    Test get_options without UserParameters or environment overrides
+    """
+    codepipeline = SampleEvent('codepipeline')
+    assert get_options(codepipeline.event) == DEFAULT_OPTIONS
+
+@patch.dict('os.environ', {'GARLC_CHUNK_SIZE': '10', 'GARLC_CHUNK_STRATEGY': 'group'})
+def test_get_options_with_user_parameters():
+    """
+    Test get_options prefers UserParameters over environment variables
+    """
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = '{"TargetConcurrency": "4", "ChunkSize": 20}'
+    options = get_options(codepipeline.event)
+    assert options['ChunkSize'] == 20
+    assert options['TargetConcurrency'] == 4
+    assert options['ChunkStrategy'] == 'group'
+
+def test_get_options_with_invalid_user_parameters():
+    """
+    Test get_options falls back to defaults on unparseable input
+    """
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = '{"ChunkSize": "blah"'
+    assert get_options(codepipeline.event) == DEFAULT_OPTIONS
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = '{"ChunkSize": "blah"}'
+    assert get_options(codepipeline.event) == DEFAULT_OPTIONS
+
+def test_chunk_size():
+    """
+    Test chunk_size spreads the fleet across the target concurrency and
+    stays within the SendCommand limit
+    """
+    options = dict(DEFAULT_OPTIONS, TargetConcurrency=10)
+    assert chunk_size(0, options) == 1
+    assert chunk_size(5, options) == 1
+    assert chunk_size(101, options) == 11
+    assert chunk_size(3000, options) == 50
+    assert chunk_size(3000, dict(options, ChunkSize=3)) == 3
+    assert chunk_size(3000, dict(options, ChunkSize=500)) == 50
+
+def test_break_instance_ids_into_chunks():
+    """
+    Test break_instance_ids_into_chunks with an explicit size
+    """
+    assert break_instance_ids_into_chunks([1, 2, 3, 4, 5], 2) == [[1, 2], [3, 4], [5]]
+    assert break_instance_ids_into_chunks([], 2) == []
+
+def test_break_instance_groups_into_chunks():
+    """
+    Test break_instance_groups_into_chunks never mixes groups
+    """
+    groups = {'b': [1, 2, 3], 'a': [4]}
+    assert break_instance_groups_into_chunks(groups, 2) == [[4], [1, 2], [3]]
+
+def test_group_instances_by_tag():
+    """
+    Test group_instances_by_tag keys instances by tag value
+    """
+    instances = [
+        {'InstanceId': 'i-1', 'Tags': [{'Key': 'Rollout_Group', 'Value': 'canary'}]},
+        {'InstanceId': 'i-2', 'Tags': [{'Key': 'Name', 'Value': 'web'}]},
+        {'InstanceId': 'i-3'}
+    ]
+    assert group_instances_by_tag(instances, 'Rollout_Group') == \
+        {'canary': ['i-1'], '': ['i-2', 'i-3']}
+
+def test_chunk_instances():
+    """
+    Test chunk_instances follows the ChunkStrategy option
+    """
+    instances = [
+        {'InstanceId': 'i-1', 'Tags': [{'Key': 'Rollout_Group', 'Value': 'a'}]},
+        {'InstanceId': 'i-2', 'Tags': [{'Key': 'Rollout_Group', 'Value': 'b'}]},
+        {'InstanceId': 'i-3', 'Tags': [{'Key': 'Rollout_Group', 'Value': 'a'}]}
+    ]
+    options = dict(DEFAULT_OPTIONS, ChunkSize=2)
+    assert chunk_instances(instances, options) == [['i-1', 'i-2'], ['i-3']]
+    options['ChunkStrategy'] = 'group'
+    assert chunk_instances(instances, options) == [['i-1', 'i-3'], ['i-2']]
+
+def test_pending_instances():
+    """
+    Test pending_instances leaves out the instances tagged with the version
+    """
+    instances = [
+        {'InstanceId': 'i-1', 'Tags': [{'Key': 'GARLC_Version', 'Value': 'abc'}]},
+        {'InstanceId': 'i-2', 'Tags': [{'Key': 'GARLC_Version', 'Value': 'old'}]},
+        {'InstanceId': 'i-3'}
+    ]
+    pending = pending_instances(instances, DEFAULT_OPTIONS, 'abc')
+    assert [instance['InstanceId'] for instance in pending] == ['i-2', 'i-3']
+    assert pending_instances(instances, DEFAULT_OPTIONS, None) == instances
+
+def test_pending_instances_with_role_changes():
+    """
+    Test pending_instances leaves out the instances none of whose roles changed
+    """
+    instances = [
+        {'InstanceId': 'i-1', 'Tags': [{'Key': 'Ansible_Roles', 'Value': 'webserver'}]},
+        {'InstanceId': 'i-2', 'Tags': [{'Key': 'Ansible_Roles', 'Value': 'dbserver'}]}
+    ]
+    changes = MagicMock()
+    changes.affects.side_effect = lambda applied, roles: 'webserver' in roles
+    pending = pending_instances(instances, DEFAULT_OPTIONS, 'abc', changes)
+    assert [instance['InstanceId'] for instance in pending] == ['i-1']
+
+@patch('main.artifact_version')
+@patch('main.record_latest_artifact')
+@patch('main.codepipeline_continue')
+@patch('main.execute_runcommand')
+@patch('main.find_artifact')
+@patch('main.ssm_commands')
+@patch('main.stream_chunks')
+def test_handle(mock_chunks, mock_commands, mock_artifact, mock_run_command,
+                mock_continue, mock_record, mock_version):
+    """
+    Test the handle function hands off every page of instances, and keeps
+    the artifact's version to record for bootstrap once the deployment ends
+    """
+    mock_chunks.return_value = iter([(2, [['i-1'], ['i-2']]), (1, [['i-3']])])
+    mock_version.return_value = 'abc'
+    mock_commands.return_value = ['blah']
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    mock_run_command.return_value = True
+    mock_continue.return_value = True
+    codepipeline = SampleEvent('codepipeline')
+    assert handle(codepipeline.event, 'Test')
+    job_id = codepipeline.event['CodePipeline.job']['id']
+    comment = 'GARLC ' + job_id
+    assert mock_run_command.call_args_list[0][0] == (
+        [['i-1'], ['i-2']], ['blah'], comment, ('bucket', manifest_key(job_id, 0)))
+    assert mock_run_command.call_args_list[1][0] == (
+        [['i-3']], ['blah'], comment, ('bucket', manifest_key(job_id, 1)))
+    # The artifact is recorded for bootstrap once the deployment succeeds
+    assert mock_record.call_count == 0
+    token = json.loads(mock_continue.call_args[0][1])
+    assert token['Version'] == 'abc'
+    assert token['Instances'] == 3
+    assert token['Manifests'] == 2
+    assert token['JobId'] == job_id
+
+@patch('main.artifact_version')
+@patch('main.record_latest_artifact')
 @patch('main.codepipeline_success')
 @patch('main.execute_runcommand')
 @patch('main.find_artifact')
 @patch('main.ssm_commands')
-@patch('main.find_instances')
-def test_handle(mock_instances, mock_commands, mock_artifact, mock_run_command,
-                mock_success):
+@patch('main.stream_chunks')
+def test_handle_without_tracking(mock_chunks, mock_commands, mock_artifact,
+                                 mock_run_command, mock_success, mock_record, _mock_version):
     """
-    Test the handle function with valid input and instances
+    Test the handle function succeeds straight away when TrackResults is 0
     """
-    mock_instances.return_value = ['abcdef-12345']
-    mock_commands.return_value = True
-    mock_artifact.return_value = True
+    mock_chunks.return_value = iter([(1, [['i-1']])])
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    mock_run_command.return_value = True
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = '{"TrackResults": 0}'
+    assert handle(codepipeline.event, 'Test')
+    mock_success.assert_called_once_with(codepipeline.event['CodePipeline.job']['id'])
+    assert mock_record.call_args[0][:2] == ('s3://bucket/GARLC/MyApp/artifact.zip',
+                                            codepipeline.event['CodePipeline.job']['id'])
+
+@patch('main.artifact_version')
+@patch('main.record_latest_artifact')
+@patch('main.codepipeline_continue')
+@patch('main.execute_runcommand')
+@patch('main.find_artifact')
+@patch('main.stream_chunks')
+def test_handle_across_targets(mock_chunks, mock_artifact, mock_run_command, mock_continue,
+                               _mock_record, _mock_version):
+    """
+    Test the handle function hands off the instances of every target, with
+    commands exporting the target's region, and tracks them as one deployment
+    """
+    remote = Target('eu-west-1', 'arn:aws:iam::123456789012:role/garlc_target_role')
+    pages = {LOCAL_TARGET: [(2, [['i-1', 'i-2']])], remote: [(1, [['i-3']]), (1, [])]}
+    mock_chunks.side_effect = lambda options, versions, target: iter(pages[target])
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    _mock_version.return_value = 'abc'
     mock_run_command.return_value = True
-    mock_success.return_value = True
     codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = json.dumps({'Targets': [
+            '', {'Region': remote.region, 'RoleArn': remote.role_arn}]})
     assert handle(codepipeline.event, 'Test')
+    sent = dict((call[1]['target'], call[0]) for call in mock_run_command.call_args_list)
+    assert sent[LOCAL_TARGET][0] == [['i-1', 'i-2']]
+    assert sent[remote][0] == [['i-3']]
+    assert sent[remote][1][0] == 'export AWS_DEFAULT_REGION=eu-west-1'
+    assert sorted(key for _, _, _, (_, key) in sent.values()) == sorted(
+        manifest_key(codepipeline.event['CodePipeline.job']['id'], part) for part in (0, 1))
+    token = json.loads(mock_continue.call_args[0][1])
+    assert token['Instances'] == 3
+    assert token['Targets'] == [2, 1]
+    assert token['Manifests'] == 2
 
+@patch('main.artifact_version')
+@patch('main.codepipeline_success')
+@patch('main.codepipeline_continue')
+@patch('main.codepipeline_failure')
+@patch('main.execute_runcommand')
+@patch('main.find_artifact')
+@patch('main.stream_chunks')
+def test_handle_with_unlisted_target(mock_chunks, mock_artifact, mock_run_command,
+                                     mock_failure, mock_continue, mock_success,
+                                     _mock_version):
+    """
+    Test the handle function fails the job, naming the target, when the role
+    of one target cannot be assumed, after handing off the other targets
+    """
+    remote = Target('eu-west-1', 'arn:aws:iam::123456789012:role/garlc_target_role')
+
+    def pages(_options, _versions, target):
+        """Lists the local target, and fails to assume the remote role"""
+        if target == remote:
+            raise ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Boom!'}},
+                              'AssumeRole')
+        yield 1, [['i-1']]
+    mock_chunks.side_effect = pages
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    mock_run_command.return_value = True
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = json.dumps({'Targets': [
+            '', {'Region': remote.region, 'RoleArn': remote.role_arn}]})
+    assert handle(codepipeline.event, 'Test') is False
+    assert mock_run_command.call_count == 1
+    assert mock_failure.call_args[0][1] == \
+        'Failed to list the instances in 123456789012/eu-west-1!'
+    assert mock_continue.call_count == 0
+    assert mock_success.call_count == 0
+
+@patch('main.codepipeline_failure')
+def test_handle_with_invalid_targets(mock_failure):
+    """
+    Test the handle function fails the job when Targets can't be read
+    """
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = '{"Targets": [{"Region": "eu-west-1", "Arn": ""}]}'
+    assert handle(codepipeline.event, 'Test') is False
+    assert mock_failure.call_args[0][1].startswith('Invalid Targets')
+
+def continuation_event(token):
+    """
+    Returns a CodePipeline event handing back a job with token
+    """
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['continuationToken'] = token
+    return codepipeline.event
+
+@patch('main.record_artifact')
+@patch('main.codepipeline_success')
+@patch('main.poll')
+def test_handle_continuation_when_deployment_succeeded(mock_poll, mock_success, mock_record):
+    """
+    Test the handle function puts success once every instance succeeded, and
+    only then records the artifact for bootstrap
+    """
+    progress = Progress(2)
+    progress.add({'CommandId': 'c-1', 'Status': 'Success', 'TargetCount': 2,
+                  'CompletedCount': 2, 'ErrorCount': 0})
+    mock_poll.return_value = progress
+    state = new_state(2, 'started-job')
+    state['Version'] = 'abc'
+    event = continuation_event(encode_state(state))
+    assert handle(event, 'Test') is True
+    assert mock_poll.call_args[0][1]['Instances'] == 2
+    assert 'seconds' in mock_success.call_args[0][1]
+    mock_record.assert_called_once_with(
+        's3://codepipeline-us-east-1-123456789000/pipeline/MyApp/random.zip', 'started-job',
+        'abc')
+
+@patch('main.codepipeline_failure')
+@patch('tracking.failed_instances')
+@patch('main.poll')
+def test_handle_continuation_when_deployment_failed(mock_poll, mock_failed, mock_failure):
+    """
+    Test the handle function puts failure naming failed instances
+    """
+    progress = Progress(2)
+    progress.add({'CommandId': 'c-1', 'Status': 'Failed', 'TargetCount': 2,
+                  'CompletedCount': 2, 'ErrorCount': 1})
+    mock_poll.return_value = progress
+    mock_failed.return_value = ['i-2']
+    assert handle(continuation_event(encode_state(new_state(2))), 'Test') is False
+    mock_failed.assert_called_once_with(['c-1'], {})
+    assert mock_failure.call_args[0][1].endswith('i-2')
+
+@patch('main.codepipeline_continue')
+@patch('main.poll')
+def test_handle_continuation_when_deployment_in_progress(mock_poll, mock_continue):
+    """
+    Test the handle function hands the job back while instances are running
+    """
+    progress = Progress(2)
+    progress.add({'CommandId': 'c-1', 'Status': 'InProgress', 'TargetCount': 2,
+                  'CompletedCount': 1, 'ErrorCount': 0})
+    mock_poll.return_value = progress
+    assert handle(continuation_event(encode_state(new_state(2))), 'Test') is True
+    assert mock_continue.call_args[0][3] == 50
+
+@patch('main.codepipeline_continue')
+@patch('main.poll')
+def test_handle_continuation_before_next_check(mock_poll, mock_continue):
+    """
+    Test the handle function hands the job straight back, without checking
+    on it, when CodePipeline invokes it before the next check is due
+    """
+    state = new_state(4)
+    state.update({'Completed': 2, 'NotBefore': int(time.time()) + 60})
+    token = encode_state(state)
+    assert handle(continuation_event(token), 'Test') is True
+    assert mock_poll.call_count == 0
+    assert json.loads(mock_continue.call_args[0][1]) == json.loads(token)
+    assert mock_continue.call_args[0][2].startswith('Next check in')
+    assert mock_continue.call_args[0][3] == 50
+
+@patch('main.codepipeline_failure')
+@patch('main.poll')
+def test_handle_continuation_when_deployment_timed_out(mock_poll, mock_failure):
+    """
+    Test the handle function fails a deployment that takes too long
+    """
+    mock_poll.return_value = Progress(2)
+    state = new_state(2)
+    state['Started'] -= TRACKING_TIMEOUT_SECONDS + 1
+    assert handle(continuation_event(encode_state(state)), 'Test') is False
+    assert mock_failure.call_args[0][1].startswith('Timed out')
+
+@patch('main.codepipeline_failure')
+def test_handle_continuation_with_invalid_token(mock_failure):
+    """
+    Test the handle function fails the job when the token can't be read
+    """
+    assert handle(continuation_event('blah'), 'Test') is False
+    assert mock_failure.call_count == 1
+
+@patch('main.artifact_version')
+@patch('main.codepipeline_failure')
+@patch('main.execute_runcommand')
+@patch('main.find_artifact')
+@patch('main.ssm_commands')
+@patch('main.stream_chunks')
+def test_handle_with_failed_handoff(mock_chunks, mock_commands, mock_artifact,
+                                   mock_run_command, mock_failure, _mock_version):
+    """
+    Test the handle function fails the job when a page cannot be handed off
+    """
+    mock_chunks.return_value = iter([(1, [['i-1']]), (1, [['i-2']])])
+    mock_commands.return_value = ['blah']
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    mock_run_command.side_effect = [False, True]
+    codepipeline = SampleEvent('codepipeline')
+    assert handle(codepipeline.event, 'Test') is False
+    assert mock_run_command.call_count == 2
+    assert mock_failure.call_count == 1
+
+@patch('main.artifact_version')
+@patch('main.codepipeline_success')
+@patch('main.codepipeline_failure')
+@patch('main.execute_runcommand')
+@patch('main.find_artifact')
+@patch('main.ssm_commands')
+@patch('main.stream_chunks')
+def test_handle_with_failed_listing(mock_chunks, mock_commands, mock_artifact,
+                                   mock_run_command, mock_failure, mock_success,
+                                   _mock_version):
+    """
+    Test the handle function fails the job when a later page of instances
+    cannot be listed, after handing off the pages before it
+    """
+    def pages(*_args, **_kwargs):
+        """Yields a page, then fails to list the next"""
+        yield 1, [['i-1']]
+        raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'Boom!'}},
+                          'DescribeInstances')
+    mock_chunks.side_effect = pages
+    mock_commands.return_value = ['blah']
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    mock_run_command.return_value = True
+    codepipeline = SampleEvent('codepipeline')
+    assert handle(codepipeline.event, 'Test') is False
+    assert mock_run_command.call_count == 1
+    assert mock_failure.call_args[0][1].startswith('Failed to list the instances')
+    assert mock_success.call_count == 0
+
+@patch('main.artifact_version')
 @patch('main.codepipeline_failure')
 @patch('main.find_artifact')
 @patch('main.ssm_commands')
-@patch('main.find_instances')
-def test_handle_no_instances(mock_instances, mock_commands, mock_artifact,
-                             mock_failure):
+@patch('main.stream_chunks')
+def test_handle_no_instances(mock_chunks, mock_commands, mock_artifact,
+                             mock_failure, _mock_version):
     """
     Test the handle function with valid input and no instances
     """
-    mock_instances.return_value = []
+    mock_chunks.return_value = iter([(0, [])])
     mock_commands.return_value = True
-    mock_artifact.return_value = True
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
     mock_failure.return_value = True
     codepipeline = SampleEvent('codepipeline')
     assert handle(codepipeline.event, 'Test') is False
 
+@patch('main.artifact_version')
+@patch('main.record_latest_artifact')
+@patch('main.codepipeline_success')
+@patch('main.execute_runcommand')
+@patch('main.find_artifact')
+@patch('main.stream_chunks')
+def test_handle_when_every_instance_applied(mock_chunks, mock_artifact, mock_run_command,
+                                            mock_success, mock_record, mock_version):
+    """
+    Test the handle function succeeds without deploying when every instance
+    has already applied the artifact
+    """
+    mock_chunks.return_value = iter([(2, []), (1, [])])
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    mock_version.return_value = 'abc'
+    codepipeline = SampleEvent('codepipeline')
+    assert handle(codepipeline.event, 'Test') is True
+    assert mock_chunks.call_args[0][1].result() == ('abc', None)
+    assert mock_run_command.call_count == 0
+    assert mock_success.call_args[0][1] == 'All 3 instances are up to date with version abc'
+    assert mock_record.call_count == 1
+
+@patch('main.artifact_version')
+@patch('main.find_artifact')
+@patch('main.stream_chunks')
+def test_handle_forced(mock_chunks, mock_artifact, mock_version):
+    """
+    Test the handle function does not skip any instance when forced
+    """
+    mock_chunks.return_value = iter([])
+    mock_artifact.return_value = 's3://bucket/GARLC/MyApp/artifact.zip'
+    codepipeline = SampleEvent('codepipeline')
+    codepipeline.event['CodePipeline.job']['data']['actionConfiguration'] \
+        ['configuration']['UserParameters'] = '{"Force": 1}'
+    with patch('main.codepipeline_failure'):
+        handle(codepipeline.event, 'Test')
+    assert mock_chunks.call_args[0][1].result() == (None, None)
+    assert mock_version.call_count == 0
+
 def test_handle_invalid_event():
     """
     Test the handle function with an invalid event
@@ -176,35 +630,29 @@ def test_handle_invalid_event():
     event = {}
     assert handle(event, 'Test') is False
 
-@patch('main.codepipeline_success')
 @patch('boto3.client')
-def test_execute_runcommand(mock_client, mock_success):
+def test_execute_runcommand(mock_client):
     """
     Test the execute_runcommand function with valid input
     """
     client = MagicMock()
     mock_client.return_value = client
     client.invoke_async.return_value = {"Status": 202}
-    mock_success.return_value = True
     chunked_instance_ids = ['abcdef-12345']
     commands = ['blah']
-    job_id = 1
-    assert execute_runcommand(chunked_instance_ids, commands, job_id) is True
+    assert execute_runcommand(chunked_instance_ids, commands) is True
 
-@patch('main.codepipeline_failure')
 @patch('boto3.client')
-def test_execute_runcommand_with_failed_status(mock_client, mock_failure):
+def test_execute_runcommand_with_failed_status(mock_client):
     """
     Test the execute_runcommand function with a failed status code
     """
     client = MagicMock()
     mock_client.return_value = client
     client.invoke_async.return_value = {"Status": 400}
-    mock_failure.return_value = True
     chunked_instance_ids = ['abcdef-12345']
     commands = ['blah']
-    job_id = 1
-    assert execute_runcommand(chunked_instance_ids, commands, job_id) is False
+    assert execute_runcommand(chunked_instance_ids, commands) is False
 
 @patch('boto3.client')
 def test_execute_runcommand_with_clienterror(mock_client):
@@ -220,5 +668,67 @@ def test_execute_runcommand_with_clienterror(mock_client):
     mock_client.side_effect = ClientError(err_msg, 'Test')
     chunked_instance_ids = ['abcdef-12345']
     commands = ['blah']
-    job_id = 1
-    assert execute_runcommand(chunked_instance_ids, commands, job_id) is False
+    assert execute_runcommand(chunked_instance_ids, commands) is False
+
+@patch('main.save_manifest')
+@patch('boto3.client')
+def test_execute_runcommand_with_manifest(mock_client, mock_save):
+    """
+    Test the execute_runcommand function passes a manifest reference when
+    the chunks are too large to pass inline
+    """
+    client = MagicMock()
+    mock_client.return_value = client
+    client.invoke_async.return_value = {"Status": 202}
+    mock_save.return_value = {'Manifest': {'Bucket': 'bucket', 'Key': 'key'},
+                              'Start': 0, 'End': 1}
+    assert execute_runcommand([['i-1']], ['blah'], None, ('bucket', 'key')) is True
+    assert mock_save.call_count == 0
+    chunked_instance_ids = [['i-%08d' % i for i in range(50)] for _ in range(100)]
+    assert execute_runcommand(chunked_instance_ids, ['blah'], None, ('bucket', 'key')) is True
+    mock_save.assert_called_once_with('bucket', 'key', chunked_instance_ids, ['blah'], None,
+                                      None, None)
+    assert json.loads(client.invoke_async.call_args[1]['InvokeArgs']) == \
+        mock_save.return_value
+
+@patch('main.LEDGER', 'sqlite:/tmp/ledger.db')
+@patch('main.codepipeline_continue')
+@patch('main.invoke_runcommand_helper')
+@patch('main.poll')
+def test_handle_continuation_resumes_stalled_deployment(mock_poll, mock_invoke, mock_continue):
+    """
+    Test the handle function hands every manifest to the helper again when
+    instances were never sent their commands
+    """
+    progress = Progress(3)
+    progress.add({'CommandId': 'c-1', 'Status': 'Success', 'TargetCount': 2,
+                  'CompletedCount': 2, 'ErrorCount': 0})
+    mock_poll.return_value = progress
+    state = new_state(3, 'started-job')
+    state.update({'Started': state['Started'] - 600, 'Manifests': 2})
+    event = continuation_event(encode_state(state))
+    assert handle(event, 'Test') is True
+    assert [json.loads(call[0][0]) for call in mock_invoke.call_args_list] == [
+        {'Manifest': {'Bucket': 'codepipeline-us-east-1-123456789000',
+                      'Key': manifest_key('started-job', part)}, 'Start': 0, 'End': None}
+        for part in (0, 1)]
+    assert json.loads(mock_continue.call_args[0][1])['Resumes'] == 1
+
+@patch('main.record_artifact')
+@patch('main.delete_manifests')
+@patch('main.codepipeline_success')
+@patch('main.poll')
+def test_handle_continuation_removes_manifests(mock_poll, mock_success, mock_delete,
+                                               _mock_record):
+    """
+    Test the handle function removes the manifests once the deployment ends
+    """
+    progress = Progress(1)
+    progress.add({'CommandId': 'c-1', 'Status': 'Success', 'TargetCount': 1,
+                  'CompletedCount': 1, 'ErrorCount': 0})
+    mock_poll.return_value = progress
+    state = new_state(1, 'started-job')
+    state['Manifests'] = 2
+    assert handle(continuation_event(encode_state(state)), 'Test') is True
+    mock_delete.assert_called_once_with('codepipeline-us-east-1-123456789000',
+                                        'started-job', 2)
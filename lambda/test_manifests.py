@@ -0,0 +1,80 @@
+"""
+Unit Tests for the manifests module
+"""
+import json
+from mock import patch, MagicMock
+from manifests import manifest_key
+from manifests import save_manifest
+from manifests import load_manifest
+from manifests import delete_manifests
+from manifests import delete_failures
+from manifests import failures_event
+from manifests import failures_prefix
+from manifests import read_failures
+from manifests import save_failure
+
+@patch('boto3.client')
+def test_save_manifest(mock_client):
+    """
+    Test save_manifest stores the work once and returns a reference to it
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    event = save_manifest('bucket', manifest_key('job', 0), [['i-1'], ['i-2']], ['blah'], 'GARLC job')
+    assert event == {'Manifest': {'Bucket': 'bucket', 'Key': 'garlc-manifests/job/0.json'},
+                     'Start': 0, 'End': 2}
+    assert json.loads(aws_s3.put_object.call_args[1]['Body']) == {
+        'ChunkedInstanceIds': [['i-1'], ['i-2']], 'Commands': ['blah'], 'Comment': 'GARLC job'
+    }
+
+@patch('boto3.client')
+def test_load_manifest(mock_client):
+    """
+    Test load_manifest reads each manifest once
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    body = json.dumps({'ChunkedInstanceIds': [['i-1']], 'Commands': ['blah']})
+    aws_s3.get_object.return_value = {
+        'Body': MagicMock(read=MagicMock(return_value=body.encode('utf-8')))
+    }
+    assert load_manifest('bucket', 'key')['Commands'] == ['blah']
+    assert load_manifest('bucket', 'key')['ChunkedInstanceIds'] == [['i-1']]
+    assert aws_s3.get_object.call_count == 1
+
+@patch('boto3.client')
+def test_delete_manifests(mock_client):
+    """
+    Test delete_manifests removes every part, 1000 keys per call
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    delete_manifests('bucket', 'job', 0)
+    assert aws_s3.delete_objects.call_count == 0
+    delete_manifests('bucket', 'job', 1001)
+    assert aws_s3.delete_objects.call_count == 2
+    objects = aws_s3.delete_objects.call_args[1]['Delete']['Objects']
+    assert objects == [{'Key': manifest_key('job', 1000)}]
+
+@patch('boto3.client')
+def test_failures(mock_client):
+    """
+    Test chunks that failed to send are recorded under the deployment's
+    prefix, read back and removed
+    """
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    prefix = failures_prefix('job', 1)
+    assert prefix == 'garlc-manifests/job/failed/wave-1/'
+    assert failures_prefix('job') == 'garlc-manifests/job/failed/all/'
+    save_failure(failures_event('bucket', prefix), 'chunk', ['i-1', 'i-2'])
+    assert aws_s3.put_object.call_args[1]['Key'] == prefix + 'chunk.json'
+
+    aws_s3.list_objects_v2.return_value = {'Contents': [{'Key': prefix + 'chunk.json'}]}
+    aws_s3.get_object.return_value = {'Body': MagicMock(
+        read=MagicMock(return_value=aws_s3.put_object.call_args[1]['Body'].encode('utf-8')))}
+    assert read_failures('bucket', prefix) == ['i-1', 'i-2']
+    delete_failures('bucket', 'job')
+    assert aws_s3.list_objects_v2.call_args[1]['Prefix'] == 'garlc-manifests/job/failed/'
+    assert aws_s3.delete_objects.call_args[1]['Delete']['Objects'] == [
+        {'Key': prefix + 'chunk.json'}]
@@ -0,0 +1,96 @@
+"""
+Unit Tests for the metrics module
+"""
+import json
+import pytest
+from mock import patch, MagicMock
+from botocore.exceptions import ClientError
+import metrics
+from metrics import span
+from metrics import count
+from metrics import document
+from metrics import instrument
+from metrics import NULL_SPAN
+from throttling import call
+
+@patch('metrics.ENABLED', False)
+def test_disabled():
+    """
+    Test nothing is recorded while metrics are disabled
+    """
+    assert span('Phase') is NULL_SPAN
+    with span('Phase'):
+        count('Calls')
+    assert metrics.TIMINGS == {}
+    assert metrics.COUNTERS == {}
+
+@patch('metrics.ENABLED', True)
+def test_span_and_count():
+    """
+    Test spans add up their time and calls, and counters add up
+    """
+    with span('Phase'):
+        pass
+    with span('Phase'):
+        pass
+    count('Calls')
+    count('Calls', 2)
+    assert metrics.TIMINGS['Phase'][1] == 2
+    assert metrics.COUNTERS['Calls'] == 3
+
+@patch('metrics.ENABLED', True)
+def test_document():
+    """
+    Test the document follows the Embedded Metric Format
+    """
+    with span('Phase'):
+        pass
+    count('Calls')
+    result = document('main')
+    directive = result['_aws']['CloudWatchMetrics'][0]
+    assert directive['Dimensions'] == [['Function']]
+    assert {'Name': 'Phase', 'Unit': 'Milliseconds'} in directive['Metrics']
+    assert {'Name': 'Calls', 'Unit': 'Count'} in directive['Metrics']
+    assert result['Function'] == 'main'
+    assert result['Phase.Count'] == 1
+    assert result['Calls'] == 1
+
+@patch('metrics.ENABLED', True)
+def test_instrument(capsys):
+    """
+    Test an instrumented handler emits one line per invocation, even when
+    it raises
+    """
+    @instrument('main')
+    def handler(event, _context):
+        """Counts and fails on request"""
+        count('Events')
+        if event == 'fail':
+            raise ValueError(event)
+        return True
+
+    assert handler('event', None) is True
+    assert handler('event', None) is True
+    lines = capsys.readouterr()[0].strip().splitlines()
+    assert len(lines) == 2
+    assert json.loads(lines[-1])['Events'] == 1
+    with pytest.raises(ValueError):
+        handler('fail', None)
+    assert json.loads(capsys.readouterr()[0])['Invocation.Count'] == 1
+
+@patch('metrics.ENABLED', True)
+@patch('throttling.get_bucket', MagicMock())
+@patch('throttling.sleep', MagicMock())
+def test_call_records_throttling():
+    """
+    Test AWS calls are timed and throttled calls counted
+    """
+    func = MagicMock(__name__='send_command', side_effect=[
+        ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}},
+                    'SendCommand'),
+        {'Command': {}}
+    ])
+    call('ssm', func)
+    assert metrics.TIMINGS['ssm.send_command'][1] == 2
+    assert metrics.COUNTERS['ssm.send_command.Throttled'] == 1
+    assert metrics.COUNTERS['ssm.send_command.Retries'] == 1
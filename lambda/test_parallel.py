@@ -0,0 +1,57 @@
+"""
+Unit Tests for the parallel module
+"""
+import threading
+import pytest
+from mock import patch
+import metrics
+from parallel import Done
+from parallel import run_lookups
+from parallel import start_lookup
+
+def test_run_lookups_side_by_side():
+    """
+    Test lookups run at the same time, each waiting on the other here, and
+    return their results in order
+    """
+    first, second = threading.Event(), threading.Event()
+
+    def lookup(mine, other, value):
+        """Signals and waits for the other lookup"""
+        mine.set()
+        assert other.wait(5)
+        return value
+
+    assert run_lookups([
+        ('First', lambda: lookup(first, second, 1), None),
+        ('Second', lambda: lookup(second, first, 2), None)
+    ]) == [1, 2]
+
+def test_run_lookups_raises():
+    """
+    Test what a lookup raises is raised to the caller, and that a single
+    lookup runs on the calling thread
+    """
+    def fail():
+        """Fails"""
+        raise ValueError('blah')
+    with pytest.raises(ValueError):
+        run_lookups([('Fail', fail, None), ('Other', lambda: 1, None)])
+    assert run_lookups([('Only', threading.current_thread, None)]) == \
+        [threading.current_thread()]
+
+@patch('metrics.ENABLED', True)
+def test_lookup_timeout():
+    """
+    Test a lookup taking too long is given up on for its default
+    """
+    release = threading.Event()
+    try:
+        lookup = start_lookup('Slow', release.wait, 5, default='default', timeout=0.05)
+        assert lookup.result() == 'default'
+        assert lookup.result() == 'default'
+        assert metrics.COUNTERS['LookupTimeouts'] == 1
+    finally:
+        release.set()
+    assert start_lookup('Fast', lambda value: value, 'value').result() == 'value'
+    assert Done('value').result() == 'value'
@@ -0,0 +1,129 @@
+"""
+Unit Tests for the role_changes module
+"""
+import io
+import json
+import zipfile
+from botocore.exceptions import ClientError
+from mock import patch, MagicMock
+from role_changes import changed_roles
+from role_changes import fingerprint
+from role_changes import fingerprint_key
+from role_changes import list_artifact
+from role_changes import RoleChanges
+
+def artifact(**roles):
+    """
+    Returns a zipped artifact with a playbook, a README and a task file for
+    each role
+    """
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr('README.md', 'readme')
+        archive.writestr('ansible/playbook.yml', 'playbook')
+        for role, tasks in roles.items():
+            archive.writestr('ansible/roles/%s/tasks/main.yml' % role, tasks)
+        archive.writestr('padding.bin', 'x' * 100000)
+    return data.getvalue()
+
+def fingerprint_of(data):
+    """
+    Returns the fingerprint of a zipped artifact
+    """
+    return fingerprint(zipfile.ZipFile(io.BytesIO(data)).infolist())
+
+def s3_object(data):
+    """
+    Returns a GetObject response holding data
+    """
+    return {'Body': MagicMock(read=MagicMock(return_value=data))}
+
+def test_changed_roles():
+    """
+    Test changed_roles finds the changed, added and removed roles and
+    ignores files outside the Ansible directory
+    """
+    old = fingerprint_of(artifact(common='c', webserver='w', dbserver='d'))
+    new = fingerprint_of(artifact(common='c', webserver='w2', appserver='a'))
+    assert changed_roles(old, new) == set(['webserver', 'dbserver', 'appserver'])
+    assert changed_roles(old, old) == set()
+
+def test_changed_roles_with_shared_change():
+    """
+    Test changed_roles returns None when the playbook changed
+    """
+    old = fingerprint_of(artifact(webserver='w'))
+    new = dict(fingerprint_of(artifact(webserver='w')), Shared='other')
+    assert changed_roles(old, new) is None
+
+@patch('boto3.client')
+def test_list_artifact(mock_client):
+    """
+    Test list_artifact reads the file list from the end of the artifact
+    """
+    data = artifact(webserver='w')
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.return_value = dict(
+        s3_object(data[-65536:]), ContentRange='bytes %d-%d/%d' % (
+            len(data) - 65536, len(data) - 1, len(data))
+    )
+    names = [info.filename for info in list_artifact('bucket', 'key')]
+    assert 'ansible/roles/webserver/tasks/main.yml' in names
+    aws_s3.get_object.assert_called_once_with(Bucket='bucket', Key='key', Range='bytes=-65536')
+
+@patch('role_changes.TAIL_BYTES', 100)
+@patch('boto3.client')
+def test_list_artifact_downloads_large_directories(mock_client):
+    """
+    Test list_artifact reads the whole artifact when its central directory
+    is larger than the end read
+    """
+    data = artifact(webserver='w')
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.side_effect = [
+        dict(s3_object(data[-100:]), ContentRange='bytes 0-99/%d' % len(data)),
+        s3_object(data)
+    ]
+    assert len(list_artifact('bucket', 'key')) == 4
+    assert aws_s3.get_object.call_count == 2
+
+@patch('boto3.client')
+def test_role_changes(mock_client):
+    """
+    Test RoleChanges compares each instance with the version it applied
+    """
+    old = fingerprint_of(artifact(common='c', webserver='w', dbserver='d'))
+    new = fingerprint_of(artifact(common='c', webserver='w2', dbserver='d'))
+    stored = {fingerprint_key('v1'): old, fingerprint_key('v2'): new}
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    aws_s3.get_object.side_effect = lambda **kwargs: s3_object(
+        json.dumps(stored[kwargs['Key']]).encode('utf-8'))
+    changes = RoleChanges.for_artifact('bucket', 'key', 'v2')
+    assert changes.affects('v1', ['webserver']) is True
+    assert changes.affects('v1', ['dbserver']) is False
+    assert changes.affects(None, ['dbserver']) is True
+    assert aws_s3.get_object.call_count == 2
+    assert aws_s3.put_object.call_count == 0
+
+@patch('boto3.client')
+def test_role_changes_fingerprints_new_artifacts(mock_client):
+    """
+    Test RoleChanges fingerprints an artifact seen for the first time and
+    stores its fingerprint
+    """
+    data = artifact(common='c')
+    aws_s3 = MagicMock()
+    mock_client.return_value = aws_s3
+    def get_object(**kwargs):
+        """Returns the artifact, there being no fingerprint yet"""
+        if kwargs['Key'] != 'key':
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}},
+                              'GetObject')
+        return s3_object(data)
+    aws_s3.get_object.side_effect = get_object
+    changes = RoleChanges.for_artifact('bucket', 'key', 'v2')
+    assert changes.new == fingerprint_of(data)
+    assert aws_s3.put_object.call_args[1]['Key'] == fingerprint_key('v2')
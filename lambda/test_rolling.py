@@ -0,0 +1,339 @@
+"""
+Unit Tests for the rolling module, and rolling deployments run by main
+against a simulated SSM backend
+"""
+import io
+import json
+import uuid
+from botocore.exceptions import ClientError
+from mock import patch, MagicMock
+import clients
+from main import handle
+from artifacts import LATEST_ARTIFACT_KEY
+from rolling import wave_size
+from rolling import instance_roles
+from rolling import plan_waves
+from rolling import plan_key
+from runcommand_helper import report_failures
+from runcommand_helper import send_run_command
+from targets import LOCAL_TARGET
+from aws_lambda_sample_events import SampleEvent
+
+def instance(instance_id, roles=None):
+    """
+    Returns an instance as described by DescribeInstances
+    """
+    tags = [{'Key': 'has_ssm_agent', 'Value': 'true'}]
+    if roles is not None:
+        tags.append({'Key': 'Ansible_Roles', 'Value': roles})
+    return {'InstanceId': instance_id, 'Tags': tags}
+
+def options(**overrides):
+    """
+    Returns the rolling deployment options with overrides applied
+    """
+    result = {'MaxConcurrent': 0, 'MaxConcurrentPercent': 25, 'WaveOrder': '',
+              'RolesTag': 'Ansible_Roles'}
+    result.update(overrides)
+    return result
+
+class FakeSSM(object):
+    """
+    Simulated SSM backend whose commands finish as soon as they are sent,
+    failing on the instances in failing, and that rejects commands for the
+    instances in rejected
+    """
+    def __init__(self, failing=(), rejected=()):
+        self.failing = set(failing)
+        self.rejected = set(rejected)
+        self.commands = []
+
+    def waves(self):
+        """
+        Returns the instances sent each wave's commands, in order
+        """
+        waves = []
+        for command in self.commands:
+            if not waves or waves[-1][0] != command['Comment']:
+                waves.append((command['Comment'], []))
+            waves[-1][1].extend(command['InstanceIds'])
+        return waves
+
+    def send_command(self, **kwargs):
+        """
+        Records the command, finished on every instance
+        """
+        instance_ids = kwargs['InstanceIds']
+        if self.rejected.intersection(instance_ids):
+            raise ClientError({'Error': {'Code': 'InvalidInstanceId', 'Message': ''}},
+                              'SendCommand')
+        errors = len([i for i in instance_ids if i in self.failing])
+        self.commands.append({
+            'CommandId': 'c-%d' % len(self.commands),
+            'Comment': kwargs.get('Comment'),
+            'InstanceIds': instance_ids,
+            'Status': 'Failed' if errors else 'Success',
+            'TargetCount': len(instance_ids),
+            'CompletedCount': len(instance_ids),
+            'ErrorCount': errors
+        })
+        return {'Command': self.commands[-1]}
+
+    def list_commands(self, **kwargs):
+        """
+        Lists every command in a single page
+        """
+        return {'Commands': self.commands}
+
+    def list_command_invocations(self, **kwargs):
+        """
+        Lists the invocations of a command
+        """
+        command = [c for c in self.commands if c['CommandId'] == kwargs['CommandId']][0]
+        return {'CommandInvocations': [
+            {'InstanceId': i, 'Status': 'Failed' if i in self.failing else 'Success'}
+            for i in command['InstanceIds']
+        ]}
+
+class FakeS3(object):
+    """
+    Simulated S3 bucket
+    """
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, **kwargs):
+        """
+        Stores an object
+        """
+        self.objects[kwargs['Key']] = kwargs['Body']
+
+    def get_object(self, **kwargs):
+        """
+        Returns an object
+        """
+        return {'Body': io.BytesIO(self.objects[kwargs['Key']].encode('utf-8'))}
+
+    def head_object(self, **kwargs):
+        """
+        Returns the metadata of the artifact
+        """
+        return {'ETag': '"v1"'}
+
+    def delete_object(self, **kwargs):
+        """
+        Removes an object
+        """
+        self.objects.pop(kwargs['Key'], None)
+
+    def delete_objects(self, **kwargs):
+        """
+        Removes several objects
+        """
+        for obj in kwargs['Delete']['Objects']:
+            self.objects.pop(obj['Key'], None)
+
+    def list_objects_v2(self, **kwargs):
+        """
+        Lists the objects under Prefix in a single page
+        """
+        return {'Contents': [{'Key': key} for key in sorted(self.objects)
+                             if key.startswith(kwargs['Prefix'])]}
+
+def hand_off(chunked_instance_ids, commands, comment=None, _manifest=None,
+             target=LOCAL_TARGET, failures=None):
+    """
+    Stands in for the helper Lambda, sending each chunk straight to SSM and
+    recording those that fail to send
+    """
+    report_failures(failures, [chunk for chunk in chunked_instance_ids if not
+                               send_run_command(chunk, commands, comment=comment,
+                                                target=target)])
+    return True
+
+def run_deployment(instances, failing=(), rejected=(), describe=None, **user_parameters):
+    """
+    Runs a rolling deployment to completion, feeding each continuation token
+    back to main as a job with an ID of its own, and returns the simulated
+    SSM backend, the simulated bucket and the CodePipeline client.
+    describe, when given, are the DescribeInstances pages returned (or
+    raised) in turn instead of a single page of instances.
+    """
+    ssm, aws_s3, codepipeline, ec2 = FakeSSM(failing, rejected), FakeS3(), MagicMock(), \
+        MagicMock()
+    ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': instances}]
+    }
+    ec2.describe_instances.side_effect = describe
+    for service, client in (('ssm', ssm), ('s3', aws_s3), ('codepipeline', codepipeline),
+                            ('ec2', ec2)):
+        clients.set_client(service, client)
+
+    user_parameters['DeploymentStrategy'] = 'rolling'
+    event = SampleEvent('codepipeline').event
+    event['CodePipeline.job']['data']['actionConfiguration']['configuration'] \
+        ['UserParameters'] = json.dumps(user_parameters)
+    with patch('main.execute_runcommand', side_effect=hand_off):
+        handle(event, 'Test')
+        while codepipeline.put_job_success_result.call_args is not None and \
+                'continuationToken' in codepipeline.put_job_success_result.call_args[1] \
+                and not codepipeline.put_job_failure_result.called:
+            token = codepipeline.put_job_success_result.call_args[1]['continuationToken']
+            codepipeline.put_job_success_result.reset_mock()
+            event['CodePipeline.job']['data']['continuationToken'] = token
+            event['CodePipeline.job']['id'] = str(uuid.uuid4())
+            handle(event, 'Test')
+    return ssm, aws_s3, codepipeline
+
+def test_wave_size():
+    """
+    Test wave_size prefers MaxConcurrent and never returns 0
+    """
+    assert wave_size(10, options(MaxConcurrent=3)) == 3
+    assert wave_size(10, options()) == 3
+    assert wave_size(0, options()) == 1
+
+def test_instance_roles():
+    """
+    Test instance_roles splits the roles tag
+    """
+    assert instance_roles(instance('i-1', 'web, db'), 'Ansible_Roles') == ['web', 'db']
+    assert instance_roles(instance('i-1'), 'Ansible_Roles') == []
+
+def test_plan_waves():
+    """
+    Test plan_waves deploys the WaveOrder roles first and keeps tiers apart
+    """
+    instances = [
+        instance('i-1', 'web'),
+        instance('i-2', 'db'),
+        instance('i-3', 'web'),
+        instance('i-4'),
+        instance('i-5', 'db,web')
+    ]
+    waves = plan_waves(instances, options(MaxConcurrent=2, WaveOrder='db'))
+    assert waves == [['i-2', 'i-5'], ['i-4', 'i-1'], ['i-3']]
+    assert plan_waves([], options()) == []
+
+def test_rolling_deployment():
+    """
+    Test a rolling deployment sends one wave at a time and succeeds after
+    the last one
+    """
+    instances = [instance('i-%d' % i, 'web') for i in range(5)]
+    ssm, aws_s3, codepipeline = run_deployment(instances, MaxConcurrent=2)
+    assert ssm.waves() == [
+        ('GARLC 7c878283-f6d8-42b8-865c-d43a949cd902 wave 0', ['i-0', 'i-1']),
+        ('GARLC 7c878283-f6d8-42b8-865c-d43a949cd902 wave 1', ['i-2', 'i-3']),
+        ('GARLC 7c878283-f6d8-42b8-865c-d43a949cd902 wave 2', ['i-4'])
+    ]
+    result = codepipeline.put_job_success_result.call_args[1]
+    assert 'continuationToken' not in result
+    assert '5 instances finished in 3 waves' in result['executionDetails']['summary']
+    assert plan_key('7c878283-f6d8-42b8-865c-d43a949cd902') not in aws_s3.objects
+    assert LATEST_ARTIFACT_KEY in aws_s3.objects
+
+def test_rolling_deployment_halts():
+    """
+    Test a rolling deployment halts after a wave with too many failures
+    """
+    instances = [instance('i-%d' % i) for i in range(6)]
+    ssm, aws_s3, codepipeline = run_deployment(
+        instances, failing=['i-2', 'i-3'], MaxConcurrent=2, MaxErrorsPerWave=1
+    )
+    assert len(ssm.waves()) == 2
+    message = codepipeline.put_job_failure_result.call_args[1]['failureDetails']['message']
+    assert message.startswith('Halted after wave 2 of 3')
+    assert message.endswith('i-2, i-3')
+    assert aws_s3.objects == {}
+
+def test_rolling_deployment_halts_on_failed_sends():
+    """
+    Test a rolling deployment counts instances their commands could not be
+    sent to as failed, rather than waiting for them
+    """
+    instances = [instance('i-%d' % i) for i in range(4)]
+    ssm, aws_s3, codepipeline = run_deployment(
+        instances, rejected=['i-2'], MaxConcurrent=2, MaxErrorsPerWave=0
+    )
+    assert [wave[1] for wave in ssm.waves()] == [['i-0', 'i-1'], ['i-3']]
+    message = codepipeline.put_job_failure_result.call_args[1]['failureDetails']['message']
+    assert message.startswith('Halted after wave 2 of 2, 1 of 2 instances finished, 1 failed')
+    assert message.endswith(': i-2')
+    assert aws_s3.objects == {}
+
+def test_rolling_deployment_tolerates_errors():
+    """
+    Test a rolling deployment carries on while failures stay within
+    MaxErrorsPerWave
+    """
+    instances = [instance('i-%d' % i) for i in range(4)]
+    ssm, _, codepipeline = run_deployment(
+        instances, failing=['i-0'], MaxConcurrent=2, MaxErrorsPerWave=1
+    )
+    assert len(ssm.waves()) == 2
+    assert '1 failed' in \
+        codepipeline.put_job_success_result.call_args[1]['executionDetails']['summary']
+
+def test_rolling_deployment_skips_applied_instances():
+    """
+    Test a rolling deployment leaves out instances already at the artifact's
+    version
+    """
+    instances = [instance('i-%d' % i) for i in range(4)]
+    instances[1]['Tags'].append({'Key': 'GARLC_Version', 'Value': 'v1'})
+    ssm, _, codepipeline = run_deployment(instances, MaxConcurrent=2)
+    assert [wave[1] for wave in ssm.waves()] == [['i-0', 'i-2'], ['i-3']]
+    assert '3 instances finished in 2 waves' in \
+        codepipeline.put_job_success_result.call_args[1]['executionDetails']['summary']
+
+def test_rolling_deployment_fails_when_listing_fails():
+    """
+    Test a rolling deployment fails without sending any commands when a
+    later page of instances cannot be listed
+    """
+    ssm, _, codepipeline = run_deployment([], MaxConcurrent=1, PageSize=1, describe=[
+        {'Reservations': [{'Instances': [instance('i-0')]}], 'NextToken': 'page-2'},
+        ClientError({'Error': {'Code': 'InternalError', 'Message': 'Boom!'}},
+                    'DescribeInstances')
+    ])
+    assert ssm.commands == []
+    assert codepipeline.put_job_success_result.call_count == 0
+    assert 'Failed to list the instances' in \
+        codepipeline.put_job_failure_result.call_args[1]['failureDetails']['message']
+
+def test_rolling_deployment_across_targets():
+    """
+    Test a rolling deployment plans its waves over every target and sends
+    each instance's commands to its own target
+    """
+    remote_ssm, remote_ec2 = FakeSSM(()), MagicMock()
+    remote_ec2.describe_instances.return_value = {
+        'Reservations': [{'Instances': [instance('i-r%d' % i, 'web') for i in range(2)]}]
+    }
+    clients.set_client('ssm', remote_ssm, 'eu-west-1')
+    clients.set_client('ec2', remote_ec2, 'eu-west-1')
+    instances = [instance('i-%d' % i, 'web') for i in range(3)]
+    ssm, _, codepipeline = run_deployment(instances, MaxConcurrent=2,
+                                          Targets=['', 'eu-west-1'])
+    job = 'GARLC 7c878283-f6d8-42b8-865c-d43a949cd902'
+    assert ssm.waves() == [(job + ' wave 0', ['i-0', 'i-1']), (job + ' wave 1', ['i-2'])]
+    assert remote_ssm.waves() == [(job + ' wave 1', ['i-r0']), (job + ' wave 2', ['i-r1'])]
+    assert '5 instances finished in 3 waves' in \
+        codepipeline.put_job_success_result.call_args[1]['executionDetails']['summary']
+
+def test_rolling_deployment_fails_when_a_target_is_not_listed():
+    """
+    Test a rolling deployment fails, naming the target, when the instances
+    of one target cannot be listed
+    """
+    remote_ssm, remote_ec2 = FakeSSM(()), MagicMock()
+    remote_ec2.describe_instances.side_effect = ClientError(
+        {'Error': {'Code': 'UnauthorizedOperation', 'Message': 'Boom!'}}, 'DescribeInstances')
+    clients.set_client('ssm', remote_ssm, 'eu-west-1')
+    clients.set_client('ec2', remote_ec2, 'eu-west-1')
+    ssm, _, codepipeline = run_deployment([instance('i-0')], MaxConcurrent=1,
+                                          Targets=['', 'eu-west-1'])
+    assert ssm.commands == [] and remote_ssm.commands == []
+    assert codepipeline.put_job_failure_result.call_args[1]['failureDetails']['message'] == \
+        'Failed to list the instances in eu-west-1!'
@@ -1,11 +1,22 @@
 """
 Unit Tests for trigger_run_command Lambda function
 """
+import time
+import pytest
 from mock import patch, MagicMock
 from botocore.exceptions import ClientError
+from runcommand_helper import HANDOFF_RESERVE_MS
 from runcommand_helper import send_run_command
 from runcommand_helper import invoke_lambda
+from runcommand_helper import dispatch_chunks
+from runcommand_helper import split_chunks
+from runcommand_helper import fan_out
+from runcommand_helper import fan_out_manifest
 from runcommand_helper import handle
+import clients
+from ledger import SQLiteStore
+from ledger import chunk_key
+from targets import LOCAL_TARGET
 
 @patch('boto3.client')
 def test_send_run_command(mock_client):
@@ -17,6 +28,16 @@ def test_send_run_command(mock_client):
     ssm.send_command.return_value = True
     assert send_run_command(['i-12345678'], ['blah']) is True
 
+@patch('boto3.client')
+def test_send_run_command_with_existing_client(mock_client):
+    """
+    Test the send_run_command function reuses a client that is passed in
+    """
+    ssm = MagicMock()
+    assert send_run_command(['i-12345678'], ['blah'], ssm) is True
+    assert mock_client.call_count == 0
+    assert ssm.send_command.call_count == 1
+
 @patch('boto3.client')
 def test_send_run_command_with_clienterror(mock_client):
     """
@@ -31,11 +52,11 @@ def test_send_run_command_with_clienterror(mock_client):
     mock_client.side_effect = ClientError(err_msg, 'blah')
     assert send_run_command('blah', 'blah') is False
 
-@patch('runcommand_helper.send_run_command')
+@patch('throttling.sleep')
 @patch('boto3.client')
-def test_send_run_command_with_throttlingexception(mock_client, mock_run_command):
+def test_send_run_command_with_throttlingexception(mock_client, mock_sleep):
     """
-    Test the send_run_command function with a ThrottlingException
+    Test the send_run_command function retries after a ThrottlingException
     """
     err_msg = {
         'Error': {
@@ -45,8 +66,26 @@ def test_send_run_command_with_throttlingexception(mock_client, mock_run_command
     }
     ssm = MagicMock()
     mock_client.return_value = ssm
+    ssm.send_command.side_effect = [ClientError(err_msg, 'blah'), True]
+    assert send_run_command('blah', 'blah') is True
+    assert ssm.send_command.call_count == 2
+
+@patch('throttling.sleep')
+@patch('boto3.client')
+def test_send_run_command_when_always_throttled(mock_client, mock_sleep):
+    """
+    Test the send_run_command function gives up once retries are exhausted
+    """
+    err_msg = {
+        'Error': {
+            'Code': 'ThrottlingException',
+            'Message': 'Rate exceeded'
+        }
+    }
+    ssm = MagicMock()
+    mock_client.return_value = ssm
     ssm.send_command.side_effect = ClientError(err_msg, 'blah')
-    assert send_run_command('blah', 'blah') is not False
+    assert send_run_command('blah', 'blah') is False
 
 @patch('boto3.client')
 def test_send_run_command_with_clienterror_during_send_command(mock_client):
@@ -105,9 +144,106 @@ def test_invoke_lambda_with_clienterror(mock_client, mock_invoke):
     mock_client.side_effect = ClientError(err_msg, 'blah')
     assert invoke_lambda([["blah"]], ["blah"]) is False
 
+@patch('runcommand_helper.send_run_command')
+@patch('boto3.client')
+def test_dispatch_chunks(mock_client, mock_ssm):
+    """
+    Test dispatch_chunks sends every chunk when there is no time limit
+    """
+    mock_ssm.return_value = True
+    chunks = [[1, 2], [3, 4], [5, 6]]
+    assert dispatch_chunks(chunks, ['blah'], 'blah') == ([], [])
+    sent = sorted(call[0][0] for call in mock_ssm.call_args_list)
+    assert sent == chunks
+
+@patch('runcommand_helper.DISPATCH_WORKERS', 2)
+@patch('runcommand_helper.send_run_command')
+@patch('boto3.client')
+def test_dispatch_chunks_when_time_runs_out(mock_client, mock_ssm):
+    """
+    Test dispatch_chunks returns the unsent chunks once the time budget is
+    exhausted
+    """
+    context = MagicMock()
+    context.get_remaining_time_in_millis.side_effect = [60000, 5000]
+    chunks = [[1], [2], [3], [4], [5]]
+    with patch('time.time', return_value=1000.0):
+        assert dispatch_chunks(chunks, ['blah'], context) == ([[3], [4], [5]], [])
+    assert mock_ssm.call_count == 2
+    # Throttled sends give up retrying once the handoff reserve is reached
+    assert mock_ssm.call_args[0][6] == 1000.0 + (60000 - HANDOFF_RESERVE_MS) / 1000.0
+
+@patch('runcommand_helper.DISPATCH_WORKERS', 2)
+@patch('runcommand_helper.send_run_command')
+@patch('boto3.client')
+def test_dispatch_chunks_within_reserve(mock_client, mock_ssm):
+    """
+    Test dispatch_chunks still sends one batch when the invocation starts
+    with less time than the handoff reserve, so hand-offs always progress
+    """
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = HANDOFF_RESERVE_MS - 1000
+    assert dispatch_chunks([[1], [2], [3]], ['blah'], context) == ([[3]], [])
+    assert mock_ssm.call_count == 2
+
+@patch('boto3.client')
+def test_dispatch_chunks_with_clienterror(mock_client):
+    """
+    Test dispatch_chunks fails every chunk when no SSM client can be
+    created, rather than leaving them to be handed off
+    """
+    err_msg = {
+        'Error': {
+            'Code': 400,
+            'Message': 'Boom!'
+        }
+    }
+    mock_client.side_effect = ClientError(err_msg, 'blah')
+    assert dispatch_chunks([[1], [2]], ['blah'], 'blah') == ([], [[1], [2]])
+
+def test_split_chunks():
+    """
+    Test split_chunks splits into contiguous parts
+    """
+    assert split_chunks([[1], [2], [3], [4], [5]], 2) == [[[1], [2], [3]], [[4], [5]]]
+    assert split_chunks([[1]], 3) == [[[1]]]
+    assert split_chunks([], 3) == []
+
+@patch('runcommand_helper.HELPER_FANOUT', 2)
+@patch('runcommand_helper.invoke_lambda')
+def test_fan_out(mock_invoke):
+    """
+    Test fan_out hands the remaining chunks to several helpers
+    """
+    mock_invoke.return_value = True
+    assert fan_out([[1], [2], [3]], ['blah']) is True
+    assert mock_invoke.call_count == 2
+
+def test_fan_out_with_clienterror():
+    """
+    Test fan_out reports a failed hand-off when invoking the next helper
+    raises, rather than crashing the handler
+    """
+    client = MagicMock()
+    clients.set_client('lambda', client)
+    client.invoke_async.side_effect = ClientError(
+        {'Error': {'Code': 'TooManyRequestsException', 'Message': 'Boom!'}}, 'InvokeAsync')
+    with patch('throttling.sleep'):
+        assert fan_out([[1], [2]], ['blah']) is False
+
+@patch('runcommand_helper.invoke_lambda')
+def test_fan_out_with_no_chunks(mock_invoke):
+    """
+    Test fan_out with nothing left to hand off
+    """
+    mock_invoke.return_value = True
+    assert fan_out([], ['blah']) is True
+    mock_invoke.assert_called_once_with([], ['blah'], None, LOCAL_TARGET, None)
+
 @patch('runcommand_helper.invoke_lambda')
 @patch('runcommand_helper.send_run_command')
-def test_handle(mock_ssm, mock_invoke):
+@patch('boto3.client')
+def test_handle(mock_client, mock_ssm, mock_invoke):
     """
     Test the handle function with valid input and no errors
     """
@@ -118,6 +254,30 @@ def test_handle(mock_ssm, mock_invoke):
         "Commands": ["blah"]
     }
     assert handle(event, 'blah') is True
+    assert mock_ssm.call_count == 2
+    mock_invoke.assert_called_once_with([], ['blah'], None, LOCAL_TARGET, None)
+
+@patch('runcommand_helper.invoke_helper')
+def test_handle_with_target(mock_invoke):
+    """
+    Test the handle function sends to the target named in the event and
+    hands off to it
+    """
+    ssm = MagicMock()
+    clients.set_client('ssm', ssm, 'eu-west-1')
+    clients.set_client('lambda', MagicMock())
+    event = {
+        "ChunkedInstanceIds": [['i-1'], ['i-2']],
+        "Commands": ["blah"],
+        "Target": {"Region": "eu-west-1", "RoleArn": None}
+    }
+    context = MagicMock()
+    context.get_remaining_time_in_millis.side_effect = [60000, 0]
+    with patch('runcommand_helper.DISPATCH_WORKERS', 1):
+        assert handle(event, context) is True
+    ssm.send_command.assert_called_once()
+    assert mock_invoke.call_args[0][0]['ChunkedInstanceIds'] == [['i-2']]
+    assert mock_invoke.call_args[0][0]['Target'] == event['Target']
 
 def test_handle_with_typeerror():
     """
@@ -135,3 +295,178 @@ def test_handle_with_keyerror():
         "Blah": ["blah"]
     }
     assert handle(event, 'blah') is False
+
+def test_send_run_command_with_comment():
+    """
+    Test the send_run_command function marks commands with the comment
+    """
+    ssm = MagicMock()
+    assert send_run_command(['i-12345678'], ['blah'], ssm, 'GARLC job') is True
+    assert ssm.send_command.call_args[1]['Comment'] == 'GARLC job'
+
+@patch('runcommand_helper.invoke_helper')
+@patch('runcommand_helper.HELPER_FANOUT', 2)
+def test_fan_out_manifest(mock_invoke):
+    """
+    Test fan_out_manifest only passes the manifest reference and ranges
+    """
+    mock_invoke.return_value = True
+    manifest = {'Bucket': 'bucket', 'Key': 'key'}
+    assert fan_out_manifest(manifest, 2, 7) is True
+    assert [call[0][0] for call in mock_invoke.call_args_list] == [
+        {'Manifest': manifest, 'Start': 2, 'End': 5},
+        {'Manifest': manifest, 'Start': 5, 'End': 7}
+    ]
+    mock_invoke.reset_mock()
+    assert fan_out_manifest(manifest, 7, 7) is True
+    assert mock_invoke.call_count == 0
+
+@patch('runcommand_helper.fan_out_manifest')
+@patch('runcommand_helper.dispatch_chunks')
+@patch('runcommand_helper.load_manifest')
+def test_handle_with_manifest(mock_load, mock_dispatch, mock_fan_out):
+    """
+    Test the handle function sends its range of the manifest and hands off
+    the rest as a range
+    """
+    mock_load.return_value = {
+        'ChunkedInstanceIds': [['i-1'], ['i-2'], ['i-3'], ['i-4']],
+        'Commands': ['blah'],
+        'Comment': 'GARLC job'
+    }
+    mock_dispatch.return_value = ([['i-3']], [])
+    event = {'Manifest': {'Bucket': 'bucket', 'Key': 'key'}, 'Start': 1, 'End': 3}
+    assert handle(event, 'blah') is True
+    mock_load.assert_called_once_with('bucket', 'key')
+    mock_dispatch.assert_called_once_with([['i-2'], ['i-3']], ['blah'], 'blah', 'GARLC job',
+                                          LOCAL_TARGET)
+    mock_fan_out.assert_called_once_with(event['Manifest'], 2, 3)
+
+@patch('runcommand_helper.load_manifest')
+def test_handle_with_missing_manifest(mock_load):
+    """
+    Test the handle function gives up when the manifest can't be read
+    """
+    mock_load.side_effect = ClientError(
+        {'Error': {'Code': 'NoSuchKey', 'Message': 'Not found'}}, 'GetObject')
+    event = {'Manifest': {'Bucket': 'bucket', 'Key': 'key'}, 'Start': 0, 'End': 1}
+    assert handle(event, 'blah') is False
+
+def test_send_run_command_with_document():
+    """
+    Test the send_run_command function runs a deploy document
+    """
+    ssm = MagicMock()
+    document = {'DocumentName': 'GARLC-Deploy', 'Parameters': {'artifact': ['s3://b/a']}}
+    assert send_run_command(['i-12345678'], document, ssm) is True
+    ssm.send_command.assert_called_once_with(
+        InstanceIds=['i-12345678'], DocumentName='GARLC-Deploy',
+        Parameters={'artifact': ['s3://b/a']}, TimeoutSeconds=900
+    )
+
+def test_send_run_command_with_ledger(tmpdir):
+    """
+    Test a chunk is sent once per job and its CommandId recorded, and a
+    failed chunk is sent again
+    """
+    ledger = SQLiteStore(str(tmpdir.join('ledger.db')))
+    ssm = MagicMock()
+    ssm.send_command.return_value = {'Command': {'CommandId': 'c-1'}}
+    assert send_run_command(['i-1'], ['blah'], ssm, 'GARLC job', ledger=ledger) is True
+    assert send_run_command(['i-1'], ['blah'], ssm, 'GARLC job', ledger=ledger) is True
+    assert ssm.send_command.call_count == 1
+    assert [chunk['CommandId'] for chunk in ledger.chunks('GARLC job').values()] == ['c-1']
+
+    ssm.send_command.side_effect = [
+        ClientError({'Error': {'Code': 'InvalidInstanceId', 'Message': ''}}, 'SendCommand'),
+        {'Command': {'CommandId': 'c-2'}}
+    ]
+    assert send_run_command(['i-2'], ['blah'], ssm, 'GARLC job', ledger=ledger) is False
+    assert send_run_command(['i-2'], ['blah'], ssm, 'GARLC job', ledger=ledger) is True
+    assert ssm.send_command.call_count == 3
+
+@patch('runcommand_helper.fan_out_manifest')
+@patch('runcommand_helper.dispatch_chunks')
+@patch('runcommand_helper.load_manifest')
+def test_handle_retried_when_handoff_fails(mock_load, mock_dispatch, mock_fan_out, tmpdir):
+    """
+    Test the handle function fails, for Lambda to retry it, when the rest of
+    the chunks can't be handed off and the ledger makes retrying safe
+    """
+    mock_load.return_value = {'ChunkedInstanceIds': [['i-1'], ['i-2']],
+                              'Commands': ['blah'], 'Comment': 'GARLC job'}
+    mock_dispatch.return_value = ([['i-2']], [])
+    mock_fan_out.return_value = False
+    event = {'Manifest': {'Bucket': 'bucket', 'Key': 'key'}, 'Start': 0, 'End': None}
+    assert handle(dict(event), 'blah') is True
+    with patch('runcommand_helper.get_ledger') as mock_ledger:
+        mock_ledger.return_value = SQLiteStore(str(tmpdir.join('ledger.db')))
+        with pytest.raises(RuntimeError):
+            handle(dict(event), 'blah')
+    mock_fan_out.assert_called_with(event['Manifest'], 1, 2)
+
+@patch('runcommand_helper.save_failure')
+@patch('runcommand_helper.invoke_lambda')
+def test_handle_records_failed_chunks(mock_invoke, mock_save):
+    """
+    Test the handle function records the chunks SendCommand rejects where
+    the event says, and hands off where to record them
+    """
+    ssm = MagicMock()
+    clients.set_client('ssm', ssm)
+    ssm.send_command.side_effect = ClientError(
+        {'Error': {'Code': 'InvalidInstanceId', 'Message': ''}}, 'SendCommand')
+    mock_invoke.return_value = True
+    failures = {'Bucket': 'bucket', 'Prefix': 'garlc-manifests/job/failed/all/'}
+    event = {
+        "ChunkedInstanceIds": [['i-1'], ['i-2']],
+        "Commands": ["blah"],
+        "Failures": failures
+    }
+    assert handle(event, 'blah') is True
+    assert sorted(call[0][2] for call in mock_save.call_args_list) == [['i-1'], ['i-2']]
+    assert mock_save.call_args[0][0] == failures
+    mock_invoke.assert_called_once_with([], ['blah'], None, LOCAL_TARGET, failures)
+
+@patch('runcommand_helper.save_failure')
+@patch('runcommand_helper.invoke_helper')
+@patch('runcommand_helper.target_client')
+def test_handle_without_ssm_client(mock_target_client, mock_invoke, mock_save):
+    """
+    Test the handle function records every chunk as failed, and invokes no
+    other helper, when the target's role cannot be assumed
+    """
+    mock_target_client.side_effect = ClientError(
+        {'Error': {'Code': 'AccessDenied', 'Message': ''}}, 'AssumeRole')
+    failures = {'Bucket': 'bucket', 'Prefix': 'garlc-manifests/job/failed/all/'}
+    event = {
+        "ChunkedInstanceIds": [['i-1'], ['i-2']],
+        "Commands": ["blah"],
+        "Target": {"Region": "eu-west-1",
+                   "RoleArn": "arn:aws:iam::123456789012:role/garlc_target_role"},
+        "Failures": failures
+    }
+    assert handle(event, 'blah') is True
+    assert sorted(call[0][2] for call in mock_save.call_args_list) == [['i-1'], ['i-2']]
+    assert mock_invoke.call_count == 0
+
+@patch('runcommand_helper.get_ledger')
+def test_handle_retry_resends_its_claims(mock_ledger, tmpdir):
+    """
+    Test a retry of an invocation, with the same request ID, sends the
+    chunks it claimed before it failed, and another invocation does not
+    """
+    store = SQLiteStore(str(tmpdir.join('ledger.db')))
+    mock_ledger.return_value = store
+    store.claim('GARLC job', chunk_key(['i-1']), time.time(), 'request-1')
+    ssm = MagicMock()
+    clients.set_client('ssm', ssm)
+    clients.set_client('lambda', MagicMock())
+    event = {"ChunkedInstanceIds": [['i-1']], "Commands": ["blah"], "Comment": "GARLC job"}
+    context = MagicMock(aws_request_id='request-2')
+    context.get_remaining_time_in_millis.return_value = 60000
+    assert handle(dict(event), context) is True
+    assert ssm.send_command.call_count == 0
+    context.aws_request_id = 'request-1'
+    assert handle(dict(event), context) is True
+    assert ssm.send_command.call_count == 1
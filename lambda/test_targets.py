@@ -0,0 +1,74 @@
+"""
+Unit Tests for the targets module
+"""
+import pytest
+from mock import patch
+from targets import LOCAL_TARGET
+from targets import Target
+from targets import budget
+from targets import event_target
+from targets import is_local
+from targets import map_targets
+from targets import parse_targets
+from targets import target_event
+from targets import target_name
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/garlc_target_role'
+
+def test_parse_targets():
+    """
+    Test targets are read from lists, their JSON and region lists
+    """
+    assert parse_targets('') == [LOCAL_TARGET]
+    assert parse_targets([]) == [LOCAL_TARGET]
+    assert parse_targets('us-east-1, eu-west-1,') == [
+        Target('us-east-1', None), Target('eu-west-1', None)]
+    assert parse_targets(['', {'Region': 'eu-west-1', 'RoleArn': ROLE_ARN}, 'eu-west-1']) == [
+        LOCAL_TARGET, Target('eu-west-1', ROLE_ARN), Target('eu-west-1', None)]
+    assert parse_targets('[{"Region": "eu-west-1"}, "eu-west-1"]') == [Target('eu-west-1', None)]
+
+def test_parse_targets_invalid():
+    """
+    Test invalid targets are refused
+    """
+    with pytest.raises(ValueError):
+        parse_targets([{'Region': 'eu-west-1', 'Role': ROLE_ARN}])
+    with pytest.raises(ValueError):
+        parse_targets([1])
+    with pytest.raises(ValueError):
+        parse_targets({'Region': 'eu-west-1'})
+    with pytest.raises(ValueError):
+        parse_targets('[blah')
+
+@patch.dict('os.environ', {'AWS_REGION': 'us-east-1'})
+def test_target_name_and_budget():
+    """
+    Test targets are named by account and region, and only other regions
+    and accounts get budgets of their own
+    """
+    assert target_name(LOCAL_TARGET) == 'us-east-1'
+    assert target_name(Target('eu-west-1', ROLE_ARN)) == '123456789012/eu-west-1'
+    assert budget(LOCAL_TARGET) is None
+    assert budget(Target('us-east-1', None)) is None
+    assert budget(Target('eu-west-1', None)) == 'eu-west-1'
+    assert budget(Target(None, ROLE_ARN)) == '123456789012/us-east-1'
+    assert is_local([LOCAL_TARGET])
+    assert not is_local([LOCAL_TARGET, Target('eu-west-1', None)])
+
+def test_target_event():
+    """
+    Test targets survive being passed in events
+    """
+    target = Target('eu-west-1', ROLE_ARN)
+    assert event_target(target_event(target)) == target
+    assert target_event(LOCAL_TARGET) is None
+    assert event_target(None) == LOCAL_TARGET
+
+def test_map_targets():
+    """
+    Test map_targets keeps the order of the targets
+    """
+    targets = [Target('region-%d' % i, None) for i in range(20)]
+    assert map_targets(lambda target: target.region, targets) == \
+        ['region-%d' % i for i in range(20)]
+    assert map_targets(lambda target: target, []) == []
@@ -0,0 +1,134 @@
+"""
+Unit Tests for the throttling module
+"""
+import pytest
+from mock import patch, MagicMock
+from botocore.exceptions import ClientError
+import throttling
+from throttling import TokenBucket
+from throttling import get_bucket
+from throttling import is_throttling_error
+from throttling import backoff_delay
+from throttling import call
+
+def throttling_error(code='ThrottlingException'):
+    """
+    Returns a ClientError as raised for a throttled call
+    """
+    return ClientError({'Error': {'Code': code, 'Message': 'Rate exceeded'}}, 'SendCommand')
+
+@patch('throttling.now')
+def test_token_bucket(mock_now):
+    """
+    Test the token bucket hands out its capacity and then refills at its rate
+    """
+    mock_now.return_value = 100.0
+    bucket = TokenBucket(2)
+    assert bucket.wait_time() == 0
+    assert bucket.wait_time() == 0
+    assert bucket.wait_time() == 0.5
+    mock_now.return_value = 100.5
+    assert bucket.wait_time() == 0
+
+@patch('throttling.sleep')
+@patch('throttling.now')
+def test_token_bucket_acquire_waits(mock_now, mock_sleep):
+    """
+    Test acquire sleeps until a token is available
+    """
+    mock_now.return_value = 100.0
+    bucket = TokenBucket(1)
+    bucket.acquire()
+
+    def advance(seconds):
+        mock_now.return_value += seconds
+    mock_sleep.side_effect = advance
+    bucket.acquire()
+    mock_sleep.assert_called_once_with(1.0)
+
+def test_get_bucket():
+    """
+    Test a bucket is shared per service
+    """
+    assert get_bucket('ssm') is get_bucket('ssm')
+    assert get_bucket('ssm') is not get_bucket('ec2')
+    assert get_bucket('ssm').rate == throttling.RATES['ssm']
+    assert get_bucket('sqs').rate == throttling.DEFAULT_RATE
+
+def test_is_throttling_error():
+    """
+    Test is_throttling_error recognises throttles by code and message
+    """
+    assert is_throttling_error(throttling_error())
+    assert is_throttling_error(throttling_error('RequestLimitExceeded'))
+    assert is_throttling_error(
+        ClientError({'Error': {'Code': 400, 'Message': 'ThrottlingException'}}, 'blah')
+    )
+    assert not is_throttling_error(throttling_error('InvalidInstanceId'))
+
+@patch('throttling.random.uniform')
+def test_backoff_delay(mock_uniform):
+    """
+    Test the backoff window doubles per attempt and is capped
+    """
+    mock_uniform.side_effect = lambda low, high: high
+    assert backoff_delay(1) == throttling.BASE_DELAY * 2
+    assert backoff_delay(2) == throttling.BASE_DELAY * 4
+    assert backoff_delay(100) == throttling.MAX_DELAY
+
+def test_call():
+    """
+    Test call passes keyword arguments through and returns the result
+    """
+    func = MagicMock(return_value={'Command': {'CommandId': '1'}})
+    assert call('ssm', func, InstanceIds=['i-1']) == {'Command': {'CommandId': '1'}}
+    func.assert_called_once_with(InstanceIds=['i-1'])
+
+@patch('throttling.sleep')
+def test_call_retries_throttles(mock_sleep):
+    """
+    Test call retries throttled calls with a delay
+    """
+    func = MagicMock(side_effect=[throttling_error(), throttling_error(), 'ok'])
+    assert call('ssm', func) == 'ok'
+    assert func.call_count == 3
+    assert mock_sleep.call_count >= 2
+
+@patch('throttling.sleep')
+def test_call_gives_up_after_max_attempts(mock_sleep):
+    """
+    Test call raises the throttling error after max_attempts
+    """
+    func = MagicMock(side_effect=throttling_error())
+    with pytest.raises(ClientError):
+        call('ssm', func, max_attempts=3)
+    assert func.call_count == 3
+
+@patch('throttling.sleep')
+@patch('throttling.now')
+def test_call_respects_deadline(mock_now, mock_sleep):
+    """
+    Test call does not retry past its deadline
+    """
+    mock_now.return_value = 100.0
+    func = MagicMock(side_effect=throttling_error())
+    with pytest.raises(ClientError):
+        call('ec2', func, deadline=100.0)
+    assert func.call_count == 1
+
+def test_call_does_not_retry_other_errors():
+    """
+    Test call raises errors other than throttling straight away
+    """
+    func = MagicMock(side_effect=throttling_error('InvalidInstanceId'))
+    with pytest.raises(ClientError):
+        call('ssm', func)
+    assert func.call_count == 1
+
+def test_get_bucket_per_budget():
+    """
+    Test other regions and accounts get buckets of their own
+    """
+    assert get_bucket('ssm', 'eu-west-1') is get_bucket('ssm', 'eu-west-1')
+    assert get_bucket('ssm', 'eu-west-1') is not get_bucket('ssm')
+    assert get_bucket('ssm', 'eu-west-1').rate == throttling.RATES['ssm']
@@ -0,0 +1,207 @@
+"""
+Unit Tests for the tracking module
+"""
+import time
+import pytest
+from mock import patch, MagicMock
+import clients
+import tracking
+from tracking import command_comment
+from tracking import new_state
+from tracking import encode_state
+from tracking import decode_state
+from tracking import Progress
+from tracking import check_progress
+from tracking import failed_instances
+from tracking import poll
+from tracking import poll_due
+from tracking import stalled
+from tracking import waiting_summary
+from targets import LOCAL_TARGET
+from targets import Target
+
+def command(command_id, status, targets, completed, errors=0, job_id='job'):
+    """
+    Returns a command as listed by ListCommands
+    """
+    return {
+        'CommandId': command_id,
+        'Comment': command_comment(job_id),
+        'Status': status,
+        'TargetCount': targets,
+        'CompletedCount': completed,
+        'ErrorCount': errors
+    }
+
+def test_command_comment():
+    """
+    Test command_comment stays within the SendCommand limit
+    """
+    assert command_comment('job') == 'GARLC job'
+    assert len(command_comment('x' * 200)) == 100
+
+def test_state_round_trip():
+    """
+    Test the state survives a continuation token
+    """
+    state = new_state(10)
+    assert decode_state(encode_state(state)) == state
+    assert len(encode_state(state)) < 2048
+
+def test_progress():
+    """
+    Test Progress sums commands and knows when the deployment is done
+    """
+    progress = Progress(4)
+    progress.add(command('c-1', 'Success', 2, 2))
+    assert not progress.done
+    progress.add(command('c-2', 'InProgress', 2, 1))
+    assert not progress.done
+    assert progress.percent_complete == 75
+    progress = Progress(4)
+    progress.add(command('c-1', 'Success', 2, 2))
+    progress.add(command('c-2', 'Failed', 2, 2, errors=1))
+    assert progress.done
+    assert not progress.succeeded
+    assert progress.failed_command_ids == ['c-2']
+    assert progress.summary() == '4 of 4 instances finished, 1 failed'
+
+@patch('boto3.client')
+def test_check_progress(mock_client):
+    """
+    Test check_progress only counts the job's commands across pages
+    """
+    ssm = MagicMock()
+    mock_client.return_value = ssm
+    ssm.list_commands.side_effect = [
+        {'Commands': [command('c-1', 'Success', 2, 2),
+                      command('c-2', 'Success', 5, 5, job_id='other')],
+         'NextToken': 'page-2'},
+        {'Commands': [command('c-3', 'Success', 1, 1)]}
+    ]
+    progress = check_progress('job', new_state(3))
+    assert progress.succeeded
+    assert progress.targets == 3
+    assert ssm.list_commands.call_args[1]['NextToken'] == 'page-2'
+    assert ssm.list_commands.call_args[1]['Filters'][0]['key'] == 'InvokedAfter'
+
+@patch('boto3.client')
+def test_check_progress_of_started_job(mock_client):
+    """
+    Test check_progress counts the commands of the job that started the
+    deployment, not those of the continuation's job
+    """
+    ssm = MagicMock()
+    mock_client.return_value = ssm
+    ssm.list_commands.return_value = {'Commands': [
+        command('c-1', 'Success', 2, 2, job_id='started'),
+        command('c-2', 'Success', 2, 2, job_id='continued')
+    ]}
+    progress = check_progress('continued', new_state(2, 'started'))
+    assert progress.succeeded
+    assert progress.targets == 2
+
+@patch('boto3.client')
+def test_failed_instances(mock_client):
+    """
+    Test failed_instances names the instances whose invocations failed
+    """
+    ssm = MagicMock()
+    mock_client.return_value = ssm
+    ssm.list_command_invocations.return_value = {'CommandInvocations': [
+        {'InstanceId': 'i-1', 'Status': 'Success'},
+        {'InstanceId': 'i-2', 'Status': 'Failed'},
+        {'InstanceId': 'i-3', 'Status': 'TimedOut'}
+    ]}
+    assert failed_instances(['c-1']) == ['i-2', 'i-3']
+    ssm.list_command_invocations.assert_called_once_with(CommandId='c-1')
+
+def test_check_progress_across_targets():
+    """
+    Test check_progress sums the commands of every target instances were
+    handed off to, and remembers where failed commands were sent
+    """
+    local, remote, idle = MagicMock(), MagicMock(), MagicMock()
+    local.list_commands.return_value = {'Commands': [command('c-1', 'Success', 2, 2)]}
+    remote.list_commands.return_value = {'Commands': [command('c-1', 'Failed', 1, 1, 1)]}
+    clients.set_client('ssm', local)
+    clients.set_client('ssm', remote, 'eu-west-1')
+    clients.set_client('ssm', idle, 'ap-south-1')
+    targets = [LOCAL_TARGET, Target('eu-west-1', None), Target('ap-south-1', None)]
+    state = new_state(3)
+    state['Targets'] = [2, 1, 0]
+    progress = check_progress('job', state, targets)
+    assert progress.done and not progress.succeeded
+    assert progress.command_targets == {'c-1': targets[1]}
+    assert idle.list_commands.call_count == 0
+    with pytest.raises(ValueError):
+        check_progress('job', state, targets[:2])
+
+def test_failed_instances_across_targets():
+    """
+    Test failed_instances asks the target each command was sent to
+    """
+    local, remote = MagicMock(), MagicMock()
+    local.list_command_invocations.return_value = {'CommandInvocations': [
+        {'InstanceId': 'i-1', 'Status': 'Failed'}]}
+    remote.list_command_invocations.return_value = {'CommandInvocations': [
+        {'InstanceId': 'i-2', 'Status': 'Failed'}]}
+    clients.set_client('ssm', local)
+    clients.set_client('ssm', remote, 'eu-west-1')
+    assert failed_instances(['c-1', 'c-2'], {'c-2': Target('eu-west-1', None)}) == \
+        ['i-1', 'i-2']
+
+def test_stalled():
+    """
+    Test a deployment is stalled once every command sent has finished for
+    a while without all of its instances having been sent one
+    """
+    progress = Progress(3)
+    progress.add(command('c-1', 'Success', 2, 2))
+    state = new_state(3)
+    assert not stalled(progress, state)
+    state['Started'] -= tracking.RESUME_AFTER_SECONDS + 1
+    assert stalled(progress, state)
+    state['Resumed'] = int(time.time())
+    assert not stalled(progress, state)
+    state.update({'Resumed': 0, 'Resumes': tracking.MAX_RESUMES})
+    assert not stalled(progress, state)
+    progress.add(command('c-2', 'Success', 1, 1))
+    assert not stalled(progress, new_state(3))
+
+@patch('tracking.check_progress')
+def test_poll_backs_off_while_nothing_changes(mock_check):
+    """
+    Test poll checks once, doubling the interval before the next check
+    while no further instance finishes and keeping when it is due
+    """
+    running = Progress(2)
+    running.add(command('c-1', 'InProgress', 2, 0))
+    finished = Progress(2)
+    finished.add(command('c-1', 'InProgress', 2, 1))
+    mock_check.side_effect = [running, running, running, finished]
+    state = new_state(2)
+    intervals = []
+    for expected in (running, running, running, finished):
+        assert poll('job', state) is expected
+        intervals.append(state['Interval'])
+    assert mock_check.call_count == 4
+    assert intervals == [tracking.POLL_MIN_SECONDS, tracking.POLL_MIN_SECONDS * 2,
+                         tracking.POLL_MIN_SECONDS * 4, tracking.POLL_MIN_SECONDS]
+    assert state['Completed'] == 1
+    assert state['NotBefore'] <= time.time() + tracking.POLL_MIN_SECONDS
+
+def test_poll_due():
+    """
+    Test a check is due straight away, and then once its interval has passed
+    """
+    state = new_state(4)
+    assert poll_due(state)
+    state.update({'NotBefore': int(time.time()) + 30, 'Completed': 1})
+    assert not poll_due(state)
+    summary, percent_complete = waiting_summary(state)
+    assert summary.startswith('Next check in') and \
+        summary.endswith('1 of 4 instances finished')
+    assert percent_complete == 25
+    state['NotBefore'] = int(time.time()) - 1
+    assert poll_due(state)
@@ -0,0 +1,139 @@
+"""
+Rate limiting and retries shared by every AWS API call GARLC makes.  Calls to
+a service first take a token from that service's bucket so concurrent callers
+stay under the account's API rate, and throttled calls are retried with capped
+exponential backoff and full jitter until they succeed, run out of attempts
+or would overrun a deadline.  Calls to other regions and accounts draw from
+budgets of their own, as AWS applies its limits per account and region.
+"""
+import logging
+import os
+import random
+import threading
+from time import sleep, time as now
+from botocore.exceptions import ClientError
+import metrics
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'TooManyRequestsException',
+    'SlowDown'
+)
+
+# Sustained calls per second allowed for each service, sized to the account's
+# API limits (in each region).  Services not listed use GARLC_DEFAULT_TPS.
+RATES = {
+    'ssm': float(os.environ.get('GARLC_SSM_TPS', '5')),
+    'ec2': float(os.environ.get('GARLC_EC2_TPS', '20')),
+    'lambda': float(os.environ.get('GARLC_LAMBDA_TPS', '20')),
+    'dynamodb': float(os.environ.get('GARLC_DYNAMODB_TPS', '50'))
+}
+DEFAULT_RATE = float(os.environ.get('GARLC_DEFAULT_TPS', '10'))
+
+# Attempts made before a throttled call is given up on
+MAX_ATTEMPTS = int(os.environ.get('GARLC_MAX_ATTEMPTS', '8'))
+# Seconds the first retry waits at most, doubling on each attempt up to MAX_DELAY
+BASE_DELAY = float(os.environ.get('GARLC_BASE_DELAY', '0.1'))
+MAX_DELAY = float(os.environ.get('GARLC_MAX_DELAY', '5'))
+
+BUCKETS = {}
+BUCKETS_LOCK = threading.Lock()
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket refilled at rate tokens per second and holding
+    at most capacity tokens (one second worth by default)
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = now()
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        """
+        Takes a token if one is available and returns 0, otherwise returns
+        the seconds until one will be
+        """
+        with self.lock:
+            current = now()
+            elapsed = max(current - self.updated, 0)
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = current
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """
+        Blocks until a token has been taken
+        """
+        delay = self.wait_time()
+        while delay > 0:
+            sleep(delay)
+            delay = self.wait_time()
+
+def get_bucket(service, budget=None):
+    """
+    Returns the token bucket shared by all calls to service in budget (a
+    region and account, None for this function's own)
+    """
+    key = (service, budget)
+    with BUCKETS_LOCK:
+        if key not in BUCKETS:
+            BUCKETS[key] = TokenBucket(RATES.get(service, DEFAULT_RATE))
+        return BUCKETS[key]
+
+def is_throttling_error(err):
+    """
+    Returns True if the ClientError means the call was throttled
+    """
+    code = err.response.get('Error', {}).get('Code')
+    return code in THROTTLING_ERROR_CODES or 'ThrottlingException' in str(err)
+
+def backoff_delay(attempt):
+    """
+    Returns a random delay, with full jitter, before retrying the given attempt
+    """
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+def call(service, func, max_attempts=None, deadline=None, budget=None, **kwargs):
+    """
+    Calls func(**kwargs) once service's rate in budget allows, retrying while
+    it is throttled.  The last ClientError is raised once max_attempts calls
+    have been throttled or the next retry would start after deadline (a
+    time.time() value).
+    """
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    bucket = get_bucket(service, budget)
+    name = '%s.%s' % (service, getattr(func, '__name__', 'call'))
+    attempt = 0
+    while True:
+        with metrics.span(service + '.RateLimitWait'):
+            bucket.acquire()
+        try:
+            with metrics.span(name):
+                return func(**kwargs)
+        except ClientError as err:
+            attempt += 1
+            if not is_throttling_error(err):
+                raise
+            metrics.count(name + '.Throttled')
+            if attempt >= max_attempts:
+                raise
+            delay = backoff_delay(attempt)
+            if deadline is not None and now() + delay > deadline:
+                raise
+            LOGGER.info("%s call throttled, retrying in %.2fs (attempt %d of %d)",
+                        service, delay, attempt + 1, max_attempts)
+            metrics.count(name + '.Retries')
+            sleep(delay)
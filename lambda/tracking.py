@@ -0,0 +1,299 @@
+"""
+Tracks the Run Command jobs of a deployment until every instance has run the
+commands.  Commands sent for a CodePipeline job carry the job ID in their
+Comment, so the progress of the whole deployment can be read back in bulk
+with ListCommands, in each target the deployment reached at the same time.
+Each invocation checks once, and between checks the state of a deployment is
+kept in a CodePipeline continuation token, along with the time the next check
+is due, so no Lambda function sits idle waiting.  CodePipeline
+gives each continuation a job ID of its own, so the state keeps the ID of the
+job that started the deployment.  Instances in chunks the helper failed to
+send count as failed, so the deployment fails once the rest have finished.
+"""
+import datetime
+import json
+import logging
+import os
+import time
+from manifests import failures_prefix
+from manifests import read_failures
+from targets import LOCAL_TARGET
+from targets import budget
+from targets import map_targets
+from targets import target_client
+from throttling import call
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+# Seconds between checks, doubling from the minimum while nothing changes
+POLL_MIN_SECONDS = float(os.environ.get('GARLC_POLL_MIN_SECONDS', '5'))
+POLL_MAX_SECONDS = float(os.environ.get('GARLC_POLL_MAX_SECONDS', '60'))
+# Seconds a deployment may take before it is failed
+TRACKING_TIMEOUT_SECONDS = int(os.environ.get('GARLC_TRACKING_TIMEOUT_SECONDS', '3600'))
+# Seconds a deployment may go without sending to instances still waiting for
+# their commands before it is resumed, and the most times a deployment (or a
+# wave of one) is resumed
+RESUME_AFTER_SECONDS = int(os.environ.get('GARLC_RESUME_AFTER_SECONDS', '300'))
+MAX_RESUMES = int(os.environ.get('GARLC_MAX_RESUMES', '3'))
+# Failed instances named in a failure message
+MAX_REPORTED_FAILURES = 10
+
+PENDING_STATUSES = ('Pending', 'InProgress', 'Cancelling')
+FAILED_STATUSES = ('Failed', 'TimedOut', 'Cancelled')
+
+def command_comment(job_id, wave=None):
+    """
+    Returns the Comment that marks a command as part of job_id's deployment,
+    or of one wave of it
+    """
+    comment = 'GARLC ' + str(job_id)
+    if wave is not None:
+        comment += ' wave %d' % wave
+    return comment[:100]
+
+def new_state(instance_count, job_id=None):
+    """
+    Returns the tracking state of a deployment to instance_count instances
+    that job_id starts now
+    """
+    state = {'Started': int(time.time()), 'Instances': instance_count,
+             'Interval': POLL_MIN_SECONDS}
+    if job_id is not None:
+        state['JobId'] = job_id
+    return state
+
+def deployment_job(job_id, state):
+    """
+    Returns the ID of the job that started the deployment state tracks,
+    which commands, manifests and plans are named by, when job_id is the
+    current job's
+    """
+    return state.get('JobId', job_id)
+
+def encode_state(state):
+    """
+    Returns state as a continuation token
+    """
+    return json.dumps(state, sort_keys=True)
+
+def decode_state(token):
+    """
+    Returns the state held in a continuation token
+    """
+    state = json.loads(token)
+    state.update({
+        'Started': int(state['Started']),
+        'Instances': int(state['Instances']),
+        'Interval': float(state.get('Interval', POLL_MIN_SECONDS))
+    })
+    return state
+
+class Progress(object):
+    """
+    Progress of a deployment, summed over its commands
+    """
+    def __init__(self, instance_count):
+        self.instance_count = instance_count
+        self.targets = 0
+        self.completed = 0
+        self.errors = 0
+        self.pending_commands = 0
+        self.failed_command_ids = []
+        # Target of each failed command sent outside this region and account
+        self.command_targets = {}
+        self.unsent_instance_ids = []
+
+    def add(self, command, target=LOCAL_TARGET):
+        """
+        Adds a command returned by ListCommands in target
+        """
+        self.targets += command.get('TargetCount', 0)
+        self.completed += command.get('CompletedCount', 0)
+        self.errors += command.get('ErrorCount', 0)
+        if command['Status'] in PENDING_STATUSES:
+            self.pending_commands += 1
+        elif command['Status'] in FAILED_STATUSES or command.get('ErrorCount', 0):
+            self.failed_command_ids.append(command['CommandId'])
+            if target != LOCAL_TARGET:
+                self.command_targets[command['CommandId']] = target
+
+    def add_unsent(self, instance_ids):
+        """
+        Adds instances the helper failed to send the commands to, which count
+        as failed
+        """
+        self.targets += len(instance_ids)
+        self.errors += len(instance_ids)
+        self.unsent_instance_ids.extend(instance_ids)
+
+    @property
+    def done(self):
+        """
+        True once every instance has been sent a command that has finished
+        """
+        return self.targets >= self.instance_count and self.pending_commands == 0
+
+    @property
+    def succeeded(self):
+        """
+        True once every instance has run the commands successfully
+        """
+        return self.done and self.errors == 0 and not self.failed_command_ids
+
+    @property
+    def percent_complete(self):
+        """
+        Percentage of the instances that have finished
+        """
+        if self.instance_count == 0:
+            return 100
+        return min(int(100 * self.completed / float(self.instance_count)), 100)
+
+    def summary(self):
+        """
+        Returns a one line summary for CodePipeline
+        """
+        return '%d of %d instances finished, %d failed' % (
+            self.completed, self.instance_count, self.errors)
+
+def list_deployment_commands(job_id, started, wave=None, target=LOCAL_TARGET):
+    """
+    Yields the commands sent to target for job_id's deployment (or one wave
+    of it) since started (a time.time() value), reading every page of
+    ListCommands
+    """
+    ssm = target_client('ssm', target)
+    comment = command_comment(job_id, wave)
+    invoked_after = datetime.datetime.utcfromtimestamp(started - 60)
+    kwargs = {'Filters': [
+        {'key': 'InvokedAfter', 'value': invoked_after.strftime('%Y-%m-%dT%H:%M:%SZ')}
+    ]}
+    while True:
+        page = call('ssm', ssm.list_commands, budget=budget(target), **kwargs)
+        for command in page.get('Commands', []):
+            if command.get('Comment') == comment:
+                yield command
+        if not page.get('NextToken'):
+            return
+        kwargs['NextToken'] = page['NextToken']
+
+def tracked_targets(state, targets=None):
+    """
+    Returns the targets commands were sent to.  The Targets of the state
+    hold the number of instances handed off to each of targets, and a state
+    without them is of a deployment to this region and account only.
+    """
+    if 'Targets' not in state:
+        return [LOCAL_TARGET]
+    if targets is None or len(targets) != len(state['Targets']):
+        raise ValueError('The targets of the deployment have changed')
+    return [target for target, count in zip(targets, state['Targets']) if count]
+
+def check_progress(job_id, state, targets=None, bucket=None):
+    """
+    Returns the Progress of job_id's deployment, over all of its targets,
+    along with the chunks recorded in bucket as failed to send
+    """
+    def list_commands(target):
+        """Lists the commands sent to one target"""
+        return target, list(list_deployment_commands(deployment_job(job_id, state),
+                                                     state['Started'], state.get('Wave'),
+                                                     target))
+
+    progress = Progress(state['Instances'])
+    for target, commands in map_targets(list_commands, tracked_targets(state, targets)):
+        for command in commands:
+            progress.add(command, target)
+    if bucket is not None:
+        progress.add_unsent(read_failures(bucket, failures_prefix(deployment_job(job_id, state),
+                                                                  state.get('Wave'))))
+    return progress
+
+def failed_instances(command_ids, command_targets=None):
+    """
+    Returns up to MAX_REPORTED_FAILURES instances that failed to run the
+    given commands, each sent to the target in command_targets or to this
+    region and account
+    """
+    instance_ids = []
+    for command_id in command_ids:
+        target = (command_targets or {}).get(command_id, LOCAL_TARGET)
+        ssm = target_client('ssm', target)
+        kwargs = {'CommandId': command_id}
+        while len(instance_ids) < MAX_REPORTED_FAILURES:
+            page = call('ssm', ssm.list_command_invocations, budget=budget(target), **kwargs)
+            instance_ids.extend(
+                invocation['InstanceId'] for invocation in page.get('CommandInvocations', [])
+                if invocation['Status'] in FAILED_STATUSES
+            )
+            if not page.get('NextToken'):
+                break
+            kwargs['NextToken'] = page['NextToken']
+    return instance_ids[:MAX_REPORTED_FAILURES]
+
+def reported_failures(progress):
+    """
+    Returns up to MAX_REPORTED_FAILURES instances of progress that were never
+    sent their commands or failed to run them
+    """
+    instance_ids = progress.unsent_instance_ids[:MAX_REPORTED_FAILURES]
+    if len(instance_ids) < MAX_REPORTED_FAILURES:
+        instance_ids += failed_instances(progress.failed_command_ids, progress.command_targets)
+    return instance_ids[:MAX_REPORTED_FAILURES]
+
+def stalled(progress, state):
+    """
+    Returns True when some instances were never sent their commands, although
+    every command sent has finished, for RESUME_AFTER_SECONDS since the
+    deployment (or wave) started or was last resumed, and it may be resumed
+    again
+    """
+    if progress.pending_commands or progress.targets >= progress.instance_count:
+        return False
+    since = max(state['Started'], state.get('Resumed', 0))
+    return time.time() - since > RESUME_AFTER_SECONDS and \
+        state.get('Resumes', 0) < MAX_RESUMES
+
+def remaining_time_in_millis(context):
+    """
+    Returns the milliseconds left in this invocation, or None when the
+    context does not tell us (e.g. when invoked locally).
+    """
+    try:
+        return context.get_remaining_time_in_millis()
+    except AttributeError:
+        return None
+
+def poll_due(state):
+    """
+    Returns whether the next check of the deployment state tracks is due
+    """
+    return time.time() >= state.get('NotBefore', 0)
+
+def waiting_summary(state):
+    """
+    Returns the summary and percentage complete of a deployment whose next
+    check is not due yet, from what its last check found
+    """
+    progress = Progress(state['Instances'])
+    progress.completed = state.get('Completed', 0)
+    return 'Next check in %d seconds, %d of %d instances finished' % (
+        max(state['NotBefore'] - time.time(), 0), progress.completed,
+        progress.instance_count), progress.percent_complete
+
+def poll(job_id, state, targets=None, bucket=None):
+    """
+    Checks the progress of job_id's deployment once and returns it.  The
+    interval before the next check doubles, up to POLL_MAX_SECONDS, while no
+    further instance finishes, and the state keeps when that check is due.
+    """
+    progress = check_progress(job_id, state, targets, bucket)
+    LOGGER.info('Deployment %s: %s', job_id, progress.summary())
+    if progress.completed == state.get('Completed'):
+        state['Interval'] = min(state['Interval'] * 2, POLL_MAX_SECONDS)
+    else:
+        state['Interval'] = POLL_MIN_SECONDS
+    state['Completed'] = progress.completed
+    state['NotBefore'] = int(time.time() + state['Interval'])
+    return progress
@@ -1,7 +1,10 @@
 resource "aws_autoscaling_group" "asg" {
   lifecycle { create_before_destroy = true }
   name = "${var.asg_name}"
-  launch_configuration = "${var.lcid}"
+  launch_template {
+    id = "${var.lcid}"
+    version = "$Latest"
+  }
   max_size = "${var.max_size}"
   min_size = "${var.min_size}"
   desired_capacity = "${var.desired_capacity}"
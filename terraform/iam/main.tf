@@ -90,6 +90,18 @@ resource "aws_iam_role_policy" "ssm_policy" {
             ],
             "Resource": "*"
         },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "ec2:CreateTags"
+            ],
+            "Resource": "*",
+            "Condition": {
+                "ForAllValues:StringEquals": {
+                    "aws:TagKeys": ["GARLC_Version"]
+                }
+            }
+        },
         {
             "Effect": "Allow",
             "Action": [
@@ -73,6 +73,28 @@ resource "aws_iam_role_policy" "bootstrap_codepipeline_policy" {
 EOF
 }
 
+# Add SQS policy for receiving queued launch events
+resource "aws_iam_role_policy" "bootstrap_sqs_policy" {
+  name = "sqs_policy"
+  role = "${aws_iam_role.bootstrap_lambda_role.id}"
+  policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Action": [
+        "sqs:ReceiveMessage",
+        "sqs:DeleteMessage",
+        "sqs:GetQueueAttributes"
+      ],
+      "Resource": "${aws_sqs_queue.bootstrap_launches.arn}"
+    }
+  ]
+}
+EOF
+}
+
 # Add an SSM Policy
 resource "aws_iam_role_policy" "bootstrap_ssm_policy" {
   name = "ssm_policy"
@@ -149,17 +171,79 @@ resource "aws_cloudwatch_event_rule" "instance_running" {
 PATTERN
 }
 
-resource "aws_lambda_permission" "allow_cloudwatch" {
-    statement_id = "AllowExecutionFromCloudWatch"
-    action = "lambda:InvokeFunction"
-    function_name = "${aws_lambda_function.bootstrap_lambda_function.arn}"
-    principal = "events.amazonaws.com"
-    source_arn = "${aws_cloudwatch_event_rule.instance_running.arn}"
+# Batching mode: launch events are queued and delivered to the Lambda function
+# in batches of up to bootstrap_batch_size events, waiting at most
+# bootstrap_max_wait_seconds for a batch to fill.  Point the event target at the
+# Lambda function instead to bootstrap every instance with its own invocation.
+# A batch that fails is delivered again once its visibility timeout passes,
+# and is moved to the dead-letter queue after bootstrap_max_receives attempts.
+resource "aws_sqs_queue" "bootstrap_launches" {
+  name = "garlc_bootstrap_launches"
+  visibility_timeout_seconds = 300 # must cover the Lambda timeout
+  redrive_policy = "{\"deadLetterTargetArn\":\"${aws_sqs_queue.bootstrap_launches_dead.arn}\",\"maxReceiveCount\":${var.bootstrap_max_receives}}"
 }
 
-resource "aws_cloudwatch_event_target" "bootstrap_lambda" {
-  depends_on = ["aws_iam_role.bootstrap_lambda_role"] # we need the Lambda arn to exist
+resource "aws_sqs_queue" "bootstrap_launches_dead" {
+  name = "garlc_bootstrap_launches_dead"
+  message_retention_seconds = 1209600
+}
+
+resource "aws_sqs_queue_policy" "bootstrap_launches" {
+  queue_url = "${aws_sqs_queue.bootstrap_launches.id}"
+  policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Principal": {
+        "Service": "events.amazonaws.com"
+      },
+      "Action": "sqs:SendMessage",
+      "Resource": "${aws_sqs_queue.bootstrap_launches.arn}",
+      "Condition": {
+        "ArnEquals": {
+          "aws:SourceArn": "${aws_cloudwatch_event_rule.instance_running.arn}"
+        }
+      }
+    }
+  ]
+}
+EOF
+}
+
+resource "aws_cloudwatch_event_target" "bootstrap_queue" {
   rule = "${aws_cloudwatch_event_rule.instance_running.name}"
   target_id = "garlc_bootstrap"
+  arn = "${aws_sqs_queue.bootstrap_launches.arn}"
+}
+
+resource "aws_lambda_event_source_mapping" "bootstrap_launches" {
+  event_source_arn = "${aws_sqs_queue.bootstrap_launches.arn}"
+  function_name = "${aws_lambda_function.bootstrap_lambda_function.arn}"
+  batch_size = "${var.bootstrap_batch_size}"
+  maximum_batching_window_in_seconds = "${var.bootstrap_max_wait_seconds}"
+}
+
+# Keeps a container warm, with its clients created and the pipeline bucket
+# and latest deployment loaded, ahead of the launches of a scale out
+resource "aws_cloudwatch_event_rule" "bootstrap_prewarm" {
+  name = "garlc_bootstrap_prewarm"
+  description = "Keep a garlc_bootstrap container warm"
+  schedule_expression = "rate(5 minutes)"
+}
+
+resource "aws_cloudwatch_event_target" "bootstrap_prewarm" {
+  rule = "${aws_cloudwatch_event_rule.bootstrap_prewarm.name}"
+  target_id = "garlc_bootstrap_prewarm"
   arn = "${aws_lambda_function.bootstrap_lambda_function.arn}"
+  input = "{\"Prewarm\": true}"
+}
+
+resource "aws_lambda_permission" "bootstrap_prewarm" {
+  statement_id = "AllowPrewarmFromCloudWatch"
+  action = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.bootstrap_lambda_function.function_name}"
+  principal = "events.amazonaws.com"
+  source_arn = "${aws_cloudwatch_event_rule.bootstrap_prewarm.arn}"
 }
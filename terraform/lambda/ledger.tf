@@ -0,0 +1,61 @@
+# Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file
+# except in compliance with the License. A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS"
+# BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under the License.
+
+# Ledger of the chunks the Run Command helper has sent, so retried and resumed
+# helpers never send a chunk twice or leave one out (set GARLC_LEDGER to
+# dynamodb:garlc_dispatch_ledger on both Lambda functions to use it).
+# Entries expire a week after they were last written.
+resource "aws_dynamodb_table" "garlc_dispatch_ledger" {
+    name = "garlc_dispatch_ledger"
+    read_capacity = 5
+    write_capacity = 50
+    hash_key = "Deployment"
+    range_key = "Chunk"
+
+    attribute {
+        name = "Deployment"
+        type = "S"
+    }
+
+    attribute {
+        name = "Chunk"
+        type = "S"
+    }
+
+    ttl {
+        attribute_name = "Expires"
+        enabled = true
+    }
+}
+
+resource "aws_iam_role_policy" "runcommand_helper_ledger_policy" {
+    name = "ledger_policy"
+    role = "${aws_iam_role.runcommand_helper_lambda_role.id}"
+    policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Action": [
+        "dynamodb:PutItem",
+        "dynamodb:Query"
+      ],
+      "Resource": "${aws_dynamodb_table.garlc_dispatch_ledger.arn}"
+    }
+  ]
+}
+EOF
+}
+
+output "dispatch_ledger_name" {
+  value = "${aws_dynamodb_table.garlc_dispatch_ledger.name}"
+}
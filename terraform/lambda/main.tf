@@ -50,6 +50,30 @@ resource "aws_iam_role_policy" "codepipeline_policy" {
 EOF
 }
 
+# Add S3 Put policy for the latest artifact pointer, and List for the chunks
+# the helper failed to send
+resource "aws_iam_role_policy" "s3_policy" {
+    name = "s3_policy"
+    role = "${aws_iam_role.lambda_role.id}"
+    policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Action": [
+        "s3:PutObject",
+        "s3:GetObject",
+        "s3:DeleteObject",
+        "s3:ListBucket"
+      ],
+      "Resource": "*"
+    }
+  ]
+}
+EOF
+}
+
 resource "aws_iam_role_policy" "lambda_policy" {
     name = "lambda_policy"
     role = "${aws_iam_role.lambda_role.id}"
@@ -61,7 +85,9 @@ resource "aws_iam_role_policy" "lambda_policy" {
       "Effect": "Allow",
       "Action": [
         "lambda:InvokeFunction",
-        "ec2:Describe*"
+        "ec2:Describe*",
+        "ssm:ListCommands",
+        "ssm:ListCommandInvocations"
       ],
       "Resource": "*"
     }
@@ -70,6 +96,25 @@ resource "aws_iam_role_policy" "lambda_policy" {
 EOF
 }
 
+# Allow assuming the roles of the Targets in other accounts, which are named
+# garlc_* and trust this role
+resource "aws_iam_role_policy" "assume_target_role_policy" {
+    name = "assume_target_role_policy"
+    role = "${aws_iam_role.lambda_role.id}"
+    policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Action": "sts:AssumeRole",
+      "Resource": "arn:aws:iam::*:role/garlc_*"
+    }
+  ]
+}
+EOF
+}
+
 resource "aws_iam_role" "lambda_role" {
     name = "garlc_lambda_role"
     assume_role_policy = <<EOF
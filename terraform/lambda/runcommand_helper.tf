@@ -52,6 +52,28 @@ resource "aws_iam_role_policy" "runcommand_helper_ssm_policy" {
 EOF
 }
 
+# Allow reading the manifests handed off by the main function, and recording
+# the chunks that failed to send next to them
+resource "aws_iam_role_policy" "runcommand_helper_s3_policy" {
+    name = "s3_policy"
+    role = "${aws_iam_role.runcommand_helper_lambda_role.id}"
+    policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Action": [
+        "s3:GetObject",
+        "s3:PutObject"
+      ],
+      "Resource": "*"
+    }
+  ]
+}
+EOF
+}
+
 resource "aws_iam_role_policy" "runcommand_helper_lambda_policy" {
     name = "lambda_policy"
     role = "${aws_iam_role.runcommand_helper_lambda_role.id}"
@@ -71,6 +93,25 @@ resource "aws_iam_role_policy" "runcommand_helper_lambda_policy" {
 EOF
 }
 
+# Allow assuming the roles of the Targets in other accounts, which are named
+# garlc_* and trust this role
+resource "aws_iam_role_policy" "runcommand_helper_assume_target_role_policy" {
+    name = "assume_target_role_policy"
+    role = "${aws_iam_role.runcommand_helper_lambda_role.id}"
+    policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Effect": "Allow",
+      "Action": "sts:AssumeRole",
+      "Resource": "arn:aws:iam::*:role/garlc_*"
+    }
+  ]
+}
+EOF
+}
+
 resource "aws_iam_role" "runcommand_helper_lambda_role" {
     name = "garlc_runcommand_helper_lambda_role"
     assume_role_policy = <<EOF
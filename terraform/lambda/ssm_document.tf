@@ -0,0 +1,23 @@
+# Copyright 2016 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You may not use this file
+# except in compliance with the License. A copy of the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is distributed on an "AS IS"
+# BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under the License.
+
+# Run Command document holding the deploy script, so only the artifact URL
+# is sent with each command (set GARLC_SSM_DOCUMENT to GARLC-Deploy to use it).
+# Every change to garlc_deploy.json creates a new version of the document.
+resource "aws_ssm_document" "garlc_deploy" {
+    name = "GARLC-Deploy"
+    document_type = "Command"
+    content = "${file("${path.module}/garlc_deploy.json")}"
+}
+
+output "deploy_document_name" {
+  value = "${aws_ssm_document.garlc_deploy.name}"
+}
@@ -0,0 +1,11 @@
+variable "bootstrap_batch_size" {
+  default = 50
+}
+
+variable "bootstrap_max_wait_seconds" {
+  default = 5
+}
+
+variable "bootstrap_max_receives" {
+  default = 5
+}
@@ -1,16 +1,27 @@
-resource "aws_launch_configuration" "garlc" {
-  lifecycle { create_before_destroy = true }
+# A launch template rather than a launch configuration, as only launch
+# templates can allow instance tags in the instance metadata, where
+# generate_inventory.py reads the roles tag without an EC2 API call
+resource "aws_launch_template" "garlc" {
   name_prefix = "garlc-"
   image_id = "${lookup(var.amis, var.region)}"
-  enable_monitoring = true
   instance_type = "${var.instance_type}"
-  security_groups = [
+  vpc_security_group_ids = [
     "${aws_security_group.garlc_demo_sg.id}"
   ]
-  iam_instance_profile = "${var.iam_instance_profile}"
+  iam_instance_profile {
+    name = "${var.iam_instance_profile}"
+  }
+  monitoring {
+    enabled = true
+  }
+  metadata_options {
+    http_endpoint = "enabled"
+    instance_metadata_tags = "enabled"
+  }
 }
+# The ID of the launch template
 output "lcid" {
-  value = "${aws_launch_configuration.garlc.id}"
+  value = "${aws_launch_template.garlc.id}"
 }
 
 resource "aws_security_group" "garlc_demo_sg" {